@@ -4,7 +4,8 @@ import sys
 import gzip
 import json
 from urlparse import urlparse
-import tldextract
+import domains
+from url_filter import BloomFilter
 
 # Input looks like this:
 # lang-independent url    url                       ELANG   LANGS
@@ -19,7 +20,7 @@ import tldextract
 
 
 def get_tld(uri):
-    tld = tldextract.extract(urlparse(uri).netloc)
+    tld = domains.extract(urlparse(uri).netloc)
     return tld
 
 
@@ -53,16 +54,25 @@ if __name__ == "__main__":
 
     parser.add_argument('--outfile', type=argparse.FileType('w'),
                         default=sys.stdout)
+    parser.add_argument('--filter',
+                        help='skip lines not in this filter before parsing '
+                        'them, see url_filter.py')
     args = parser.parse_args(sys.argv[1:])
 
     valid_tlds, uri_dict = read_candidates(args.candidates)
     sys.stderr.write("Looking for %d URLs from %d domains\n" %
                      (len(uri_dict), len(valid_tlds)))
 
+    url_filter = None
+    if args.filter:
+        url_filter = BloomFilter.load(args.filter)
+
     tld_found, uri_found, n_lines, errors = 0, 0, 0, 0
     for line in sys.stdin:
-        tld, json_data = line.split(" ", 1)
         n_lines += 1
+        if url_filter is not None and not url_filter.check_line(line):
+            continue
+        tld, json_data = line.split(" ", 1)
         if tld not in valid_tlds:
             continue
 
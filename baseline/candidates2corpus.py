@@ -8,6 +8,7 @@ from ccdownloader import CCDownloader
 from html2text import html2text
 from textsanitzer import TextSanitizer
 from external_processor import TextProcessor
+from record_cache import RecordCache
 
 
 def process_candidates(candidates, outfile):
@@ -28,15 +29,48 @@ def process_candidates(candidates, outfile):
     outfile.write("\n")
 
 
-def extract(html, lang, text_processor):
+def extract(html, lang):
+    """ Sentence splitting and tokenization are left to a batched
+        TextProcessor.process_documents call """
     text = u""
     if html:
         html = TextSanitizer.to_unicode(html, is_html=True,
                                         lang=lang)
         text = html2text(html.encode('utf-8'), sanitize=True)
-        text = text_processor.process(text)
     return html, text
 
+
+def process_batch(batch, args, source_text_processor, target_text_processor):
+    """ batch is a list of ((url, html), (url, html)) candidate pairs """
+    sources = [extract(html, args.srclang) for (url, html), _ in batch]
+    targets = [extract(html, args.tgtlang) for _, (url, html) in batch]
+    source_texts = source_text_processor.process_documents(
+        [text for html, text in sources])
+    target_texts = target_text_processor.process_documents(
+        [text for html, text in targets])
+    for ((src_url, _), (tgt_url, _)), (src_html, _), (tgt_html, _), \
+            src_text, tgt_text in zip(batch, sources, targets,
+                                      source_texts, target_texts):
+        process_candidates([(src_url, src_text, src_html),
+                            (tgt_url, tgt_text, tgt_html)], args.outfile)
+
+
+def read_locations(lines, urls):
+    """ Yields (filename, offset, length) per line, keeps urls by index """
+    for linenr, line in enumerate(lines):
+        # if linenr > 0:
+        #     if linenr % 100 == 0:
+        #         sys.stderr.write('.')
+        #     if linenr % 1000 == 0:
+        #         sys.stderr.write("[%d]\n" % linenr)
+        url, _crawl, data = line.split('\t', 2)
+        data = json.loads(data)
+        # Workaround server error
+        if 'offset:' in data:
+            data['offset'] = data.pop('offset:')
+        urls[linenr] = url
+        yield data['filename'], int(data[u'offset']), int(data['length'])
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -54,41 +88,61 @@ if __name__ == "__main__":
                         help="source langauge e.g. en")
     parser.add_argument('-tgtlang',
                         help="target langauge e.g. fr")
+    parser.add_argument('-workers', type=int, default=1,
+                        help='splitter/tokenizer processes per language')
+    parser.add_argument('-timeout', type=float, default=60.0,
+                        help='seconds per document for splitter/tokenizer')
+    parser.add_argument('-batch_size', type=int, default=100,
+                        help='candidate pairs per splitter/tokenizer batch')
+    parser.add_argument('-downloads', type=int, default=16,
+                        help='number of concurrent downloads')
+    parser.add_argument('-coalesce', action='store_true',
+                        help='merge nearby records of the same WARC file '
+                        'into one request, reads all locations first')
+    parser.add_argument('-max_gap', type=int, default=128 * 1024,
+                        help='max. bytes between coalesced records')
+    parser.add_argument('-max_request', type=int, default=8 * 1024 * 1024,
+                        help='max. bytes per coalesced request')
+    parser.add_argument('-cache_dir',
+                        help='keep downloaded records in this directory')
+    parser.add_argument('-cache_size', type=float, default=10.,
+                        help='max. cache size in GB')
     args = parser.parse_args(sys.argv[1:])
 
-    downloader = CCDownloader()
+    cache = None
+    if args.cache_dir:
+        cache = RecordCache(args.cache_dir,
+                            max_size=int(args.cache_size * 1024 ** 3))
+    downloader = CCDownloader(cache=cache)
     source_text_processor = TextProcessor(splitter=args.source_splitter,
-                                          tokenizer=args.source_tokenizer)
+                                          tokenizer=args.source_tokenizer,
+                                          n_workers=args.workers,
+                                          timeout=args.timeout)
     target_text_processor = TextProcessor(splitter=args.target_splitter,
-                                          tokenizer=args.target_tokenizer)
+                                          tokenizer=args.target_tokenizer,
+                                          n_workers=args.workers,
+                                          timeout=args.timeout)
 
+    batch = []
     candidates = []
-    for linenr, line in enumerate(sys.stdin):
-        # if linenr > 0:
-        #     if linenr % 100 == 0:
-        #         sys.stderr.write('.')
-        #     if linenr % 1000 == 0:
-        #         sys.stderr.write("[%d]\n" % linenr)
-        url, _crawl, data = line.split('\t', 2)
-        data = json.loads(data)
-        # Workaround server error
-        if 'offset:' in data:
-            data['offset'] = data.pop('offset:')
-
-        html = downloader.download(data['filename'],
-                                   int(data[u'offset']),
-                                   int(data['length']),
-                                   html_only=True)
-
-        text = u""
-        if len(candidates) == 0:
-            html, text = extract(html, args.srclang, source_text_processor)
-        else:
-            assert len(candidates) == 1
-            html, text = extract(html, args.tgtlang, target_text_processor)
-
-        candidates.append((url, text, html))
+    urls = {}
+    for linenr, html in downloader.download_many(
+            read_locations(sys.stdin, urls), n_workers=args.downloads,
+            html_only=True, coalesce=args.coalesce, max_gap=args.max_gap,
+            max_size=args.max_request):
+        url = urls.pop(linenr)
+        candidates.append((url, html))
 
         if len(candidates) == 2:
-            process_candidates(candidates, args.outfile)
+            batch.append(tuple(candidates))
             candidates = []
+            if len(batch) >= args.batch_size:
+                process_batch(batch, args, source_text_processor,
+                              target_text_processor)
+                batch = []
+
+    if batch:
+        process_batch(batch, args, source_text_processor,
+                      target_text_processor)
+    if cache is not None:
+        cache.report()
@@ -1,4 +1,6 @@
+import Queue
 import requests
+import threading
 import zlib
 import sys
 import time
@@ -9,8 +11,26 @@ class CCDownloader(object):
 
     magic_number = "df6fa1abb58549287111ba8d776733e9"
 
-    def __init__(self):
-        self.session = requests.Session()
+    def __init__(self, pool_size=10, cache=None):
+        # one session per thread, see download_many
+        self._local = threading.local()
+        self.pool_size = pool_size
+        # optional RecordCache for raw records
+        self.cache = cache
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        if getattr(self._local, 'session', None) is None:
+            self._local.session = self._new_session()
+        return self._local.session
 
     # TODO: check if we can deprecate this
     def make_full_path(self, crawl, folder, filename):
@@ -35,26 +55,32 @@ class CCDownloader(object):
     def _restart_session(self, wait_before_restart=1):
         self.session.close()
         time.sleep(wait_before_restart)
-        self.session = requests.Session()
+        self._local.session = self._new_session()
 
     def _try_request(self, location, headers, timeout=5, retries=5,
-                     use_session=True):
+                     use_session=True, backoff=0.5):
+        """ Retries failed connections and 429/5xx responses with
+            exponentially growing pauses, the last try without session """
         resp = None
-        try:
-            if use_session:
-                resp = self.session.get(
-                    location, headers=headers, timeout=timeout)
-            else:
-                resp = requests.get(location, headers=headers, timeout=timeout)
-        except requests.exceptions.RequestException:
-            self._restart_session()
-            if retries == 1:
-                return self._try_request(location, headers, timeout,
-                                         retries - 1, use_session=False)
-            elif retries > 1:
-                return self._try_request(location, headers, timeout,
-                                         retries - 1, use_session)
-
+        for attempt in range(retries + 1):
+            try:
+                if use_session and attempt < retries:
+                    resp = self.session.get(
+                        location, headers=headers, timeout=timeout)
+                else:
+                    resp = requests.get(location, headers=headers,
+                                        timeout=timeout)
+            except requests.exceptions.RequestException:
+                if attempt < retries:
+                    self._restart_session(backoff * 2 ** attempt)
+                continue
+            # throttled or server trouble, worth another try
+            if resp.status_code in (429, 500, 502, 503, 504) and \
+                    attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+                continue
+            break
+        else:
             sys.stderr.write("Error downloading: %s from %s\n" %
                              (str(headers), location))
             return False, None
@@ -70,18 +96,31 @@ class CCDownloader(object):
     def download(self, location, offset, length, html_only=False, timeout=5):
         start_range = offset
         end_range = offset + length - 1
-        r = {'Range': "bytes=%d-%d" % (start_range, end_range)}
-        success, resp = self._try_request(location, r, timeout)
+        content = None
+        if self.cache is not None:
+            content = self.cache.get(location, offset, length)
+        if content is None:
+            r = {'Range': "bytes=%d-%d" % (start_range, end_range)}
+            success, resp = self._try_request(location, r, timeout)
+            if not success:
+                return u''
+            content = resp.content
+            if self.cache is not None and len(content) == length:
+                self.cache.put(location, offset, length, content)
 
-        if not success:
-            return u''
+        return self._decode_record(content, location, offset, length,
+                                   html_only)
 
+    def _decode_record(self, content, location, offset, length, html_only):
+        """ Gunzips one WARC record and splits off the headers """
+        start_range = offset
+        end_range = offset + length - 1
         warc_record = None
         try:
-            warc_record = zlib.decompress(resp.content, zlib.MAX_WBITS | 16)
+            warc_record = zlib.decompress(content, zlib.MAX_WBITS | 16)
         except zlib.error:
             sys.stderr.write("Error decompressing %d bytes from %s: %d-%d\n"
-                             % (len(resp.content),
+                             % (len(content),
                                 location, start_range, end_range))
             return u''
 
@@ -91,13 +130,177 @@ class CCDownloader(object):
             return page
         return u"%s\n\n%s" % (header.strip(), page)
 
+    @staticmethod
+    def plan_ranges(locations, max_gap=128 * 1024, max_size=8 * 1024 * 1024):
+        """ Groups (location, offset, length) requests into fewer, larger
+            range requests: sorted by (location, offset), a record joins the
+            previous range if it starts at most max_gap bytes after its end
+            and the range stays within max_size bytes. Returns a list of
+            (location, start, end, [(index, offset, length), ...]). """
+        order = sorted(range(len(locations)),
+                       key=lambda idx: locations[idx][:2])
+        groups = []
+        for idx in order:
+            location, offset, length = locations[idx]
+            if groups:
+                g_location, g_start, g_end, members = groups[-1]
+                if g_location == location and \
+                        offset <= g_end + max_gap and \
+                        max(g_end, offset + length) - g_start <= max_size:
+                    groups[-1] = (g_location, g_start,
+                                  max(g_end, offset + length), members)
+                    members.append((idx, offset, length))
+                    continue
+            groups.append((location, offset, offset + length,
+                           [(idx, offset, length)]))
+        return groups
+
+    def download_range(self, group, html_only=False, timeout=5):
+        """ Downloads one group from plan_ranges with a single request and
+            returns [(index, page), ...] for its members """
+        location, start, end, members = group
+        contents = {}
+        if self.cache is not None:
+            for idx, offset, length in members:
+                contents[idx] = self.cache.get(location, offset, length)
+            missing = [(offset, length) for idx, offset, length in members
+                       if contents[idx] is None]
+            # only fetch the span of the records we don't have
+            if missing:
+                start = min(offset for offset, length in missing)
+                end = max(offset + length for offset, length in missing)
+        else:
+            missing = members
+        success, resp = False, None
+        if missing:
+            r = {'Range': "bytes=%d-%d" % (start, end - 1)}
+            success, resp = self._try_request(location, r, timeout)
+        pages = []
+        for idx, offset, length in members:
+            content = contents.get(idx)
+            if content is None and success:
+                content = resp.content[offset - start:offset - start + length]
+                if self.cache is not None and len(content) == length:
+                    self.cache.put(location, offset, length, content)
+            if not content or len(content) < length:
+                pages.append((idx, u''))
+                continue
+            pages.append((idx, self._decode_record(content, location, offset,
+                                                   length, html_only)))
+        return pages
+
+    def _map_threads(self, function, tasks, n_workers, ordered):
+        """ Calls function on every task with n_workers threads and yields
+            (index, result). At most a few times n_workers results are held
+            in memory. """
+        task_queue, results = Queue.Queue(), Queue.Queue()
+
+        def work():
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    break
+                idx, task = task
+                try:
+                    result = function(task)
+                except Exception as e:
+                    sys.stderr.write("Error downloading %s: %s\n"
+                                     % (task[0], e))
+                    result = None
+                results.put((idx, result))
+
+        threads = [threading.Thread(target=work) for _ in range(n_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        window = 4 * n_workers
+        tasks = iter(tasks)
+        n_submitted, n_done, next_idx = 0, 0, 0
+        buffered = {}
+        exhausted = False
+        try:
+            while True:
+                # in ordered mode buffered results count against the window
+                while not exhausted and n_submitted - \
+                        (next_idx if ordered else n_done) < window:
+                    try:
+                        task = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    task_queue.put((n_submitted, task))
+                    n_submitted += 1
+                if exhausted and n_done == n_submitted:
+                    break
+                idx, result = results.get()
+                n_done += 1
+                if not ordered:
+                    yield idx, result
+                    continue
+                buffered[idx] = result
+                while next_idx in buffered:
+                    yield next_idx, buffered.pop(next_idx)
+                    next_idx += 1
+        finally:
+            for thread in threads:
+                task_queue.put(None)
+
+    def download_many(self, locations, n_workers=16, ordered=True,
+                      html_only=False, timeout=5, coalesce=False,
+                      max_gap=128 * 1024, max_size=8 * 1024 * 1024):
+        """ Downloads (location, offset, length) tuples with n_workers
+            threads. Yields (index, page) pairs, in input order if ordered
+            is set, otherwise as soon as a download finishes.
+            With coalesce, nearby records of the same file are fetched
+            with one request, see plan_ranges. This reads all locations
+            first and in ordered mode may hold many pages in memory. """
+        if not coalesce:
+            def download(location):
+                return self.download(*location, html_only=html_only,
+                                     timeout=timeout)
+            for idx, page in self._map_threads(download, locations,
+                                               n_workers, ordered):
+                yield idx, page or u''
+            return
+
+        locations = list(locations)
+        groups = self.plan_ranges(locations, max_gap, max_size)
+        sys.stderr.write("Fetching %d records with %d requests\n"
+                         % (len(locations), len(groups)))
+
+        def download_range(group):
+            return self.download_range(group, html_only=html_only,
+                                       timeout=timeout)
+        next_idx = 0
+        buffered = {}
+        for group_idx, pages in self._map_threads(download_range, groups,
+                                                  n_workers, ordered=False):
+            if pages is None:  # failed altogether
+                pages = [(idx, u'') for idx, _, _ in groups[group_idx][3]]
+            for idx, page in pages:
+                if not ordered:
+                    yield idx, page
+                    continue
+                buffered[idx] = page
+                while next_idx in buffered:
+                    yield next_idx, buffered.pop(next_idx)
+                    next_idx += 1
+
     # TODO: check if we can deprecate this
     def download_and_write(self, line, outfile, crawl, html_only=False):
-        folder, filename = line[4].split('/')
-        full_filename = self.make_full_path(crawl, folder, filename)
-        offset = int(line[5])
-        length = int(line[6])
+        full_filename, offset, length = self.location(line, crawl)
         raw_page = self.download(full_filename, offset, length)
+        self.write_record(line, raw_page, outfile, html_only)
+
+    def location(self, line, crawl):
+        """ (location, offset, length) for a line as used by
+            download_and_write """
+        folder, filename = line[4].split('/')
+        return (self.make_full_path(crawl, folder, filename),
+                int(line[5]), int(line[6]))
+
+    def write_record(self, line, raw_page, outfile, html_only=False):
         sys.stderr.write("%s : %d bytes\n" % (line[1], len(raw_page)))
         if raw_page:
             outfile.write("%s\t%s\n" %
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import re
+import string
+import sys
+
+# Drop-in replacement for tldextract.extract on hot paths. Common Crawl
+# records come clustered by host, so results are cached per netloc; misses
+# are resolved with a trie over the public suffix list instead of one set
+# lookup per possible suffix. Works offline: the suffix list is read from a
+# file or taken from tldextract's cache/bundled snapshot, never downloaded.
+
+ExtractResult = collections.namedtuple('ExtractResult',
+                                       'subdomain domain suffix')
+
+SCHEME_RE = re.compile(r'^([' + string.ascii_letters + string.digits +
+                       r'+\-.]+:)?//')
+IP_RE = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}'
+                   r'(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
+PUBLIC_SUFFIX_RE = re.compile(r'^(?P<suffix>[.*!]*\w[\S]*)',
+                              re.UNICODE | re.MULTILINE)
+
+_EXCEPTION, _RULE = 1, 2
+
+
+def read_suffix_list(fh, include_private=False):
+    """ Rules from a public_suffix_list.dat """
+    text = fh.read().decode('utf-8')
+    if not include_private:
+        text = text.split('===BEGIN PRIVATE DOMAINS===')[0]
+    return [m.group('suffix') for m in PUBLIC_SUFFIX_RE.finditer(text)]
+
+
+def tldextract_suffixes():
+    """ The rules tldextract uses, without going online """
+    import tldextract
+    try:
+        extractor = tldextract.TLDExtract(suffix_list_urls=None)
+    except TypeError:  # tldextract < 2
+        extractor = tldextract.TLDExtract(fetch=False)
+    return list(extractor._get_tld_extractor().tlds)
+
+
+def _decode_punycode(label):
+    lowered = label.lower()
+    if lowered.startswith('xn--'):
+        try:
+            return lowered.encode('ascii').decode('idna').lower()
+        except (UnicodeError, IndexError):
+            pass
+    return lowered
+
+
+class SuffixTrie(object):
+
+    """ Public suffix rules by label, right to left """
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            flag = _RULE
+            if rule.startswith('!'):
+                rule, flag = rule[1:], _EXCEPTION
+            node = self.root
+            for label in reversed(rule.split('.')):
+                node = node.setdefault(label, {})
+            node[None] = node.get(None, 0) | flag
+
+    def suffix_index(self, lower_labels):
+        """ Index of the first suffix label, as tldextract finds it: the
+            longest matching rule, exceptions before rules before
+            wildcards of the same length. len(labels) if nothing matches. """
+        index = len(lower_labels)
+        node = self.root
+        for i in xrange(len(lower_labels) - 1, -1, -1):
+            wildcard = node.get('*')
+            node = node.get(lower_labels[i])
+            if node is not None and node.get(None, 0) & _EXCEPTION:
+                index = i + 1
+            elif node is not None and node.get(None, 0) & _RULE:
+                index = i
+            elif wildcard is not None and wildcard.get(None, 0) & _RULE:
+                index = i
+            if node is None:
+                break
+        return index
+
+
+class DomainExtractor(object):
+
+    """ Callable like tldextract.extract, with a bounded cache per netloc.
+        The cache keeps two generations of cache_size entries: when the
+        current one is full it becomes the old one, and old entries that
+        are used again move back, which is LRU-like at plain dict speed.
+    """
+
+    def __init__(self, suffixes=None, cache_size=100000):
+        if suffixes is None:
+            suffixes = tldextract_suffixes()
+        self.trie = SuffixTrie(suffixes)
+        self.cache_size = cache_size
+        self._cache, self._old_cache = {}, {}
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, url):
+        netloc = url
+        if '/' in url or ':' in url or '@' in url or '?' in url or \
+                '#' in url:
+            netloc = SCHEME_RE.sub("", url) \
+                .partition("/")[0] \
+                .partition("?")[0] \
+                .partition("#")[0] \
+                .split("@")[-1] \
+                .partition(":")[0]
+        netloc = netloc.strip().rstrip(".")
+        result = self._cache.get(netloc)
+        if result is not None:
+            self.hits += 1
+            return result
+        result = self._old_cache.get(netloc)
+        if result is None:
+            self.misses += 1
+            result = self._extract(netloc)
+        else:
+            self.hits += 1
+        if len(self._cache) >= self.cache_size:
+            self._old_cache = self._cache
+            self._cache = {}
+        self._cache[netloc] = result
+        return result
+
+    def _extract(self, netloc):
+        labels = netloc.split(".")
+        suffix_index = self.trie.suffix_index(
+            [_decode_punycode(label) for label in labels])
+
+        suffix = ".".join(labels[suffix_index:])
+        if not suffix and netloc and IP_RE.match(netloc):
+            return ExtractResult('', netloc, '')
+
+        subdomain = ".".join(labels[:suffix_index - 1]) if suffix_index else ""
+        domain = labels[suffix_index - 1] if suffix_index else ""
+        return ExtractResult(subdomain, domain, suffix)
+
+
+_extractor = None
+
+
+def extract(url):
+    """ Like tldextract.extract, using a shared DomainExtractor """
+    global _extractor
+    if _extractor is None:
+        _extractor = DomainExtractor()
+    return _extractor(url)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import tldextract
+    parser = argparse.ArgumentParser(
+        description='Compares speed and results with tldextract on urls '
+        'or netlocs, one per line')
+    parser.add_argument('infile', type=argparse.FileType('r'),
+                        default=sys.stdin, nargs='?')
+    parser.add_argument('-psl', type=argparse.FileType('r'),
+                        help='public_suffix_list.dat, default: '
+                        'tldextract\'s list')
+    parser.add_argument('-cache_size', type=int, default=100000)
+    args = parser.parse_args(sys.argv[1:])
+
+    urls = [line.strip().decode('utf-8') for line in args.infile]
+    suffixes = read_suffix_list(args.psl) if args.psl else None
+    extractor = DomainExtractor(suffixes, cache_size=args.cache_size)
+    tldextract.extract(u"example.com")  # load the suffix list first
+
+    start = time.time()
+    expected = [tldextract.extract(url) for url in urls]
+    tld_time = time.time() - start
+    start = time.time()
+    results = [extractor(url) for url in urls]
+    our_time = time.time() - start
+
+    n_diff = sum(1 for a, b in zip(expected, results) if tuple(a) != b)
+    sys.stdout.write("tldextract: %.0f records/s\n" % (len(urls) / tld_time))
+    sys.stdout.write("DomainExtractor: %.0f records/s (%d hits, %d misses)\n"
+                     % (len(urls) / our_time, extractor.hits,
+                        extractor.misses))
+    sys.stdout.write("%d of %d results differ\n" % (n_diff, len(urls)))
@@ -19,6 +19,8 @@ TLANG=it
 DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
 MOSESDIR=/home/buck/net/build/moses-clean/
 BITEXTORDIR=/home/buck/net/build/bitextor/
+# Downloaded records are kept here, reruns don't fetch them again
+CACHEDIR=${BASEDIR}/cache
 
 # Step 1: Download page pairs from S3
 DONEFILE=${BASEDIR}/locations/${PREFIX}.done
@@ -26,7 +28,7 @@ if [ ! -f ${DONEFILE} ]; then
   echo "Downloading locations from ${BASEDIR}/locations/${PREFIX}.loc.gz"
   zcat ${BASEDIR}/locations/${PREFIX}.loc.gz | \
   nice parallel -j 32 --pipe -L 2 \
-    ${DIR}/candidates2corpus.py \
+    ${DIR}/candidates2corpus.py -cache_dir ${CACHEDIR} \
         -source_splitter="'${MOSESDIR}/scripts/ems/support/split-sentences.perl -l ${SLANG} -b -q'" \
         -target_splitter="'${MOSESDIR}/scripts/ems/support/split-sentences.perl -l ${TLANG} -b -q'" | \
   nice pigz -9 > ${BASEDIR}/downloaded/${PREFIX}.down.gz
@@ -5,12 +5,13 @@ from urlparse import urlparse
 import gzip
 import os
 import sys
-import tldextract
 from ccdownloader import CCDownloader
+from record_cache import RecordCache
+import domains
 
 
 def get_domain(uri):
-    extract = tldextract.extract(urlparse(uri).netloc)
+    extract = domains.extract(urlparse(uri).netloc)
     return ".".join((extract.domain.encode('idna'), extract.suffix))
 
 
@@ -22,6 +23,14 @@ if __name__ == "__main__":
     parser.add_argument('crawl', help='crawl id, e.g. 2013_11')
     parser.add_argument('--outdir', help='prefix for filenames',
                         default='data/')
+    parser.add_argument('--max_gap', type=int, default=128 * 1024,
+                        help='max. bytes between records fetched together')
+    parser.add_argument('--max_request', type=int, default=8 * 1024 * 1024,
+                        help='max. bytes per request')
+    parser.add_argument('--cache_dir',
+                        help='keep downloaded records in this directory')
+    parser.add_argument('--cache_size', type=float, default=10.,
+                        help='max. cache size in GB')
     args = parser.parse_args(sys.argv[1:])
 
     source_lines, target_lines = defaultdict(list), defaultdict(list)
@@ -36,22 +45,35 @@ if __name__ == "__main__":
         else:
             continue
 
-    downloader = CCDownloader()
+    cache = None
+    if args.cache_dir:
+        cache = RecordCache(args.cache_dir,
+                            max_size=int(args.cache_size * 1024 ** 3))
+    downloader = CCDownloader(cache=cache)
 
+    # (output file, line) in the order they get written
+    jobs = []
     for language_independent_url in source_lines:
         if language_independent_url in target_lines:
             domain = get_domain(source_lines[language_independent_url][0][1])
+            for lang, lines in ((args.srclang, source_lines),
+                                (args.tgtlang, target_lines)):
+                filename = os.path.join(args.outdir,
+                                        "%s_%s.gz" % (domain, lang))
+                for line in lines[language_independent_url]:
+                    jobs.append((filename, line))
 
-            outfile = gzip.open(
-                os.path.join(args.outdir,
-                             "%s_%s.gz" % (domain, args.srclang)), "a", 9)
-            for line in source_lines[language_independent_url]:
-                downloader.download_and_write(line, outfile, args.crawl)
-            outfile.close()
-
-            outfile = gzip.open(
-                os.path.join(args.outdir,
-                             "%s_%s.gz" % (domain, args.tgtlang)), "a", 9)
-            for line in target_lines[language_independent_url]:
-                downloader.download_and_write(line, outfile, args.crawl)
-            outfile.close()
+    outfile = None
+    pages = downloader.download_many(
+        [downloader.location(line, args.crawl) for filename, line in jobs],
+        coalesce=True, max_gap=args.max_gap, max_size=args.max_request)
+    for (filename, line), (idx, raw_page) in zip(jobs, pages):
+        if outfile is None or outfile.name != filename:
+            if outfile is not None:
+                outfile.close()
+            outfile = gzip.open(filename, "a", 9)
+        downloader.write_record(line, raw_page, outfile)
+    if outfile is not None:
+        outfile.close()
+    if cache is not None:
+        cache.report()
@@ -1,7 +1,9 @@
+import logging
 import os
+import Queue
 import subprocess
 import threading
-import logging
+import time
 
 
 class ExternalTextProcessor(object):
@@ -70,48 +72,212 @@ class ExternalLineProcessor(object):
         return result.decode("utf-8").strip()
 
 
+# Marks the end of a document in the input, comes back as a line of its own
+# from sentence splitters and tokenizers alike (at most with changed case).
+DOCUMENT_MARKER = u"baselinedocumentend5e1d0b7c"
+
+
+class PersistentProcess(object):
+
+    """ Long-lived external process with a writer and a reader thread, so
+        neither a full pipe nor a hanging process can block the caller """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.devnull = open(os.devnull, 'wb')
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd.split(),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self.devnull)
+        self.input = Queue.Queue()
+        self.output = Queue.Queue()
+        for target, args in ((self._write, (self.proc.stdin, self.input)),
+                             (self._read, (self.proc.stdout, self.output))):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _write(stdin, data_queue):
+        while True:
+            data = data_queue.get()
+            if data is None:
+                break
+            try:
+                stdin.write(data)
+                stdin.flush()
+            except (IOError, ValueError):
+                break
+
+    @staticmethod
+    def _read(stdout, line_queue):
+        for line in iter(stdout.readline, ''):
+            line_queue.put(line)
+        line_queue.put(None)
+
+    def send(self, text):
+        self.input.put(text.encode('utf-8'))
+
+    def readline(self, timeout):
+        """ Next output line, None if the process is gone or timed out """
+        try:
+            line = self.output.get(timeout=max(timeout, 0))
+        except Queue.Empty:
+            return None
+        if line is None:
+            return None
+        return line.decode('utf-8')
+
+    def restart(self):
+        self.input.put(None)
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.start()
+
+
+class StreamingTextProcessor(object):
+
+    """ Streams many documents through n_workers long-lived processes, e.g.
+        split-sentences.perl -b or tokenizer.perl -b (output must not be
+        buffered). Each document is followed by DOCUMENT_MARKER. A worker
+        that needs more than timeout seconds for a document is restarted;
+        that document comes back empty and the worker's other pending
+        documents are sent again. """
+
+    def __init__(self, cmd, n_workers=1, timeout=60.0, max_pending=8):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.workers = [PersistentProcess(cmd) for _ in range(n_workers)]
+
+    def _send(self, worker, text):
+        # blank lines around the marker keep splitters from joining it with
+        # the last sentence, the extra output lines are empty or <P>
+        worker.send(u"%s\n\n%s\n\n" % (text.rstrip(u'\n'), DOCUMENT_MARKER))
+
+    def _receive(self, worker):
+        lines = []
+        deadline = time.time() + self.timeout
+        while True:
+            line = worker.readline(deadline - time.time())
+            if line is None:
+                return None
+            if line.strip().lower() == DOCUMENT_MARKER:
+                return u"".join(lines)
+            lines.append(line)
+
+    def process_documents(self, texts):
+        """ Yields the output for every text, in input order """
+        pending = [[] for _ in self.workers]  # texts sent to each worker
+        order = []  # worker index for every text in flight
+        texts = iter(texts)
+        exhausted = False
+        n_sent = 0
+        while True:
+            while not exhausted and \
+                    len(order) < self.max_pending * len(self.workers):
+                try:
+                    text = next(texts)
+                except StopIteration:
+                    exhausted = True
+                    break
+                worker_idx = n_sent % len(self.workers)
+                self._send(self.workers[worker_idx], text)
+                pending[worker_idx].append(text)
+                order.append(worker_idx)
+                n_sent += 1
+            if not order:
+                break
+
+            worker_idx = order.pop(0)
+            worker = self.workers[worker_idx]
+            text = pending[worker_idx].pop(0)
+            output = self._receive(worker)
+            if output is None:
+                logging.warning('Restarting %s after %f seconds'
+                                % (self.cmd, self.timeout))
+                logging.warning("failed for '%s'" % repr(text))
+                worker.restart()
+                for other in pending[worker_idx]:
+                    self._send(worker, other)
+                output = u""
+            yield output
+
+    def process(self, text):
+        return next(self.process_documents([text]))
+
+
 class TextProcessor(object):
 
-    def __init__(self, splitter=None, tokenizer=None):
+    """ Sentence splitting and tokenization of whole documents, one
+        sentence per output line. Both commands run as persistent
+        processes, n_workers of each. """
+
+    def __init__(self, splitter=None, tokenizer=None, n_workers=1,
+                 timeout=60.0):
         self.split_cmd = splitter
+        self.splitter = None
+        if splitter:
+            self.splitter = StreamingTextProcessor(splitter, n_workers,
+                                                   timeout)
         self.tokenizer = None
         if tokenizer:
-            self.tokenizer = ExternalLineProcessor(tokenizer)
+            self.tokenizer = StreamingTextProcessor(tokenizer, n_workers,
+                                                    timeout)
 
-    def split_sentences(self, text):
-        proc = ExternalTextProcessor(self.split_cmd.split())
-        output = proc.process(text.replace("\n", "\n\n"))
+    def _split(self, texts):
+        """ Yields a list of sentences per text """
+        if not self.splitter:
+            for text in texts:
+                yield [text]
+            return
+        outputs = self.splitter.process_documents(
+            text.replace("\n", "\n\n") for text in texts)
+        for output in outputs:
+            yield [line for line in output.split("\n")
+                   if line.strip() and line.strip() != "<P>"]
 
-        for line in output.split("\n"):
-            line = line.strip()
-            if not line or line == "<P>":
-                continue
-            yield line
+    def _tokenize(self, sentence_lists):
+        if not self.tokenizer:
+            for sentences in sentence_lists:
+                yield [s.strip() for s in sentences]
+            return
+        outputs = self.tokenizer.process_documents(
+            u"\n".join(s.strip() for s in sentences)
+            for sentences in sentence_lists)
+        for output in outputs:
+            yield [line.strip() for line in output.split("\n")]
 
-        # if not text:
-        #     return []
-
-        # p = subprocess.Popen(self.split_cmd.split(), stdin=subprocess.PIPE,
-        #                      stdout=subprocess.PIPE)
-        # out, err = p.communicate(input=text.encode("utf-8") + "\n")
-        # return out.decode("utf-8").split("\n")
+    def split_sentences(self, text):
+        for sentence in next(self._split([text])):
+            yield sentence.strip()
 
     def sentences(self, text):
         if text:
-            if self.split_cmd:
-                text = self.split_sentences(text)
-            else:
-                text = [text]
-            for line in text:
-                if not line.strip():
-                    continue
-                if self.tokenizer:
-                    yield self.tokenizer.process(line).strip()
-                else:
-                    yield line.strip()
+            for line in next(self._tokenize(self._split([text]))):
+                if line.strip():
+                    yield line
+
+    def process_documents(self, texts):
+        """ Streams many texts through splitter and tokenizer, yields the
+            result for every text in order """
+        texts = list(texts)
+        sentence_lists = (sentences for sentences in self._split(
+            text for text in texts if text))
+        results = self._tokenize(sentence_lists)
+        for text in texts:
+            if not text:
+                yield u""
+                continue
+            yield u"\n".join(line for line in next(results) if line.strip())
 
     def process(self, text):
         # text is unicode
         assert isinstance(text, unicode), "Expecting unicode input"
-        return "\n".join(
-            (line for line in self.sentences(text) if line.strip()))
+        return next(self.process_documents([text]))
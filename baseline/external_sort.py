@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import heapq
+import itertools
+import os
+import sys
+import tempfile
+
+# Sorting of more lines than fit into memory, in place of
+#   ... | sort -S500M | uniq | ...
+# Lines are collected until the memory budget is used up, sorted and
+# written to a gzip compressed temporary file. The sorted runs are then
+# merged, in several passes if there are too many of them to open at once.
+# Lines are compared as byte strings, like sort with LC_ALL=C, or by
+# (key(line), line) if a key function is given.
+
+LINE_OVERHEAD = 50  # approximate memory used per line besides its content
+
+
+def _read_lines(filename, block_size=1024 * 1024):
+    """ Lines of a gzip file, read in blocks which is a lot faster than
+        GzipFile's readline """
+    with gzip.open(filename) as f:
+        rest = ""
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if rest:
+            yield rest
+
+
+def _unique(lines):
+    previous = None
+    for line in lines:
+        if line != previous:
+            yield line
+            previous = line
+
+
+class ExternalSorter(object):
+
+    def __init__(self, memory=500 * 1024 * 1024, tmpdir=None, key=None,
+                 unique=False, max_merge=64, compresslevel=1):
+        """ memory is the budget in bytes for lines held in memory,
+            unique drops repeated lines like uniq """
+        self.memory = memory
+        self.tmpdir = tmpdir
+        self.key = key
+        self.unique = unique
+        self.max_merge = max_merge
+        self.compresslevel = compresslevel
+        self.runs = []
+        self._lines, self._size = [], 0
+
+    def add(self, line):
+        """ Adds one line """
+        if not line.endswith("\n"):
+            line += "\n"
+        self._lines.append(line)
+        self._size += len(line) + LINE_OVERHEAD
+        if self._size >= self.memory:
+            self._spill()
+
+    def extend(self, lines):
+        for line in lines:
+            self.add(line)
+
+    def _sorted(self, lines):
+        if self.key is None:
+            lines.sort()
+        else:
+            key = self.key
+            lines.sort(key=lambda line: (key(line), line))
+        if self.unique:
+            return _unique(lines)
+        return lines
+
+    def _write_run(self, lines):
+        fd, filename = tempfile.mkstemp(dir=self.tmpdir, prefix="sort",
+                                        suffix=".gz")
+        os.close(fd)
+        with gzip.open(filename, 'wb', self.compresslevel) as run:
+            run.writelines(lines)
+        self.runs.append(filename)
+
+    def _spill(self):
+        if self._lines:
+            self._write_run(self._sorted(self._lines))
+        self._lines, self._size = [], 0
+
+    def _merge(self, iterators):
+        if self.key is None:
+            merged = heapq.merge(*iterators)
+        else:
+            key = self.key
+            merged = (line for _, line in heapq.merge(
+                *[((key(line), line) for line in lines)
+                  for lines in iterators]))
+        if self.unique:
+            return _unique(merged)
+        return merged
+
+    def __iter__(self):
+        """ All lines in sorted order. Temporary files are removed once
+            they have been read completely, or by close. """
+        try:
+            # too many runs to open at once: merge the oldest ones first
+            while len(self.runs) >= self.max_merge:
+                runs = self.runs[:self.max_merge]
+                self.runs = self.runs[self.max_merge:]
+                self._write_run(self._merge([_read_lines(run)
+                                             for run in runs]))
+                for run in runs:
+                    os.remove(run)
+            in_memory = self._sorted(self._lines)
+            self._lines, self._size = [], 0
+            if self.runs:
+                sys.stderr.write("Merging %d sorted runs\n"
+                                 % len(self.runs))
+            for line in self._merge([iter(in_memory)] +
+                                    [_read_lines(run) for run in self.runs]):
+                yield line
+        finally:
+            self.close()
+
+    def close(self):
+        for run in self.runs:
+            if os.path.exists(run):
+                os.remove(run)
+        self.runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def sort_lines(lines, memory=500 * 1024 * 1024, tmpdir=None, key=None,
+               unique=False):
+    """ Iterator over lines in sorted order """
+    sorter = ExternalSorter(memory, tmpdir, key, unique)
+    sorter.extend(lines)
+    return iter(sorter)
+
+
+def group_lines(lines, key):
+    """ (key, [lines]) for consecutive lines with the same key, e.g.
+        group_lines(sort_lines(lines, key=key), key) """
+    for group_key, group in itertools.groupby(lines, key):
+        yield group_key, list(group)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Sorts lines like LC_ALL=C sort')
+    parser.add_argument('-memory', type=int, default=500,
+                        help='memory for sorting in MB')
+    parser.add_argument('-tmpdir', help='directory for temporary files')
+    parser.add_argument('-unique', action='store_true',
+                        help='drop repeated lines, like uniq')
+    args = parser.parse_args(sys.argv[1:])
+
+    for line in sort_lines(sys.stdin, args.memory * 1024 * 1024,
+                           args.tmpdir, unique=args.unique):
+        sys.stdout.write(line)
@@ -4,6 +4,8 @@ import sys
 import re
 import urlparse
 
+from external_sort import sort_lines, group_lines
+
 
 def process_buffer(buffer):
     if not buffer or len(buffer) < 2:
@@ -49,17 +51,17 @@ def process_buffer(buffer):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument('-sort', action='store_true',
+                        help='sort input first instead of expecting it '
+                        'grouped by stripped url')
+    parser.add_argument('-sort_memory', type=int, default=500,
+                        help='memory for sorting in MB')
+    parser.add_argument('-tmpdir', help='directory for temporary files')
+    args = parser.parse_args(sys.argv[1:])
 
-    buffer = []
-    buffer_url = None
-    for line in sys.stdin:
-        # line = line.decode("utf-8", "ignore")
-        url = line.split("\t", 1)[0]
-        if url != buffer_url:
-            process_buffer(buffer)
-            buffer = [line]
-            buffer_url = url
-        else:
-            buffer.append(line)
-            # print url != buffer_url
-    process_buffer(buffer)
+    lines = sys.stdin
+    if args.sort:
+        lines = sort_lines(lines, args.sort_memory * 1024 * 1024, args.tmpdir)
+    for url, buffer in group_lines(
+            lines, lambda line: line.split("\t", 1)[0]):
+        process_buffer(buffer)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import errno
+import fcntl
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# On-disk cache for downloaded WARC records, keyed by (filename, offset,
+# length). Records are stored exactly as downloaded, i.e. as gzip members,
+# one file per record named after the hash of the key. Files are written to
+# a temporary name and renamed, so concurrent readers and writers (threads
+# or `parallel -j 32` processes sharing a directory) never see partial
+# records. Hits touch the file's mtime; when the directory grows beyond
+# max_size the least recently used records are removed. The size is checked
+# after check_every bytes written by a process, and on the first write if no
+# process has checked within check_interval seconds (mtime of .checked), so
+# short-lived `parallel --pipe` jobs don't each scan the whole directory.
+
+
+class RecordCache(object):
+
+    def __init__(self, directory, max_size=10 * 1024 ** 3,
+                 check_every=None, check_interval=600):
+        self.directory = directory
+        self.max_size = max_size
+        # bytes written by this process before checking the total size
+        self.check_every = check_every or max(max_size // 20, 1)
+        self.check_interval = check_interval
+        self.hits, self.misses, self.bytes_read, self.bytes_written = \
+            0, 0, 0, 0
+        self._unchecked = 0
+        self._first_write = True
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, location, offset, length):
+        key = hashlib.sha1("%s %d %d" % (location, offset, length))
+        key = key.hexdigest()
+        return os.path.join(self.directory, key[:2], key[2:] + ".gz")
+
+    def get(self, location, offset, length):
+        """ The cached record or None """
+        path = self._path(location, offset, length)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            content = None
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_read += len(content)
+        return content
+
+    def put(self, location, offset, length, content):
+        path = self._path(location, offset, length)
+        dirname = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            sys.stderr.write("Could not cache %s %d %d\n"
+                             % (location, offset, length))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self.bytes_written += len(content)
+            self._unchecked += len(content)
+            due = self._unchecked >= self.check_every
+            if self._first_write:
+                self._first_write = False
+                due = due or self._check_overdue()
+            if not due:
+                return
+            self._unchecked = 0
+        self.evict()
+
+    def _marker(self):
+        return os.path.join(self.directory, '.checked')
+
+    def _check_overdue(self):
+        """ True if no process checked the size within check_interval """
+        try:
+            last_check = os.stat(self._marker()).st_mtime
+        except OSError:
+            return True
+        return last_check < time.time() - self.check_interval
+
+    def _entries(self):
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for filename in os.listdir(subdir):
+                if filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(subdir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed by another process
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self, target=0.9):
+        """ Removes least recently used records until the cache is below
+            target * max_size. Only one process at a time does this. """
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return  # somebody else is already at it
+            with open(self._marker(), 'a'):
+                os.utime(self._marker(), None)
+            entries = list(self._entries())
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_size:
+                return
+            entries.sort()
+            removed = 0
+            for _, size, path in entries:
+                if total <= target * self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            sys.stderr.write("Removed %d records from cache %s\n"
+                             % (removed, self.directory))
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / requests if requests else 0.,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written}
+
+    def report(self, outfile=sys.stderr):
+        outfile.write("Cache %s: %d hits, %d misses (%.1f%% hit rate), "
+                      "%d bytes read, %d bytes written\n"
+                      % (self.directory, self.hits, self.misses,
+                         100 * self.stats()["hit_rate"], self.bytes_read,
+                         self.bytes_written))
@@ -4,6 +4,8 @@ import sys
 import re
 import urlparse
 
+from external_sort import ExternalSorter
+
 magic_number = "df6fa1abb58549287111ba8d776733e9"
 
 
@@ -83,17 +85,40 @@ def process_buffer(buffer, language_stripper):
 
     languages = [lang for lang, percent, num_bytes in
                  get_languages(buffer[1:])]
-    print "\t".join((stripped_uri, uri, matched_language, "/".join(languages))).encode('utf-8')
+    return "\t".join((stripped_uri, uri, matched_language,
+                      "/".join(languages))).encode('utf-8') + "\n"
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sort', action='store_true',
+                        help='sort output by stripped url, for find_pairs.py')
+    parser.add_argument('-sort_memory', type=int, default=500,
+                        help='memory for sorting in MB')
+    parser.add_argument('-tmpdir', help='directory for temporary files')
+    args = parser.parse_args(sys.argv[1:])
+
+    sorter, write = None, sys.stdout.write
+    if args.sort:
+        sorter = ExternalSorter(args.sort_memory * 1024 * 1024, args.tmpdir)
+        write = sorter.add
+
     buffer = []
     language_stripper = LanguageStripper()
     for line in sys.stdin:
         line = line.decode("utf-8", "ignore")
         if line.startswith(magic_number):
-            process_buffer(buffer, language_stripper)
+            output = process_buffer(buffer, language_stripper)
+            if output:
+                write(output)
             buffer = [line]
         elif buffer:
             buffer.append(line)
-    process_buffer(buffer, language_stripper)
+    output = process_buffer(buffer, language_stripper)
+    if output:
+        write(output)
+
+    if sorter is not None:
+        for line in sorter:
+            sys.stdout.write(line)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import math
+import mmap
+import struct
+import sys
+from urlparse import urlparse
+
+import domains
+
+# Bloom filter over the URLs of a candidates/domainstats file and their
+# domains, built once and mmap'ed read-only by every worker, so parallel
+# shards share one copy through the page cache instead of each building
+# a set. Lines of the .links files produced by links_from_wat.py, i.e.
+#   domain {"container": ..., "uri": "http://...", ...}
+# are checked on the raw text before any JSON parsing. A bloom filter has
+# no false negatives, so lines that fail the check can be skipped; the few
+# false positives are removed by the exact lookup that follows.
+
+MAGIC = "CCBF"
+HEADER = struct.Struct("<4sQB")  # magic, number of bits, number of hashes
+DIGEST = struct.Struct("<QQ")
+URI_MARKER = '"uri": "'
+DOMAIN_PREFIX = "\t"  # cannot be part of a URL from a tab separated file
+
+
+def _hashes(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return DIGEST.unpack(hashlib.md5(key).digest())
+
+
+def raw_uri(line):
+    """ Value of "uri" in a JSON line without parsing it, None if it
+        is missing or escaped """
+    start = line.find(URI_MARKER)
+    if start < 0:
+        return None
+    start += len(URI_MARKER)
+    end = line.find('"', start)
+    if end < 0:
+        return None
+    uri = line[start:end]
+    if '\\' in uri:
+        return None
+    return uri
+
+
+class BloomFilter(object):
+
+    def __init__(self, bits, n_bits, n_hashes, offset=0):
+        """ bits is a bytearray, or a mmap of a filter file in which the
+            bit array starts at offset """
+        self.bits = bits
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.offset = offset
+        # indexing either of these gives single characters
+        self._bytes = memoryview(bits) if isinstance(bits, bytearray) \
+            else bits
+        # .links files are sorted by domain, remember the last one
+        self._last_domain, self._last_found = None, False
+
+    @classmethod
+    def create(cls, n_keys, fp_rate=0.001):
+        n_keys = max(n_keys, 1)
+        n_bits = int(math.ceil(-n_keys * math.log(fp_rate) /
+                               math.log(2) ** 2))
+        n_bits = max((n_bits + 7) // 8 * 8, 8)
+        n_hashes = max(int(round(float(n_bits) / n_keys * math.log(2))), 1)
+        return cls(bytearray(n_bits // 8), n_bits, n_hashes)
+
+    @classmethod
+    def load(cls, filename):
+        """ Maps a filter written by save into memory """
+        with open(filename, 'rb') as f:
+            bits = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        magic, n_bits, n_hashes = HEADER.unpack_from(bits)
+        assert magic == MAGIC, "Not a filter file: %s" % filename
+        return cls(bits, n_bits, n_hashes, HEADER.size)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.n_bits, self.n_hashes))
+            f.write(self.bits[self.offset:])
+
+    def _positions(self, key):
+        h1, h2 = _hashes(key)
+        n_bits = self.n_bits
+        return [(h1 + i * h2) % n_bits for i in xrange(self.n_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[self.offset + (pos >> 3)] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        data, offset = self._bytes, self.offset
+        for pos in self._positions(key):
+            if not ord(data[offset + (pos >> 3)]) & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add_domain(self, domain):
+        self.add(DOMAIN_PREFIX + domain)
+
+    def has_domain(self, domain):
+        return DOMAIN_PREFIX + domain in self
+
+    def check_line(self, line):
+        """ False if the domain or the uri of a .links line are certainly
+            not in the filter """
+        domain = line[:line.find(" ")]
+        if domain != self._last_domain:
+            self._last_domain = domain
+            self._last_found = self.has_domain(domain)
+        if not self._last_found:
+            return False
+        uri = raw_uri(line)
+        return uri is None or uri in self
+
+
+def open_file(filename):
+    if filename.lower().endswith(".gz"):
+        return gzip.open(filename)
+    return open(filename)
+
+
+def read_uris(infile):
+    """ URLs from the second column of a candidates/domainstats file """
+    for line in infile:
+        line = line.strip().split("\t")
+        assert len(line) == 4, "weird line: %s\n" % "\t".join(line)
+        yield line[1]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Builds a filter file for the --filter option of '
+        'collect_domains.py and add_warc_locations.py')
+    parser.add_argument('candidates', type=open_file,
+                        help='file containing candidates or domain stats')
+    parser.add_argument('outfile', help='filter file to write')
+    parser.add_argument('-fp_rate', type=float, default=0.001,
+                        help='false positive rate')
+    args = parser.parse_args(sys.argv[1:])
+
+    uris = set(read_uris(args.candidates))
+    domain_names = set(domains.extract(urlparse(uri).netloc).domain
+                       for uri in uris)
+    url_filter = BloomFilter.create(len(uris) + len(domain_names),
+                                    args.fp_rate)
+    for uri in uris:
+        url_filter.add(uri)
+    for domain in domain_names:
+        url_filter.add_domain(domain)
+    url_filter.save(args.outfile)
+    sys.stderr.write("Wrote filter of %d URLs from %d domains, %d bytes, "
+                     "%d hashes\n" % (len(uris), len(domain_names),
+                                       url_filter.n_bits // 8,
+                                       url_filter.n_hashes))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+import numpy as np
+
+from topk import TopKScores
+
+# Matching source to target documents given a score matrix, which is either
+# a dense ndarray or TopKScores. With TopKScores only candidate pairs can be
+# matched and the matrix is never densified or padded to a square.
+
+
+def _order_by_score(cols, scores):
+    """ Descending by score, ties broken by larger column first """
+    return np.lexsort((-cols, -scores))
+
+
+class _SparseRows(object):
+
+    """ Candidates of each row of a TopKScores, best first """
+
+    def __init__(self, scores):
+        order = np.lexsort((-scores.col, -scores.data, scores.row))
+        self.cols = scores.col[order]
+        self.data = scores.data[order]
+        counts = np.bincount(scores.row, minlength=scores.shape[0])
+        self.indptr = np.concatenate(([0], np.cumsum(counts)))
+
+    def rows(self):
+        return np.flatnonzero(np.diff(self.indptr))
+
+    def first(self, row):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.cols[start:end].tolist(), self.data[start:end].tolist()
+
+    def more(self, row):
+        return [], []
+
+
+class _DenseRows(object):
+
+    """ Candidates of each row of a dense matrix, best first. Only the
+        n_best entries per row are sorted up front (partial selection);
+        the rest of a row is sorted if greedy search ever gets there. """
+
+    def __init__(self, scores, n_best=10, block_size=1000):
+        self.scores = scores
+        self.n_best = min(n_best, scores.shape[1])
+        self.n_taken = np.zeros(scores.shape[0], dtype=np.int64)
+        self.firsts = {}
+        for start in xrange(0, scores.shape[0], block_size):
+            self._select(start, scores[start:start + block_size])
+
+    def _select(self, start, block):
+        if self.n_best == 0:
+            return
+        kth = -np.partition(-block, self.n_best - 1,
+                            axis=1)[:, self.n_best - 1]
+        # keep all ties of the n_best-th score so order stays exact
+        rows, cols = np.nonzero(block >= kth[:, np.newaxis])
+        values = block[rows, cols]
+        order = np.lexsort((-cols, -values, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        bounds = np.concatenate(
+            ([0], np.cumsum(np.bincount(rows, minlength=block.shape[0]))))
+        for row in xrange(block.shape[0]):
+            self.firsts[start + row] = (
+                cols[bounds[row]:bounds[row + 1]].tolist(),
+                values[bounds[row]:bounds[row + 1]].tolist())
+            self.n_taken[start + row] = bounds[row + 1] - bounds[row]
+
+    def rows(self):
+        return np.arange(self.scores.shape[0])
+
+    def first(self, row):
+        return self.firsts.pop(row, ([], []))
+
+    def more(self, row):
+        """ All remaining entries, which score lower than the first ones """
+        if self.n_taken[row] >= self.scores.shape[1]:
+            return [], []
+        values = self.scores[row]
+        order = _order_by_score(np.arange(len(values)), values)
+        order = order[self.n_taken[row]:]
+        self.n_taken[row] = len(values)
+        return order.tolist(), values[order].tolist()
+
+
+def greedy_matching(scores, max_matches=None, seen_rows=(), seen_cols=(),
+                    n_best=10):
+    """ Repeatedly takes the best scoring pair whose row and column are both
+        unused, i.e. the same as walking all pairs sorted by score, but
+        without sorting the whole matrix. Ties go to the larger row, then
+        larger column. Returns a list of (row, col) in the order found. """
+    if isinstance(scores, TopKScores):
+        candidates = _SparseRows(scores)
+    else:
+        candidates = _DenseRows(scores, n_best)
+    if max_matches is None:
+        max_matches = min(scores.shape)
+    used_rows = np.zeros(scores.shape[0], dtype=bool)
+    used_rows[list(seen_rows)] = True
+    used_cols = np.zeros(scores.shape[1], dtype=bool)
+    used_cols[list(seen_cols)] = True
+    used_cols = used_cols.tolist()
+
+    # one entry per row: its best column that was unused when pushed
+    heap, row_lists = [], {}
+    for row in candidates.rows()[~used_rows[candidates.rows()]].tolist():
+        cols, values = candidates.first(row)
+        if cols:
+            row_lists[row] = [cols, values, 0]
+            heap.append((-values[0], -row, -cols[0]))
+    heapq.heapify(heap)
+
+    matches = []
+    while heap and len(matches) < max_matches:
+        neg_value, neg_row, neg_col = heapq.heappop(heap)
+        row, col = -neg_row, -neg_col
+        if not used_cols[col]:
+            matches.append((row, col))
+            used_cols[col] = True
+            del row_lists[row]
+            continue
+        # column got taken, move on to the next unused one of this row
+        cols, values, pos = row_lists[row]
+        while True:
+            pos += 1
+            if pos == len(cols):
+                cols, values = candidates.more(row)
+                pos = 0
+                if not cols:
+                    break
+            if not used_cols[cols[pos]]:
+                break
+        if not cols:
+            del row_lists[row]
+            continue
+        row_lists[row] = [cols, values, pos]
+        heapq.heappush(heap, (-values[pos], -row, -cols[pos]))
+    return matches
+
+
+def _segments(indptr, rows):
+    """ Positions of all entries of the given CSR rows, and row lengths """
+    lengths = indptr[rows + 1] - indptr[rows]
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + \
+        np.repeat(indptr[rows] - offsets, lengths)
+    return positions, lengths, offsets
+
+
+def _shifted_candidates(scores, eps):
+    """ Candidate pairs with scores relative to what staying unmatched is
+        worth: non-candidates (fill_value) for TopKScores, zero padding for
+        dense matrices. Scores like -distance are shifted so that every
+        candidate stays worth matching, as with the padded dense assignment.
+        Returns rows, cols, data. """
+    if isinstance(scores, TopKScores):
+        rows, cols, data = scores.row, scores.col, scores.data
+        base = scores.fill_value
+        if len(data):
+            base = min(base, data.min())
+    else:
+        base = scores.min() if scores.size else 0.
+        if base >= 0:
+            rows, cols = np.nonzero(scores > 0)
+        else:
+            rows, cols = np.divmod(np.arange(scores.size), scores.shape[1])
+        data = scores[rows, cols]
+    data = data.astype(np.float64)
+    if base < 0:
+        data = data - base + eps
+    return rows, cols, data
+
+
+def _release_violating(prices, owner, assigned, own_value, best_value, eps):
+    """ Unassigns rows whose column is no longer within eps of their best
+        option (staying unmatched is worth 0) """
+    rows = np.flatnonzero(assigned >= 0)
+    own = own_value[rows] - prices[assigned[rows]]
+    release = rows[own < best_value(rows) - eps]
+    owner[assigned[release]] = -1
+    assigned[release] = -1
+
+
+def _auction_rounds(data, cols, indptr, prices, owner, assigned, own_value,
+                    bidders, eps, max_rounds):
+    """ Jacobi bidding until every row is assigned or prefers to stay
+        unmatched. Returns the number of rounds. """
+    n_rounds = 0
+    while len(bidders):
+        n_rounds += 1
+        if max_rounds is not None and n_rounds > max_rounds:
+            raise RuntimeError("auction did not converge")
+        positions, lengths, offsets = _segments(indptr, bidders)
+        values = data[positions] - prices[cols[positions]]
+        segment = np.repeat(np.arange(len(bidders)), lengths)
+        best = np.maximum.reduceat(values, offsets)
+        best_pos = np.flatnonzero(values == best[segment])
+        _, first = np.unique(segment[best_pos], return_index=True)
+        best_pos = best_pos[first]
+        values[best_pos] = -np.inf
+        # staying unmatched is worth 0, this also covers single candidates
+        second = np.maximum(np.maximum.reduceat(values, offsets), 0)
+
+        # rows that prefer to stay unmatched don't bid again in this
+        # phase: prices only go up
+        active = best > 0
+        bidders = bidders[active]
+        bid_pos = positions[best_pos[active]]
+        bid_cols = cols[bid_pos]
+        bids = prices[bid_cols] + best[active] - second[active] + eps
+
+        # highest bid wins every column
+        order = np.lexsort((-bids, bid_cols))
+        _, first = np.unique(bid_cols[order], return_index=True)
+        winners = order[first]
+        win_cols = bid_cols[winners]
+        losers = np.ones(len(bidders), dtype=bool)
+        losers[winners] = False
+        outbid = owner[win_cols]
+        outbid = outbid[outbid >= 0]
+        assigned[outbid] = -1
+
+        owner[win_cols] = bidders[winners]
+        assigned[bidders[winners]] = win_cols
+        own_value[bidders[winners]] = data[bid_pos[winners]]
+        prices[win_cols] = bids[winners]
+        bidders = np.concatenate((bidders[losers], outbid))
+    return n_rounds
+
+
+def _reverse_auction(col_rows, col_data, col_indptr, prices, owner, assigned,
+                     own_value, eps):
+    """ Lowers the prices of unassigned columns left over from earlier
+        phases. Such a column either goes back to price 0 or takes the row
+        that profits most from it (reverse auction), which can leave
+        another column unassigned. Keeps eps-complementary slackness. """
+    pending = np.flatnonzero((owner < 0) & (prices > 0)).tolist()
+    while pending:
+        col = pending.pop()
+        start, end = col_indptr[col], col_indptr[col + 1]
+        rows = col_rows[start:end]
+        profits = np.where(assigned[rows] >= 0,
+                           own_value[rows] - prices[assigned[rows]], 0)
+        gains = col_data[start:end] - profits
+        best = np.argmax(gains)
+        if gains[best] <= eps:
+            prices[col] = 0
+            continue
+        gains[best] = -np.inf
+        second = gains.max() if len(gains) > 1 else 0
+        row = rows[best]
+        old_col = assigned[row]
+        if old_col >= 0:
+            owner[old_col] = -1
+            if prices[old_col] > 0:
+                pending.append(old_col)
+        prices[col] = max(0, second - eps)
+        owner[col] = row
+        assigned[row] = col
+        own_value[row] = col_data[start + best]
+
+
+def auction_matching(scores, eps=1e-4, max_rounds=None, eps_factor=5.):
+    """ Maximum weight matching with the auction algorithm. Unmatched rows
+        and pairs that are not candidates count as zero, so rectangular
+        (and sparse) problems need no padding. Negative scores are shifted
+        up first (see _shifted_candidates). All unassigned rows bid at
+        once (Jacobi auction).
+
+        With a fixed small eps, ties (e.g. duplicate pages) take about
+        score / eps rounds. So eps starts at half the largest score and is
+        divided by eps_factor per phase (eps-scaling); prices are kept and
+        rows no longer within the new eps of their best option rebid.
+        After the last phase, with eps, unassigned columns that still have
+        a price get a reverse auction; the result is within
+        n_source * eps of the optimum. More than max_rounds bidding rounds
+        in a phase raise a RuntimeError. Returns a list of (row, col). """
+    n_source, n_target = scores.shape
+    rows, cols, data = _shifted_candidates(scores, eps)
+    positive = data > 0
+    rows, cols = rows[positive], cols[positive]
+    data = data[positive]
+    by_col = np.lexsort((rows, cols))
+    col_rows, col_data = rows[by_col], data[by_col]
+    col_indptr = np.concatenate(
+        ([0], np.cumsum(np.bincount(cols, minlength=n_target))))
+    order = np.lexsort((cols, rows))
+    cols, data = cols[order], data[order]
+    indptr = np.concatenate(
+        ([0], np.cumsum(np.bincount(rows, minlength=n_source))))
+    has_candidates = np.diff(indptr) > 0
+
+    prices = np.zeros(n_target)
+    owner = np.empty(n_target, dtype=np.int64)
+    owner.fill(-1)
+    assigned = np.empty(n_source, dtype=np.int64)
+    assigned.fill(-1)
+    own_value = np.zeros(n_source)
+
+    def best_value(rows):
+        """ Value of the best option of each row at current prices """
+        if not len(rows):
+            return np.zeros(0)
+        positions, lengths, offsets = _segments(indptr, rows)
+        values = data[positions] - prices[cols[positions]]
+        return np.maximum(np.maximum.reduceat(values, offsets), 0)
+
+    phase_eps = max(data.max() / 2, eps) if len(data) else eps
+    while True:
+        _release_violating(prices, owner, assigned, own_value, best_value,
+                           phase_eps)
+        bidders = np.flatnonzero((assigned < 0) & has_candidates)
+        _auction_rounds(data, cols, indptr, prices, owner, assigned,
+                        own_value, bidders, phase_eps, max_rounds)
+        _reverse_auction(col_rows, col_data, col_indptr, prices, owner,
+                         assigned, own_value, phase_eps)
+        if phase_eps == eps:
+            break
+        phase_eps = max(phase_eps / eps_factor, eps)
+
+    matched = np.flatnonzero(assigned >= 0)
+    return zip(matched.tolist(), assigned[matched].tolist())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Candidate pruning ahead of pairwise scoring: only (source, target) pairs
+# that share at least one rare key (n-gram, dictionary translation or
+# outgoing link) are passed on to the expensive scorers.
+import gzip
+import numpy as np
+import sys
+import time
+from collections import defaultdict
+
+from scorer import WordExtractor, LinkExtractor, DictionaryScorer
+
+sys.path.append("/home/buck/net/build/DataCollection/baseline")
+from strip_language_from_uri import LanguageStripper
+
+
+class InvertedIndex(object):
+
+    def __init__(self, name, max_df):
+        self.name = name
+        self.max_df = max_df
+        self.source_postings = defaultdict(list)
+        self.target_postings = defaultdict(list)
+
+    def add_source(self, idx, keys):
+        for key in set(keys):
+            self.source_postings[key].append(idx)
+
+    def add_target(self, idx, keys):
+        for key in set(keys):
+            self.target_postings[key].append(idx)
+
+    def pairs(self, n_target):
+        """ Returns encoded pairs s_idx * n_target + t_idx for all pairs
+            sharing a key that occurs in at most max_df documents """
+        pairs = []
+        n_rare = 0
+        for key, sources in self.source_postings.iteritems():
+            targets = self.target_postings.get(key)
+            if targets is None:
+                continue
+            if len(sources) + len(targets) > self.max_df:
+                continue
+            n_rare += 1
+            sources = np.array(sources, dtype=np.int64) * n_target
+            targets = np.array(targets, dtype=np.int64)
+            pairs.append((sources[:, np.newaxis] + targets).ravel())
+        sys.stderr.write("%s: %d shared rare keys out of %d/%d\n"
+                         % (self.name, n_rare, len(self.source_postings),
+                            len(self.target_postings)))
+        if not pairs:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(pairs))
+
+
+def ngram_keys(n):
+    extractor = WordExtractor(n=n)
+    return extractor.extract_single, extractor.extract_single
+
+
+def dictionary_keys(dictfile, slang, tlang):
+    """ Source words vs. dictionary translations of target words """
+    dictionary_scorer = DictionaryScorer(None, None, dictfile, slang, tlang)
+
+    def source_keys(page):
+        return dictionary_scorer._words_from_text(
+            page.text, dictionary_scorer.source_tokenizer)
+
+    def target_keys(page):
+        words = dictionary_scorer._words_from_text(
+            page.text, dictionary_scorer.target_tokenizer)
+        n_translated, translation = dictionary_scorer._translate_bow(words)
+        return translation
+
+    return source_keys, target_keys
+
+
+def link_keys(xpath):
+    """ Outgoing links, with language identifiers removed """
+    extractor = LinkExtractor(xpath)
+    stripper = LanguageStripper()
+
+    def keys(page):
+        return [stripper.strip(link)
+                for link in extractor.extract_single(page)]
+    return keys, keys
+
+
+def find_candidates(source_corpus, target_corpus, key_functions, max_df):
+    """ key_functions maps a name to (source_keys, target_keys) functions.
+        Returns sorted arrays of source and target indices. """
+    n_target = len(target_corpus)
+    pairs = []
+    for name, (source_keys, target_keys) in key_functions.iteritems():
+        start = time.time()
+        index = InvertedIndex(name, max_df)
+        for s_idx, page in enumerate(source_corpus):
+            index.add_source(s_idx, source_keys(page))
+        for t_idx, page in enumerate(target_corpus):
+            index.add_target(t_idx, target_keys(page))
+        pairs.append(index.pairs(n_target))
+        sys.stderr.write("%s: %d candidate pairs in %.0fs\n"
+                         % (name, len(pairs[-1]), time.time() - start))
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // n_target, pairs % n_target
+
+
+def write_candidates(fh, shape, rows, cols):
+    np.savez(fh, shape=np.array(shape), rows=rows, cols=cols)
+
+
+def read_candidates(fh):
+    if fh.name.endswith('.gz'):
+        fh = gzip.GzipFile(fileobj=fh, mode='r')
+    candidates = np.load(fh)
+    return tuple(candidates['shape']), candidates['rows'], candidates['cols']
+
+
+if __name__ == "__main__":
+    import argparse
+    from extract_features import load_corpus, sort_corpus
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus',
+                        help='pickled source and target corpus',
+                        type=argparse.FileType('r'))
+    parser.add_argument('-outfile', help='output file for candidate pairs',
+                        type=argparse.FileType('wb'), required=True)
+    parser.add_argument('-read_urlmapping',
+                        help="infile for url <-> index mapping",
+                        type=argparse.FileType('r'),
+                        required=True)
+    parser.add_argument('-keys', nargs='+',
+                        choices=['ngrams', 'dict', 'links'],
+                        default=['ngrams', 'links'])
+    parser.add_argument('-ngram_size', help="length of ngram keys",
+                        default=2, type=int)
+    parser.add_argument('-max_df', type=int, default=10,
+                        help='ignore keys found in more documents')
+    parser.add_argument('-dictfile', help='dictionary file for dict keys')
+    parser.add_argument('-xpath', help="xpath for link keys",
+                        default="//a/@href")
+    parser.add_argument('-slang', help='source language', default='en')
+    parser.add_argument('-tlang', help='target language', default='fr')
+    args = parser.parse_args()
+
+    s, t = load_corpus(args.corpus)
+    s, t = sort_corpus(s, t, args.read_urlmapping)
+
+    key_functions = {}
+    if 'ngrams' in args.keys:
+        key_functions['ngrams'] = ngram_keys(args.ngram_size)
+    if 'dict' in args.keys:
+        assert args.dictfile is not None, "Need dictfile for dict keys"
+        key_functions['dict'] = dictionary_keys(args.dictfile,
+                                                args.slang, args.tlang)
+    if 'links' in args.keys:
+        key_functions['links'] = link_keys(args.xpath)
+
+    rows, cols = find_candidates(s, t, key_functions, args.max_df)
+    sys.stderr.write("Kept %d of %d pairs (%.2f%%)\n"
+                     % (len(rows), len(s) * len(t),
+                        100. * len(rows) / max(1, len(s) * len(t))))
+    write_candidates(args.outfile, (len(s), len(t)), rows, cols)
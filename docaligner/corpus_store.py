@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import codecs
+import gzip
+import json
+import mmap
+import numpy as np
+import struct
+import sys
+import cPickle as pickle
+
+from page import Page
+
+# Columnar on-disk format for source and target corpus. For every field
+# there is one contiguous UTF-8 buffer followed by n+1 uint64 offsets into it.
+# A JSON footer holds the positions of all columns; its length is stored in
+# the last 8 bytes of the file:
+#
+#   MAGIC | col data | col offsets | ... | JSON footer | footer length
+#
+# The file is memory-mapped when reading, so a feature that only looks at
+# page.text never touches the html column.
+
+MAGIC = "DACORPUS0001"
+
+# Page fields in constructor order, True if stored as unicode
+FIELDS = [('url', False), ('html', False), ('text', True),
+          ('mime_type', False), ('encoding', False),
+          ('french', True), ('english', True), ('english_mt', True)]
+UNICODE_FIELDS = set(name for name, is_unicode in FIELDS if is_unicode)
+
+
+def is_corpus_store(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value or ''
+
+
+def _write_column(fh, values):
+    """ Writes data and offsets of a column, returns their positions """
+    data_pos = fh.tell()
+    offsets = [0]
+    for value in values:
+        value = _encode(value)
+        fh.write(value)
+        offsets.append(offsets[-1] + len(value))
+    fh.write('\0' * (-fh.tell() % 8))  # align offsets
+    offsets_pos = fh.tell()
+    fh.write(np.array(offsets, dtype='<u8').tostring())
+    return data_pos, offsets_pos
+
+
+def write_store(fh, corpora):
+    """ corpora maps a name (e.g. 'source') to a dict url -> Page """
+    fh.write(MAGIC)
+    footer = {}
+    for name, corpus in corpora.iteritems():
+        urls = list(corpus.iterkeys())
+        for url in urls:
+            assert corpus[url].url == url, "key differs from page url"
+        columns = {}
+        for field, is_unicode in FIELDS:
+            columns[field] = _write_column(
+                fh, (getattr(corpus[url], field) for url in urls))
+        footer[name] = {'n': len(urls), 'columns': columns}
+    footer = json.dumps(footer)
+    fh.write(footer)
+    fh.write(struct.pack('<Q', len(footer)))
+
+
+class CorpusStore(object):
+
+    """ Read-only, memory-mapped access to a corpus written by write_store """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mm[:len(MAGIC)] == MAGIC, \
+            "%s is not a corpus store" % filename
+        footer_len = struct.unpack('<Q', self._mm[-8:])[0]
+        self.footer = json.loads(self._mm[-8 - footer_len:-8])
+
+    def corpus(self, name):
+        return StoredCorpus(self, name)
+
+
+class StoredCorpus(object):
+
+    """ Behaves like the dict url -> Page that lett.py used to pickle,
+        keeping insertion order. Pages are read lazily, field by field. """
+
+    def __init__(self, store, name):
+        self._mm = store._mm
+        self.n = store.footer[name]['n']
+        self._columns = {}
+        for field, (data_pos, offsets_pos) in \
+                store.footer[name]['columns'].iteritems():
+            offsets = np.frombuffer(self._mm, dtype='<u8',
+                                    count=self.n + 1, offset=offsets_pos)
+            self._columns[field] = (data_pos, offsets)
+        self._url2idx = None
+        self._pages = [None] * self.n
+
+    def raw(self, field, idx):
+        """ Zero-copy view of the UTF-8 bytes of a field """
+        data_pos, offsets = self._columns[field]
+        start, end = offsets[idx], offsets[idx + 1]
+        return buffer(self._mm, data_pos + int(start), int(end - start))
+
+    def field(self, field, idx):
+        if field in UNICODE_FIELDS:
+            return codecs.utf_8_decode(self.raw(field, idx))[0]
+        data_pos, offsets = self._columns[field]
+        return self._mm[data_pos + int(offsets[idx]):
+                        data_pos + int(offsets[idx + 1])]
+
+    def page(self, idx):
+        # keep page objects so assigned fields survive, they hold no data
+        if self._pages[idx] is None:
+            self._pages[idx] = StoredPage(self, idx)
+        return self._pages[idx]
+
+    def url_to_index(self):
+        if self._url2idx is None:
+            self._url2idx = dict((self.field('url', idx), idx)
+                                 for idx in xrange(self.n))
+        return self._url2idx
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, url):
+        return url in self.url_to_index()
+
+    def __getitem__(self, url):
+        return self.page(self.url_to_index()[url])
+
+    def iterkeys(self):
+        for idx in xrange(self.n):
+            yield self.field('url', idx)
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def itervalues(self):
+        for idx in xrange(self.n):
+            yield self.page(idx)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for idx in xrange(self.n):
+            page = self.page(idx)
+            yield page.url, page
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class StoredPage(Page):
+
+    """ Page whose fields are read from the store on access. Assigned
+        fields are kept in memory and shadow the stored ones. """
+
+    def __init__(self, corpus, idx):
+        self._corpus = corpus
+        self._idx = idx
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._corpus.field(name, self._idx)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        # materialize when sent to worker processes
+        return (Page, tuple(getattr(self, field) for field, _ in FIELDS))
+
+
+def load_store(filename):
+    store = CorpusStore(filename)
+    return store.corpus('source'), store.corpus('target')
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='convert pickled corpus (lett.py -write) to corpus store')
+    parser.add_argument('corpus',
+                        help='pickled source and target corpus',
+                        type=argparse.FileType('rb'))
+    parser.add_argument('outfile', help='output corpus store',
+                        type=argparse.FileType('wb'))
+    args = parser.parse_args()
+
+    fh = args.corpus
+    if fh.name.endswith('.gz'):
+        fh = gzip.GzipFile(fileobj=fh, mode='r')
+    s = pickle.load(fh)
+    t = pickle.load(fh)
+    sys.stderr.write("Writing %d source and %d target docs to %s\n"
+                     % (len(s), len(t), args.outfile.name))
+    write_store(args.outfile, {'source': s, 'target': t})
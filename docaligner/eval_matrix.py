@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from datetime import datetime
-import dlib
-import gzip
 import json
 import numpy as np
 import sys
+from topk import TopKScores, load_scores
+from bipartite import greedy_matching, auction_matching
 
 
 def read_devset(fh, mapping):
@@ -43,6 +43,14 @@ if __name__ == "__main__":
     parser.add_argument('-matching',
                         help='compute max-cost matching',
                         action='store_true')
+    parser.add_argument('-auction',
+                        help='use auction algorithm for -matching, always '
+                        'used for top-k scores',
+                        action='store_true')
+    parser.add_argument('-auction_eps',
+                        help='final bid increment, matching is within '
+                        'n_source * eps of optimum',
+                        type=float, default=1e-4)
     parser.add_argument('-prefix',
                         help='output prefix (domain name)',
                         default="PREFIX")
@@ -53,10 +61,13 @@ if __name__ == "__main__":
     devset = read_devset(args.devset, url_mapping)
     print "Loaded %d expected pairs from %s" % (len(devset), args.devset.name)
 
-    fh = args.matrix
-    if fh.name.endswith('.gz'):
-        fh = gzip.GzipFile(fileobj=fh, mode='r')
-    score_matrix = np.load(fh).astype(np.float32, copy=False)
+    score_matrix = load_scores(args.matrix)
+    sparse_scores = None
+    if isinstance(score_matrix, TopKScores):
+        sparse_scores = score_matrix
+        print "Read %d candidate pairs" % (len(sparse_scores.data))
+    else:
+        score_matrix = score_matrix.astype(np.float32, copy=False)
 
     n_source, n_target = score_matrix.shape
     n_samples = n_source * n_target
@@ -65,7 +76,18 @@ if __name__ == "__main__":
         % (n_source, n_target)
 
     print datetime.now()
-    if args.matching:
+    if args.matching and (args.auction or sparse_scores is not None):
+        print "Finding best matching (auction)"
+        matching_pairs = set(auction_matching(score_matrix,
+                                              eps=args.auction_eps))
+
+        print "Found %d matches " % (len(matching_pairs))
+        found = devset.intersection(matching_pairs)
+        print "Found %d out of %d pairs = %f%%" \
+            % (len(found), len(devset), 100. * len(found) / len(devset))
+        print "RES:\t%s\t%s\t%d\t%d" % (args.prefix, args.matrix.name,
+                                        len(found), len(devset))
+    elif args.matching:
         print "Finding best matching"
         matching_pairs = set()
 
@@ -75,6 +97,7 @@ if __name__ == "__main__":
              (0, max(score_matrix.shape) - score_matrix.shape[1])),
             mode='constant')
 
+        import dlib
         cost = dlib.matrix(full_matrix)
         print "Searching with dlib"
         assignment = dlib.max_cost_assignment(cost)
@@ -91,18 +114,9 @@ if __name__ == "__main__":
         print "RES:\t%s\t%s\t%d\t%d" % (args.prefix, args.matrix.name,
                                         len(found), len(devset))
     else:
-        print "Finding best match (greedy / restricted + argsort)"
-        matches = set()
-        seen_cols = set()
-        seen_rows = set()
-        sorted_indices = np.argsort(score_matrix, axis=None)
-        for idx in sorted_indices[::-1]:
-            am_row, am_col = np.unravel_index(idx, score_matrix.shape)
-            if am_row in seen_rows or am_col in seen_cols:
-                continue
-            matches.add((am_row, am_col))
-            seen_cols.add(am_col)
-            seen_rows.add(am_row)
+        print "Finding best match (greedy / restricted)"
+        # only candidate pairs can be matched for top-k scores
+        matches = set(greedy_matching(score_matrix))
 
         print "Found %d matches " % (len(matches))
         found = devset.intersection(matches)
@@ -171,6 +185,7 @@ if __name__ == "__main__":
     # print full_matrix.shape, np.sum(full_matrix)
     # print score_matrix.shape, np.sum(score_matrix)
 
+    import dlib
     cost = dlib.matrix(full_matrix)
     print "Searching with dlib"
     assignment = dlib.max_cost_assignment(cost)
@@ -3,13 +3,14 @@
 from datetime import datetime
 from scipy.stats import pearsonr, spearmanr
 from sklearn.linear_model import LogisticRegression, LogisticRegressionCV
-import gzip
 import json
 import numpy as np
 import pickle
 import sys
 from sklearn import preprocessing
 from collections import defaultdict
+from topk import TopKScores, candidates, densify, load_scores, save_scores
+from bipartite import greedy_matching, auction_matching
 
 # sys.path.append("/home/buck/net/build/DataCollection/baseline")
 # from strip_language_from_uri import LanguageStripper
@@ -165,6 +166,14 @@ if __name__ == "__main__":
     parser.add_argument('-matching',
                         help='compute max-cost matching',
                         action='store_true')
+    parser.add_argument('-auction',
+                        help='use auction algorithm for -matching, always '
+                        'used for top-k scores',
+                        action='store_true')
+    parser.add_argument('-auction_eps',
+                        help='final bid increment, matching is within '
+                        'n_source * eps of optimum',
+                        type=float, default=1e-4)
     parser.add_argument('-prefix',
                         help='output prefix (domain name)',
                         default="PREFIX")
@@ -225,24 +234,38 @@ if __name__ == "__main__":
         n_samples, n_source, n_target = None, None, None
         m = None
 
-        for f_idx, f_file in enumerate(args.feature_matrix):
+        features = []
+        for f_file in args.feature_matrix:
             print "Loading features from ", f_file.name
-            fh = f_file
-            if f_file.name.endswith('.gz'):
-                fh = gzip.GzipFile(fileobj=fh, mode='r')
-            f = np.load(fh)
-            if args.scale:
-                print "scaling"
-                f = preprocessing.scale(f)
-            # f = f.astype(np.float32, copy=False)
-
-            if m is None:
-                n_samples = f.size
-                n_source, n_target = f.shape
-                m = np.zeros((n_samples, n_features), dtype=np.float64)
-            else:
-                assert f.shape == (n_source, n_target)
-            m[:, f_idx] = f.flatten()
+            features.append(load_scores(f_file))
+
+        # top-k features are only scored on the union of their candidates
+        candidate_rows, candidate_cols = None, None
+        if all(isinstance(f, TopKScores) for f in features):
+            assert not args.scale, "can't scale top-k features"
+            n_source, n_target = features[0].shape
+            candidate_rows, candidate_cols, m = candidates(features)
+            n_samples = m.shape[0]
+            del features
+            print "%d candidate pairs out of %d" \
+                % (n_samples, n_source * n_target)
+
+        else:
+            for f_idx in range(n_features):
+                f = densify(features[f_idx])
+                features[f_idx] = None
+                if args.scale:
+                    print "scaling"
+                    f = preprocessing.scale(f)
+                # f = f.astype(np.float32, copy=False)
+
+                if m is None:
+                    n_samples = f.size
+                    n_source, n_target = f.shape
+                    m = np.zeros((n_samples, n_features), dtype=np.float64)
+                else:
+                    assert f.shape == (n_source, n_target)
+                m[:, f_idx] = f.flatten()
 
         print datetime.now()
 
@@ -267,25 +290,45 @@ if __name__ == "__main__":
         del m
 
         print predicted
-        score_matrix = predicted.reshape((n_source, n_target))
+        if candidate_rows is not None:
+            score_matrix = TopKScores((n_source, n_target),
+                                      candidate_rows, candidate_cols,
+                                      predicted, 0.)
+        else:
+            score_matrix = predicted.reshape((n_source, n_target))
 
         if args.write_predictions:
-            np.save(args.write_predictions, score_matrix)
+            save_scores(args.write_predictions, score_matrix)
             # evaluate later
             sys.exit()
 
     else:
         assert args.load_predictions
-        fh = args.load_predictions
-        if fh.name.endswith('.gz'):
-            fh = gzip.GzipFile(fileobj=fh, mode='r')
-        score_matrix = np.load(fh)
+        score_matrix = load_scores(args.load_predictions)
         print "Loaded matrix of shape", score_matrix.shape, \
               " from ", args.load_predictions.name
 
+    # matching works on candidates only, csr matrix is for cost lookup
+    sparse_scores = None
+    if isinstance(score_matrix, TopKScores):
+        sparse_scores = score_matrix
+        from scipy.sparse import csr_matrix
+        score_matrix = csr_matrix(
+            (sparse_scores.data, (sparse_scores.row, sparse_scores.col)),
+            shape=sparse_scores.shape)
+
     print datetime.now()
     matches = []
-    if args.matching:
+    if args.matching and (args.auction or sparse_scores is not None):
+        print "Finding best matching (auction)"
+        matches = auction_matching(
+            score_matrix if sparse_scores is None else sparse_scores,
+            eps=args.auction_eps)
+        matches = sorted(((score_matrix[sidx, tidx], sidx, tidx)
+                          for sidx, tidx in matches), reverse=True)
+        matches = [(sidx, tidx) for score, sidx, tidx in matches]
+
+    elif args.matching:
         print "Finding best matching"
 
         full_matrix = np.pad(
@@ -312,7 +355,7 @@ if __name__ == "__main__":
         matches = [(sidx, tidx) for score, sidx, tidx in matches]
 
     else:
-        print "Finding best match (greedy / restricted + argsort)"
+        print "Finding best match (greedy / restricted)"
         seen_cols = set()
         seen_rows = set()
 
@@ -324,22 +367,11 @@ if __name__ == "__main__":
                 seen_cols.add(tidx)
                 seen_rows.add(sidx)
 
-        n_cols = score_matrix.shape[1]
         max_matches = min(score_matrix.shape)
-        sorted_indices = np.argsort(score_matrix, axis=None, kind='mergesort')
-        for idx in sorted_indices[::-1]:
-            am_row = idx / n_cols
-            if am_row in seen_rows:
-                continue
-            am_col = idx - am_row * n_cols
-            # am_row, am_col = np.unravel_index(idx, score_matrix.shape)
-            if am_col in seen_cols:
-                continue
-            matches.append((am_row, am_col))
-            seen_cols.add(am_col)
-            seen_rows.add(am_row)
-            if len(matches) >= max_matches:
-                break
+        matches.extend(greedy_matching(
+            score_matrix if sparse_scores is None else sparse_scores,
+            max_matches=max(0, max_matches - len(matches)),
+            seen_rows=seen_rows, seen_cols=seen_cols))
 
     match_costs = [score_matrix[r, c] for r, c in matches]
     # matches = set(matches)
@@ -10,6 +10,7 @@ import gzip
 from scorer import DistanceScorer, GaleChurchScorer
 from scorer import WordExtractor, LinkExtractor, StructureExtractor
 from scorer import EnglishWordExtractor, RawTokenExtractor
+from scorer import SharedExtractor, words_from_text, english_words, raw_tokens
 from scorer import SimhashDistance
 from scorer import GaleChurchAlignmentDistance
 from scorer import DictionaryScorer
@@ -18,6 +19,9 @@ from scorer import LinkageScorer
 from ratio import ratio, jaccard, weighted_jaccard
 from ratio import levenshtein_min, levenshtein_max, levenshtein_avg
 from page import Page
+from topk import TopKScores, topk, save_scores
+from blocking import read_candidates
+from corpus_store import is_corpus_store, load_store
 
 from ratio import cosine
 import multiprocessing
@@ -126,6 +130,16 @@ def write_url2dim(source_corpus, target_corpus, fh, file2url):
     json.dump(mapping, fh)
 
 
+def load_corpus(corpus_fh):
+    if is_corpus_store(corpus_fh.name):
+        return load_store(corpus_fh.name)
+    if corpus_fh.name.endswith('.gz'):
+        corpus_fh = gzip.GzipFile(fileobj=corpus_fh, mode='r')
+    s = pickle.load(corpus_fh)
+    t = pickle.load(corpus_fh)
+    return s, t
+
+
 def sort_corpus(s, t, mapping_fh):
     mapping = json.load(mapping_fh)
     sorted_source = [None for u in s]
@@ -141,11 +155,117 @@ def sort_corpus(s, t, mapping_fh):
     return sorted_source, sorted_target
 
 
+def score_feature(scorer, s, t, pool, args, candidates=None):
+    start = time.time()
+    if candidates is not None:
+        rows, cols = candidates
+        sys.stderr.write("Scoring %d candidate pairs\n" % (len(rows)))
+        if isinstance(scorer, DistanceScorer):
+            m = scorer.score(s, t, pool=pool, weighting=args.weighting,
+                             candidates=candidates)
+        else:
+            m = scorer.score(s, t, pool=pool, weighting=args.weighting)
+            m = TopKScores(m.shape, rows, cols, m[rows, cols], m.min())
+    elif args.topk and isinstance(scorer, DistanceScorer):
+        m = scorer.score(s, t, pool=pool, weighting=args.weighting,
+                         topk=args.topk)
+    else:
+        m = scorer.score(s, t, pool=pool, weighting=args.weighting)
+        if args.topk:
+            m = topk(m, args.topk)
+    print "Scoring took %.0f seconds" % (time.time() - start)
+
+    # fix nans.
+    values = m.data if isinstance(m, TopKScores) else m
+    if np.sum(np.isnan(values)) > 0:
+        sys.stderr.write(
+            "found %d nans in matrix of shape %s\n"
+            % (np.sum(np.isnan(values)), m.shape))
+        values[np.isnan(values)] = 0
+
+    # if np.std(m) > 0:
+    #     m = (m - np.mean(m)) / np.std(m)
+    return m
+
+
+def write_scores(m, outfile):
+    sys.stderr.write("Writing to %s\n" % (outfile.name))
+    if isinstance(m, TopKScores):
+        sys.stderr.write("Keeping %d of %d pairs\n"
+                         % (len(m.data), m.shape[0] * m.shape[1]))
+        save_scores(outfile, m)
+    elif outfile.name.endswith("npy"):
+        np.save(outfile, m)
+    else:
+        np.savetxt(outfile, m)
+
+
+def parse_feature_spec(spec):
+    """ name:Feature[,param=value]* e.g. bow_n2:NGramJaccard,ngram_size=2 """
+    name, feature = spec.split(':', 1)
+    params = feature.split(',')
+    feature = params.pop(0)
+    params = dict(p.split('=', 1) for p in params)
+    for param in params:
+        assert param in ('ngram_size', 'xpath'), "unknown parameter " + param
+    if 'ngram_size' in params:
+        params['ngram_size'] = int(params['ngram_size'])
+    return name, feature, params
+
+
+def shared_scorers(specs, shared_extractor, ratio_function, args):
+    """ Scorers for several features reading from one SharedExtractor """
+    scorers = []
+    for name, feature, params in specs:
+        n = params.get('ngram_size', args.ngram_size)
+        xpath = params.get('xpath', args.xpath)
+        if feature == 'LinkDistance':
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_links(xpath),
+                ratio_function=ratio_function)
+        elif feature == 'LinkJaccard':
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_links(xpath),
+                ratio_function=jaccard, set_based=True)
+        elif feature == 'TextDistance':
+            assert n == 1, "use NGramJaccard instead\n"
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_ngrams(n),
+                ratio_function=ratio_function)
+        elif feature == 'NGramJaccard':
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_ngrams(n),
+                ratio_function=jaccard, set_based=True)
+        elif feature == 'WeightedNGramJaccard':
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_ngrams(n),
+                ratio_function=weighted_jaccard, count_based=True)
+        elif feature == 'Cosine':
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_ngrams(n),
+                ratio_function=cosine, count_based=True)
+        elif feature == 'Structure':
+            scorer = DistanceScorer(
+                extraction_mapper=shared_extractor.add_structure(
+                    length_function=lambda x: len(x.split()),
+                    growth_function=lambda x: 1 + math.log(x)),
+                ratio_function=ratio_function)
+        elif feature == 'Simhash':
+            # fingerprints are computed by the scorer, nothing to share
+            scorer = SimhashDistance(n=n, max_distance=args.max_hamming)
+        else:
+            # DictionaryScorer does not work with DistanceScorer.score yet
+            raise ValueError("%s not supported with -features" % feature)
+        scorers.append((name, scorer))
+    return scorers
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('corpus',
-                        help='pickled source and target corpus',
+                        help='pickled source and target corpus or corpus '
+                        'store (see corpus_store.py)',
                         type=argparse.FileType('r'))
     parser.add_argument(
         '-outfile', help='output file', type=argparse.FileType('w'),
@@ -155,7 +275,8 @@ if __name__ == "__main__":
                                  'TextDistance', 'NGramJaccard',
                                  'Structure', 'GaleChurch', 'TranslatedBOW',
                                  'NGramCounts', 'Linkage', 'Cosine',
-                                 'WeightedNGramJaccard', 'CosineSimilarity'])
+                                 'WeightedNGramJaccard', 'CosineSimilarity',
+                                 'Multiple'])
     parser.add_argument('-mt', action='store_true',
                         help='Use MT instead of French text')
     parser.add_argument('-mtonly', action='store_true',
@@ -167,6 +288,9 @@ if __name__ == "__main__":
                         type=argparse.FileType('w'))
     parser.add_argument('-ngram_size', help="length of ngram from Simhash",
                         default=1, type=int)
+    parser.add_argument('-max_hamming', type=int,
+                        help='Simhash: only keep pairs within this Hamming '
+                        'distance (sparse .npz output)')
     parser.add_argument('-xpath', help="xpath for LinkDistance",
                         default="//a/@href")
     parser.add_argument('-urlmapping',
@@ -202,10 +326,27 @@ if __name__ == "__main__":
         default='http://localhost:8080')
     parser.add_argument('-threads', type=int,
                         help='number of threads for scoring', default=1)
+    parser.add_argument('-topk', type=int,
+                        help='only keep K best candidates per source and '
+                        'target document (sparse .npz output)')
+    parser.add_argument('-candidates',
+                        help='only score candidate pairs from blocking.py '
+                        '(sparse .npz output)',
+                        type=argparse.FileType('rb'))
+    parser.add_argument('-features', nargs='+',
+                        help='features for Multiple, scored in one pass, '
+                        'each as name:Feature[,ngram_size=N][,xpath=X]; '
+                        'writes to <outprefix><name>.npy (.npz if sparse). '
+                        'All features but TranslatedBOW')
+    parser.add_argument('-outprefix', help='output prefix for Multiple')
 
     args = parser.parse_args()
 
     assert not (args.mt and args.raw), "can't have both!"
+    assert not (args.topk and args.candidates), "can't have both!"
+    if args.feature == 'Multiple':
+        assert args.features and args.outprefix, \
+            "Multiple needs -features and -outprefix"
 
     pool = None
     if args.threads > 1:
@@ -219,11 +360,7 @@ if __name__ == "__main__":
     # read source and target corpus
     start = time.time()
     sys.stderr.write("Loading %s\n" % (args.corpus.name))
-    corpus_fh = args.corpus
-    if corpus_fh.name.endswith('.gz'):
-        corpus_fh = gzip.GzipFile(fileobj=corpus_fh, mode='r')
-    s = pickle.load(corpus_fh)
-    t = pickle.load(corpus_fh)
+    s, t = load_corpus(args.corpus)
     if args.mtonly:
         for turl in t:
             t[turl].english = u""
@@ -245,8 +382,13 @@ if __name__ == "__main__":
         s, t = sort_corpus(s, t, args.read_urlmapping)
         # sys.exit()  # TODO: remove?
 
+    candidates = None
+    if args.candidates:
+        shape, rows, cols = read_candidates(args.candidates)
+        assert shape == (len(s), len(t)), "candidates don't match corpus"
+        candidates = (rows, cols)
+
     scorer = None
-    print "Using feature: ", args.feature
 
     word_extractor = WordExtractor(n=args.ngram_size)
     if args.mt:
@@ -266,6 +408,28 @@ if __name__ == "__main__":
     elif ratio_function == 'levavg':
         ratio_function = levenshtein_avg
 
+    if args.feature == 'Multiple':
+        word_function = words_from_text
+        if args.mt:
+            word_function = english_words
+        elif args.raw:
+            word_function = raw_tokens
+        shared_extractor = SharedExtractor(word_function)
+        specs = map(parse_feature_spec, args.features)
+        scorers = shared_scorers(specs, shared_extractor, ratio_function, args)
+        start = time.time()
+        shared_extractor.extract(s, t)
+        print "Shared extraction took %.0f seconds" % (time.time() - start)
+        for name, scorer in scorers:
+            print "Using feature: ", name
+            m = score_feature(scorer, s, t, pool, args, candidates)
+            extension = ".npz" if isinstance(m, TopKScores) else ".npy"
+            with open(args.outprefix + name + extension, 'wb') as outfile:
+                write_scores(m, outfile)
+        sys.exit()
+
+    print "Using feature: ", args.feature
+
     if args.feature == 'LinkDistance':
         link_extractor = LinkExtractor(args.xpath)
         scorer = DistanceScorer(extraction_mapper=link_extractor,
@@ -298,7 +462,8 @@ if __name__ == "__main__":
         scorer = GaleChurchScorer()
 
     elif args.feature == 'Simhash':
-        scorer = SimhashDistance(n=args.ngram_size)
+        scorer = SimhashDistance(n=args.ngram_size,
+                                 max_distance=args.max_hamming)
     elif args.feature == 'GaleChurch':
         scorer = GaleChurchAlignmentDistance()
     elif args.feature == 'TranslatedBOW':
@@ -330,9 +495,7 @@ if __name__ == "__main__":
         scorer = LinkageScorer()
     assert scorer is not None, "Need to instantiate scorer first"
 
-    start = time.time()
-    m = scorer.score(s, t, pool=pool, weighting=args.weighting)
-    print "Scoring took %.0f seconds" % (time.time() - start)
+    m = score_feature(scorer, s, t, pool, args, candidates)
 
     # sys.exit()
 
@@ -358,22 +521,7 @@ if __name__ == "__main__":
     #     % (len(correct), total, len(errors), total, 100. * len(errors) / total)
     # sys.exit()
 
-    # fix nans.
-    if np.sum(np.isnan(m)) > 0:
-        sys.stderr.write(
-            "found %d nans in matrix of shape %s\n"
-            % (np.sum(np.isnan(m)), m.shape))
-        m[np.isnan(m)] = 0
-
-    # if np.std(m) > 0:
-    #     m = (m - np.mean(m)) / np.std(m)
-
-    if args.outfile:
-        sys.stderr.write("Writing to %s\n" % (args.outfile.name))
-    if args.outfile.name.endswith("npy"):
-        np.save(args.outfile, m)
-    else:
-        np.savetxt(args.outfile, m)
+    write_scores(m, args.outfile)
     sys.exit()
 
     # print info
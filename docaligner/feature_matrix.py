@@ -3,8 +3,8 @@
 import numpy as np
 import sys
 import json
-import gzip
 from sklearn import preprocessing
+from topk import TopKScores, load_scores, submatrix
 
 
 def read_devset(fh, mapping):
@@ -55,25 +55,31 @@ def cut_features(feature_files, devset, mapping, scale=False):
     # print "New Target: ", new_target
 
     new_features = []
+    candidate_mask = None
     for f in feature_files:
         # print len(new_features), f.shape
         # print (len(mapping['source_url_to_index']),
         #        len(mapping['target_url_to_index']))
-        fh = f
-        if f.name.endswith('.gz'):
-            fh = gzip.GzipFile(fileobj=fh, mode='r')
-        m = np.load(fh)
+        m = load_scores(f)
         if scale:
+            assert not isinstance(m, TopKScores), "can't scale top-k features"
             print "Scaling ..."
             m = preprocessing.scale(m)
         sys.stderr.write("Loaded %s of shape %s\n" % (f.name, m.shape))
         assert m.shape == (len(mapping['source_url_to_index']),
                            len(mapping['target_url_to_index']))
-        nf = m[rows][:, cols]
+        nf = submatrix(m, rows, cols)
+        if isinstance(m, TopKScores):
+            stored = submatrix(m._replace(data=np.ones(len(m.data)),
+                                          fill_value=0.), rows, cols) > 0
+            if candidate_mask is None:
+                candidate_mask = stored
+            else:
+                candidate_mask |= stored
         # print "New feature: ", nf
         new_features.append(nf)
 
-    return new_features, new_target
+    return new_features, new_target, candidate_mask
 
 if __name__ == "__main__":
     import argparse
@@ -114,7 +120,7 @@ if __name__ == "__main__":
 
     # features = map(np.loadtxt, args.feature_matrix)
     n_features = len(args.feature_matrix)
-    features, targets = cut_features(
+    features, targets, candidate_mask = cut_features(
         args.feature_matrix, devset, url_mapping, args.scale)
 
     n_source, n_target = features[0].shape
@@ -138,7 +144,16 @@ if __name__ == "__main__":
             % (np.sum(np.isnan(m)), m.shape))
         m[np.isnan(m)] = 0
 
+    targets = targets.reshape((n_source, n_target))
+    if candidate_mask is not None:
+        # top-k features: only train on pairs that survive candidate selection
+        keep = candidate_mask.ravel()
+        print "Keeping %d of %d candidate pairs, %d positive" \
+            % (keep.sum(), keep.size, targets.ravel()[keep].sum())
+        m = m[keep]
+        targets = targets.ravel()[keep]
+
     print "Writing to ", args.write_train.name
     np.savez(args.write_train,
-             targets=targets.reshape((n_source, n_target)),
+             targets=targets,
              feature_matrix=m)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+import os
+try:
+    from nltk.align import gale_church
+except ImportError:
+    from nltk.translate import gale_church
+
+# Gale-Church alignment cost of one source sequence of block lengths against
+# many target sequences at once. The DP runs row by row over the source; each
+# row is computed for all targets and all target positions with array
+# operations. The only horizontal dependency, the (0, 1) insertion, is a
+# min-plus scan that turns into cumsum + minimum.accumulate.
+#
+# Costs are non-negative, so all DP cells are clamped to max_dist and a target
+# is dropped as soon as a whole row is >= max_dist; its score is -max_dist.
+#
+# Targets are padded to a common length within groups of similar length
+# (TargetGroups), so one very long page doesn't pad all the others.
+
+PARAMS = gale_church.LanguageIndependent
+ALIGNMENT_TYPES = sorted(PARAMS.PRIORS.keys())
+LOG2 = np.log(2)
+
+
+def erfcc(x):
+    """ nltk's approximation of erfc, vectorized. nltk never gets to use
+        scipy.stats.norm, so this is what the per-pair scores use. """
+    z = np.abs(x)
+    t = 1 / (1 + 0.5 * z)
+    poly = 0.
+    for c in (0.17087277, -0.82215223, 1.48851587, -1.13520398, 0.27886807,
+              -0.18628806, 0.09678418, 0.37409196, 1.00002368):
+        poly = c + t * poly
+    r = t * np.exp(-z * z - 1.26551223 + t * poly)
+    return np.where(x >= 0, r, 2. - r)
+
+
+def align_cost(l_s, l_t, alignment, params=PARAMS):
+    """ Same as -gale_church.align_log_prob for arrays of summed lengths """
+    l_s = np.asarray(l_s, dtype=np.float64)
+    l_t = np.asarray(l_t, dtype=np.float64)
+    m = (l_s + l_t / params.AVERAGE_CHARACTERS) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(
+            m > 0, (l_s * params.AVERAGE_CHARACTERS - l_t) /
+            np.sqrt(m * params.VARIANCE_CHARACTERS), 0.)
+        # log(1 - norm_cdf), rounding included
+        logsf = np.log(1 - (1 - 0.5 * erfcc(np.abs(delta) / np.sqrt(2))))
+    return -(LOG2 + logsf + np.log(params.PRIORS[alignment]))
+
+
+def pad_sequences(seqs):
+    """ Target sequences as (lengths, prefix sums padded to max length) """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    max_len = lengths.max() if len(seqs) else 0
+    padded = np.zeros((len(seqs), max_len + 1))
+    for idx, seq in enumerate(seqs):
+        padded[idx, 1:lengths[idx] + 1] = np.cumsum(seq)
+        padded[idx, lengths[idx] + 1:] = padded[idx, lengths[idx]]
+    return lengths, padded
+
+
+def align_scores(source, lengths, prefix_sums, max_dist=100):
+    """ -min(alignment cost, max_dist) of source against every target, as
+        GaleChurchWrapper.align_score, for targets from pad_sequences """
+    n_targets, width = prefix_sums.shape
+    scores = np.empty(n_targets)
+    scores.fill(-max_dist)
+    source_sums = np.concatenate(([0], np.cumsum(source)))
+    n_source = len(source)
+
+    # costs of target blocks, these don't depend on the source position
+    block_lengths = dict((n, prefix_sums[:, n:] - prefix_sums[:, :-n])
+                         for n in set(a[1] for a in ALIGNMENT_TYPES) if n)
+    insertion = np.minimum(align_cost(0, block_lengths[1], (0, 1)), max_dist)
+    insertion = np.hstack((np.zeros((n_targets, 1)),
+                           np.cumsum(insertion, axis=1)))
+
+    active = np.arange(n_targets)
+    columns = np.arange(width)
+    rows = []
+    for i in xrange(n_source + 1):
+        row = np.empty((len(active), width))
+        row.fill(np.inf)
+        if i == 0:
+            row[:, 0] = 0
+        for alignment in ALIGNMENT_TYPES:
+            n_s, n_t = alignment
+            if n_s == 0 or n_s > i:
+                continue
+            l_s = source_sums[i] - source_sums[i - n_s]
+            prev = rows[-n_s]
+            if n_t == 0:
+                cost = align_cost(l_s, 0, alignment)
+                np.minimum(row, prev + cost, out=row)
+            else:
+                cost = align_cost(l_s, block_lengths[n_t], alignment)
+                np.minimum(row[:, n_t:], prev[:, :-n_t] + cost,
+                           out=row[:, n_t:])
+        np.minimum(row, max_dist, out=row)
+        # row[j] = min(row[j], row[j - 1] + insertion cost of j)
+        row = insertion + np.minimum.accumulate(row - insertion, axis=1)
+        np.minimum(row, max_dist, out=row)
+
+        # early termination: costs only grow from here
+        valid = columns <= lengths[active][:, np.newaxis]
+        alive = np.where(valid, row, np.inf).min(axis=1) < max_dist
+        if not alive.all():
+            active = active[alive]
+            row = row[alive]
+            rows = [r[alive] for r in rows]
+            insertion = insertion[alive]
+            block_lengths = dict((n, b[alive])
+                                 for n, b in block_lengths.iteritems())
+        rows = (rows + [row])[-2:]
+        if not len(active):
+            return scores
+
+    final = rows[-1][np.arange(len(active)), lengths[active]]
+    scores[active] = np.where(final == 0, -max_dist, -final)
+    return scores
+
+
+def group_by_length(seqs):
+    """ Target indices grouped by the number of blocks, so that padding at
+        most doubles a group and one very long page doesn't blow up the
+        others. Groups are lengths 0, 1, 2-3, 4-7, ... """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    keys = np.zeros(len(lengths), dtype=np.int64)
+    nonempty = lengths > 0
+    keys[nonempty] = np.floor(np.log2(lengths[nonempty])).astype(np.int64) + 1
+    order = np.argsort(keys, kind='mergesort')
+    if not len(order):
+        return []
+    return np.split(order, np.flatnonzero(np.diff(keys[order])) + 1)
+
+
+class TargetGroups(object):
+
+    """ Target sequences, padded per length group. Each group is an array
+        with the target index, the length and the padded prefix sums
+        (see pad_sequences) in one row per target. """
+
+    def __init__(self, groups):
+        self.groups = groups
+        n_targets = sum(len(group) for group in groups)
+        self.group_of = np.empty(n_targets, dtype=np.int64)
+        self.row_of = np.empty(n_targets, dtype=np.int64)
+        for group_idx, group in enumerate(groups):
+            indices = group[:, 0].astype(np.int64)
+            self.group_of[indices] = group_idx
+            self.row_of[indices] = np.arange(len(group))
+
+    @classmethod
+    def from_sequences(cls, seqs):
+        groups = []
+        for indices in group_by_length(seqs):
+            lengths, prefix_sums = pad_sequences(
+                [seqs[idx] for idx in indices])
+            groups.append(np.hstack((indices[:, np.newaxis],
+                                     lengths[:, np.newaxis], prefix_sums)))
+        return cls(groups)
+
+    def save(self, dirname):
+        for group_idx, group in enumerate(self.groups):
+            np.save(os.path.join(dirname, "%d.npy" % group_idx), group)
+
+    @classmethod
+    def load(cls, dirname):
+        """ Memory-mapped, so all workers share one copy in the page cache """
+        n_groups = len([f for f in os.listdir(dirname) if f.endswith('.npy')])
+        return cls([np.load(os.path.join(dirname, "%d.npy" % group_idx),
+                            mmap_mode='r')
+                    for group_idx in xrange(n_groups)])
+
+    def _align_rows(self, source, group, rows, max_dist):
+        targets = group if rows is None else group[rows]
+        lengths = targets[:, 1].astype(np.int64)
+        # padding beyond the longest of these targets is not needed
+        width = lengths.max() + 1 if len(lengths) else 1
+        return align_scores(source, lengths,
+                            np.asarray(targets[:, 2:2 + width]), max_dist)
+
+    def align_scores(self, source, target_indices=None, max_dist=100):
+        """ align_scores of source against all targets or only the given
+            indices, in that order """
+        if target_indices is None:
+            scores = np.empty(len(self.group_of))
+            for group in self.groups:
+                scores[group[:, 0].astype(np.int64)] = \
+                    self._align_rows(source, group, None, max_dist)
+            return scores
+
+        target_indices = np.asarray(target_indices, dtype=np.int64)
+        scores = np.empty(len(target_indices))
+        groups = self.group_of[target_indices]
+        for group_idx in np.unique(groups):
+            selected = groups == group_idx
+            scores[selected] = self._align_rows(
+                source, self.groups[group_idx],
+                self.row_of[target_indices[selected]], max_dist)
+        return scores
+
+
+_loaded_targets = {}
+
+
+def _load_targets(dirname):
+    if dirname not in _loaded_targets:
+        _loaded_targets.clear()
+        _loaded_targets[dirname] = TargetGroups.load(dirname)
+    return _loaded_targets[dirname]
+
+
+def align_scores_pool(targets_dir, max_dist, source_targets):
+    """ For pool.imap: scores one source against the targets saved with
+        TargetGroups.save, all of them or only the given indices """
+    source, target_indices = source_targets
+    return _load_targets(targets_dir).align_scores(source, target_indices,
+                                                   max_dist)
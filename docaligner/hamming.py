@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Hamming distances between 64 bit fingerprints (e.g. simhash values) kept
+# in uint64 arrays.
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def fingerprint_array(values):
+    return np.array([long(v) for v in values], dtype=np.uint64)
+
+
+def popcount64(x):
+    """ Number of set bits of every element of a uint64 array (SWAR) """
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return ((x * _H01) >> np.uint64(56)).astype(np.int64)
+
+
+def hamming_blocks(sfps, tfps, block_size=1000):
+    """ Yields (first row, distances) for blocks of the full
+        len(sfps) x len(tfps) distance matrix """
+    for start in xrange(0, len(sfps), block_size):
+        block = sfps[start:start + block_size, np.newaxis] ^ tfps
+        yield start, popcount64(block)
+
+
+def hamming_pairs(sfps, tfps, rows, cols):
+    return popcount64(sfps[rows] ^ tfps[cols])
+
+
+class HammingIndex(object):
+
+    """ Finds all pairs within Hamming distance k without the full cross
+        product. Fingerprints are cut into k + 1 bit blocks; two
+        fingerprints within distance k agree on at least one block, so only
+        pairs sharing a block need to be checked. """
+
+    def __init__(self, tfps, k, bits=64):
+        self.tfps = tfps
+        self.k = k
+        n_blocks = k + 1
+        assert n_blocks <= bits, "k too large for %d bits" % bits
+        bounds = np.linspace(0, bits, n_blocks + 1).astype(int)
+        self.blocks = []
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            shift = np.uint64(low)
+            mask = np.uint64((1 << int(high - low)) - 1)
+            keys = (tfps >> shift) & mask
+            order = np.argsort(keys, kind='mergesort')
+            self.blocks.append((shift, mask, keys[order], order))
+
+    def query(self, sfps):
+        """ Returns rows, cols and distances of all pairs with distance <= k,
+            sorted by row, then column """
+        n_target = len(self.tfps)
+        pairs = []
+        for shift, mask, sorted_keys, order in self.blocks:
+            keys = (sfps >> shift) & mask
+            begin = np.searchsorted(sorted_keys, keys, side='left')
+            end = np.searchsorted(sorted_keys, keys, side='right')
+            lengths = end - begin
+            rows = np.repeat(np.arange(len(sfps)), lengths)
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.arange(lengths.sum()) + \
+                np.repeat(begin - offsets, lengths)
+            pairs.append(rows * n_target + order[positions])
+        if not pairs:
+            pairs = [np.array([], dtype=np.int64)]
+        pairs = np.unique(np.concatenate(pairs))
+        rows, cols = pairs // n_target, pairs % n_target
+        distances = hamming_pairs(sfps, self.tfps, rows, cols)
+        close = distances <= self.k
+        return rows[close], cols[close], distances[close]
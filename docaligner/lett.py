@@ -8,10 +8,18 @@ from textsanitzer import TextSanitizer
 from external_processor import ExternalTextProcessor
 from tokenizer import ExternalProcessor, SpaceTokenizer, WordPunctTokenizer
 from page import Page
+from corpus_store import write_store
 
 magic_number = "df6fa1abb58549287111ba8d776733e9"
 
 
+def tokenize(tokenizer, texts):
+    """ Whole corpus at once if the tokenizer can batch """
+    if hasattr(tokenizer, 'process_documents'):
+        return tokenizer.process_documents(texts)
+    return [tokenizer.process(text) for text in texts]
+
+
 def read_lett(f, slang, tlang, source_tokenizer=None, target_tokenizer=None,
               no_html=False, url2source=None, url2target=None,
               detect_english=False):
@@ -30,11 +38,6 @@ def read_lett(f, slang, tlang, source_tokenizer=None, target_tokenizer=None,
         text = base64.b64decode(text).decode("utf-8")
         # assert lang in [slang, tlang]
 
-        if lang == slang and source_tokenizer is not None:
-            text = source_tokenizer.process(text)
-        elif lang == tlang and target_tokenizer is not None:
-            text = target_tokenizer.process(text)
-
         p = Page(url, html, text, mine, enc, u"", u"", u"")
 
         if lang == slang:
@@ -42,16 +45,24 @@ def read_lett(f, slang, tlang, source_tokenizer=None, target_tokenizer=None,
         elif lang == tlang:
             t[url] = p
 
+    for corpus, tokenizer in ((s, source_tokenizer), (t, target_tokenizer)):
+        if tokenizer is not None:
+            urls = corpus.keys()
+            texts = tokenize(tokenizer, [corpus[url].text for url in urls])
+            for url, text in zip(urls, texts):
+                corpus[url].text = text
+
     if url2source is not None:
         source_text = defaultdict(list)
         for line in url2source:
             url, text = line.rstrip().split('\t')
             if url in s or url in t:
                 source_text[url].append(text.decode('utf-8'))
-        for url in source_text:
-            text = u'\n'.join(source_text[url])
-            if source_tokenizer is not None:
-                text = source_tokenizer.process(text)
+        urls = source_text.keys()
+        texts = [u'\n'.join(source_text[url]) for url in urls]
+        if source_tokenizer is not None:
+            texts = tokenize(source_tokenizer, texts)
+        for url, text in zip(urls, texts):
             if url in s:
                 s[url].french = text
             if url in t:
@@ -63,10 +74,11 @@ def read_lett(f, slang, tlang, source_tokenizer=None, target_tokenizer=None,
             url, text = line.rstrip().split('\t')
             if url in s or url in t:
                 target_text[url].append(text.decode('utf-8'))
-        for url in target_text:
-            text = u'\n'.join(target_text[url])
-            if target_tokenizer is not None:
-                text = target_tokenizer.process(text)
+        urls = target_text.keys()
+        texts = [u'\n'.join(target_text[url]) for url in urls]
+        if target_tokenizer is not None:
+            texts = tokenize(target_tokenizer, texts)
+        for url, text in zip(urls, texts):
             if url in s:
                 s[url].english_mt = text
             if url in t:
@@ -167,12 +179,17 @@ if __name__ == "__main__":
         '-source_tokenizer', help='call to tokenizer, including arguments')
     parser.add_argument(
         '-target_tokenizer', help='call to tokenizer, including arguments')
+    parser.add_argument('-tokenizer_workers', type=int, default=4,
+                        help='number of tokenizer processes per language')
     parser.add_argument('-url2en', help='url to English text',
                         type=argparse.FileType('r'))
     parser.add_argument('-url2fr', help='url to French text',
                         type=argparse.FileType('r'))
     parser.add_argument('-write', help='filename for pickle file',
                         type=argparse.FileType('wb'))
+    parser.add_argument('-write_store',
+                        help='filename for memory-mapped corpus store',
+                        type=argparse.FileType('wb'))
     args = parser.parse_args()
 
     source_tokenizer = None
@@ -180,13 +197,15 @@ if __name__ == "__main__":
         if args.source_tokenizer == 'WordPunctTokenizer':
             source_tokenizer = WordPunctTokenizer()
         else:
-            source_tokenizer = ExternalTextProcessor(args.source_tokenizer)
+            source_tokenizer = ExternalProcessor(
+                args.source_tokenizer, n_workers=args.tokenizer_workers)
     target_tokenizer = None
     if args.target_tokenizer:
         if args.target_tokenizer == 'WordPunctTokenizer':
             target_tokenizer = WordPunctTokenizer()
         else:
-            target_tokenizer = ExternalTextProcessor(args.target_tokenizer)
+            target_tokenizer = ExternalProcessor(
+                args.target_tokenizer, n_workers=args.tokenizer_workers)
 
     # read source and target corpus
     s, t = read_lett(args.lettfile, args.slang, args.tlang,
@@ -218,3 +237,7 @@ if __name__ == "__main__":
         sys.stderr.write("Writing to %s\n" % (args.write.name))
         pickle.dump(s, args.write)
         pickle.dump(t, args.write)
+
+    if args.write_store:
+        sys.stderr.write("Writing to %s\n" % (args.write_store.name))
+        write_store(args.write_store, {'source': s, 'target': t})
@@ -1,5 +1,7 @@
 import difflib
 import editdistance
+import numpy as np
+from scipy.sparse import csr_matrix
 
 
 def ratio(weights, seq1, seq2):
@@ -98,6 +100,88 @@ def cosine(weights, counts1, counts2):
     return 0.
 
 
+def _row_blocks(n_rows, block_size):
+    for start in xrange(0, n_rows, block_size):
+        yield start, min(start + block_size, n_rows)
+
+
+def _count_levels(counts, max_level):
+    """ Split a count matrix into binary matrices L_k = (counts >= k).
+        sum_k L_k[i] * L_k[j] = sum_t min(counts[i, t], counts[j, t]) """
+    levels = []
+    for k in xrange(1, int(max_level) + 1):
+        level = counts.copy()
+        level.data = (level.data >= k).astype(np.float64)
+        level.eliminate_zeros()
+        if level.nnz == 0:
+            break
+        levels.append(level)
+    return levels
+
+
+def jaccard_blocks(weights, smatrix, tmatrix, block_size=1000):
+    """ Same as jaccard() for all pairs of rows in two binary
+        document-term matrices. Yields (first row, scores) per block. """
+    ssize = np.asarray(smatrix.sum(axis=1)).ravel()
+    tsize = np.asarray(tmatrix.sum(axis=1)).ravel()
+    ttrans = tmatrix.T.tocsc()
+    for start, end in _row_blocks(smatrix.shape[0], block_size):
+        scores = np.zeros((end - start, tmatrix.shape[0]))
+        intersection = (smatrix[start:end] * ttrans).tocoo()
+        rows, cols = intersection.row, intersection.col
+        union = ssize[rows + start] + tsize[cols] - intersection.data
+        scores[rows, cols] = intersection.data / union
+        yield start, scores
+
+
+def weighted_jaccard_blocks(weights, smatrix, tmatrix, block_size=1000):
+    """ Same as weighted_jaccard() for all pairs of rows in two count
+        matrices. weights is a vector with one entry per column. """
+    max_level = min(smatrix.data.max() if smatrix.nnz else 0,
+                    tmatrix.data.max() if tmatrix.nnz else 0)
+    slevels = _count_levels(smatrix, max_level)
+    tlevels = [level.multiply(weights).T.tocsc()
+               for level in _count_levels(tmatrix, max_level)]
+    ssum = smatrix * weights
+    tsum = tmatrix * weights
+    for start, end in _row_blocks(smatrix.shape[0], block_size):
+        scores = np.zeros((end - start, tmatrix.shape[0]))
+        num = csr_matrix((end - start, tmatrix.shape[0]))
+        for slevel, tlevel in zip(slevels, tlevels):
+            num = num + slevel[start:end] * tlevel
+        num = num.tocoo()
+        positive = num.data > 0
+        rows = num.row[positive]
+        cols = num.col[positive]
+        num = num.data[positive]
+        scores[rows, cols] = num / (ssum[rows + start] + tsum[cols] - num)
+        yield start, scores
+
+
+def cosine_blocks(weights, smatrix, tmatrix, block_size=1000):
+    """ Same as cosine() for all pairs of rows in two count matrices.
+        weights is a vector with one entry per column. """
+    sweighted = smatrix.multiply(weights).tocsr()
+    tweighted = tmatrix.multiply(weights).T.tocsc()
+    snorm = np.asarray(sweighted.multiply(sweighted).sum(axis=1)).ravel()
+    tnorm = np.asarray(tweighted.multiply(tweighted).sum(axis=0)).ravel()
+    for start, end in _row_blocks(smatrix.shape[0], block_size):
+        scores = np.zeros((end - start, tmatrix.shape[0]))
+        nom = (sweighted[start:end] * tweighted).tocoo()
+        positive = nom.data > 0
+        rows = nom.row[positive]
+        cols = nom.col[positive]
+        scores[rows, cols] = nom.data[positive] / \
+            (snorm[rows + start] + tnorm[cols])
+        yield start, scores
+
+
+# per-pair ratio functions that have a vectorized counterpart
+block_functions = {jaccard: jaccard_blocks,
+                   weighted_jaccard: weighted_jaccard_blocks,
+                   cosine: cosine_blocks}
+
+
 def dice(seq1, seq2):
     s1 = set(seq1)
     s2 = set(seq2)
@@ -1,5 +1,8 @@
 from collections import defaultdict, Counter
 from functools import partial
+from galechurch import TargetGroups, align_scores_pool
+from hamming import fingerprint_array, popcount64, HammingIndex
+from hamming import hamming_blocks, hamming_pairs
 from htmlprocessor import HTMLSequencer
 from itertools import imap
 try:
@@ -8,11 +11,12 @@ except ImportError:
     from nltk.translate import gale_church
 from nltk.tokenize import wordpunct_tokenize
 from nltk.tokenize.punkt import PunktSentenceTokenizer
-from ratio import ratio
+from ratio import ratio, jaccard, block_functions
 from scipy.sparse import csr_matrix, lil_matrix, vstack
 from simhash import Simhash
 from sklearn.metrics.pairwise import pairwise_distances
 from tokenizer import SpaceTokenizer
+from topk import TopKCollector, TopKScores
 from urlparse import urljoin
 import codecs
 import difflib
@@ -21,8 +25,11 @@ import jsonrpclib
 import lxml.html
 import math
 import numpy as np
+import os
 import re
+import shutil
 import sys
+import tempfile
 import time
 
 
@@ -31,6 +38,38 @@ def ratio_pool(seqs2, ratio_function, weights, seq1):
     return map(rf, seqs2)
 
 
+def ratio_subset_pool(tseqs, ratio_function, weights, seq1_targets):
+    seq1, targets = seq1_targets
+    return [ratio_function(weights, seq1, tseqs[t_idx]) for t_idx in targets]
+
+
+def document_term_matrices(sseqs, tseqs):
+    """ Builds CSR count matrices over a shared vocabulary from sets or
+        Counters. Returns both matrices and the list of column terms. """
+    term2idx = {}
+    terms = []
+    parts = []
+    for seqs in sseqs, tseqs:
+        indptr, indices, data = [0], [], []
+        for seq in seqs:
+            items = seq.iteritems() if isinstance(seq, dict) else \
+                ((term, 1) for term in seq)
+            for term, count in items:
+                idx = term2idx.get(term)
+                if idx is None:
+                    idx = term2idx[term] = len(terms)
+                    terms.append(term)
+                indices.append(idx)
+                data.append(count)
+            indptr.append(len(indices))
+        parts.append((data, indices, indptr))
+    return [csr_matrix((np.array(data, dtype=np.float64),
+                        np.array(indices, dtype=np.int32),
+                        np.array(indptr, dtype=np.int32)),
+                       shape=(len(indptr) - 1, len(terms)))
+            for data, indices, indptr in parts] + [terms]
+
+
 def _ngram_helper(words, n, hash_values):
     words = [w.strip() for w in words if w.strip()]
     ngrams = (" ".join(words[i:i + n]) for i in
@@ -41,19 +80,28 @@ def _ngram_helper(words, n, hash_values):
     return ngrams
 
 
+def words_from_text(page):
+    return page.text.split()
+
+
+def raw_tokens(page):
+    return wordpunct_tokenize(page.html)
+
+
+def english_words(page):
+    return page.english.split() + page.english_mt.split()
+
+
 def ngrams_from_text(n, hash_values, page):
-    words = page.text.split()
-    return _ngram_helper(words, n, hash_values)
+    return _ngram_helper(words_from_text(page), n, hash_values)
 
 
 def raw_tokens_from_text(n, hash_values, page):
-    words = wordpunct_tokenize(page.html)
-    return _ngram_helper(words, n, hash_values)
+    return _ngram_helper(raw_tokens(page), n, hash_values)
 
 
 def english_ngrams_from_text(n, hash_values, page):
-    words = page.english.split() + page.english_mt.split()
-    return _ngram_helper(words, n, hash_values)
+    return _ngram_helper(english_words(page), n, hash_values)
 
 
 class ExtractionMapper(object):
@@ -202,6 +250,16 @@ class DocumentVectorExtractor(object):
         return m
 
 
+def links_from_dom(dom, url, xpath):
+    links = []
+    for link in dom.xpath(xpath):
+        try:
+            links.append(urljoin(url, link))
+        except ValueError:
+            continue
+    return links
+
+
 class LinkExtractor(ExtractionMapper):
 
     def __init__(self, xpath):
@@ -211,13 +269,7 @@ class LinkExtractor(ExtractionMapper):
 
     def _extract_links(self, page):
         dom = lxml.html.fromstring(page.html)
-        links = []
-        for link in dom.xpath(self.xpath):
-            try:
-                links.append(urljoin(page.url, link))
-            except ValueError:
-                continue
-        return links
+        return links_from_dom(dom, page.url, self.xpath)
 
 
 class WeightedLinkExtractor(ExtractionMapper):
@@ -270,15 +322,98 @@ class GCBlockExtractor(ExtractionMapper):
         return blocks
 
 
+class SharedMapper(ExtractionMapper):
+
+    """ Returns what a SharedExtractor extracted for one key """
+
+    def __init__(self, shared_extractor, key):
+        super(SharedMapper, self).__init__()
+        self.shared_extractor = shared_extractor
+        self.key = key
+
+    def extract_source(self, corpus):
+        seqs = self.shared_extractor.source_results[self.key]
+        assert len(corpus) == len(seqs)
+        return seqs
+
+    def extract_target(self, corpus):
+        seqs = self.shared_extractor.target_results[self.key]
+        assert len(corpus) == len(seqs)
+        return seqs
+
+
+class SharedExtractor(object):
+
+    """ Extracts what several features need in a single pass: the HTML of
+        each page is parsed once for all link xpaths and sequenced once for
+        the structure, the text is tokenized once for all n-gram orders.
+        The add_* methods register what is needed and return extraction
+        mappers that can be used once extract() was called. """
+
+    def __init__(self, word_function=words_from_text):
+        self.word_function = word_function
+        self.ngram_sizes = set()
+        self.xpaths = set()
+        self.structure_functions = None
+        self.source_results, self.target_results = None, None
+
+    def add_ngrams(self, n):
+        self.ngram_sizes.add(n)
+        return SharedMapper(self, ('ngrams', n))
+
+    def add_links(self, xpath):
+        self.xpaths.add(xpath)
+        return SharedMapper(self, ('links', xpath))
+
+    def add_structure(self, length_function, growth_function):
+        self.structure_functions = (length_function, growth_function)
+        return SharedMapper(self, ('structure',))
+
+    def _extract_page(self, page):
+        result = {}
+        if self.ngram_sizes:
+            words = [w.strip() for w in self.word_function(page) if w.strip()]
+            for n in self.ngram_sizes:
+                result[('ngrams', n)] = _ngram_helper(words, n, False)
+
+        if self.xpaths:
+            dom = None
+            if page.html.strip():
+                dom = lxml.html.fromstring(page.html)
+            for xpath in self.xpaths:
+                result[('links', xpath)] = [] if dom is None else \
+                    links_from_dom(dom, page.url, xpath)
+        if self.structure_functions:
+            # same as StructureExtractor, lxml would repair the tree
+            parser = HTMLSequencer(*self.structure_functions)
+            parser.feed(page.html.decode('utf-8'))
+            result[('structure',)] = parser.get_result()
+        return result
+
+    def _extract_corpus(self, corpus):
+        results = defaultdict(list)
+        for idx, page in enumerate(corpus):
+            for key, seq in self._extract_page(page).iteritems():
+                results[key].append(seq)
+            if (idx + 1) % 1000 == 0:
+                sys.stderr.write("[%d]\n" % (idx + 1))
+        return results
+
+    def extract(self, source_corpus, target_corpus):
+        self.source_results = self._extract_corpus(source_corpus)
+        self.target_results = self._extract_corpus(target_corpus)
+
+
 class DistanceScorer(object):
 
     def __init__(self, extraction_mapper, ratio_function, set_based=False,
-                 count_based=False):
+                 count_based=False, vectorize=True):
         self.name = "Default Distance Scorer"
         self.extraction_mapper = extraction_mapper
         self.ratio_function = ratio_function
         self._set_based = set_based
         self._count_based = count_based
+        self._vectorize = vectorize
         assert not (count_based and set_based), "can't have both"
         self._threadsafe = False
         self.weights = None
@@ -329,17 +464,45 @@ class DistanceScorer(object):
             print "Extracting tf"
             self.weights = self.term_weights_flat(self.sseqs, self.tseqs)
 
-    def score(self, source_corpus, target_corpus, pool=None, weighting=None):
-        self._extract(source_corpus, target_corpus, weighting)
-        sys.stderr.write("Done extracting...\n")
-        scoring_matrix = np.zeros((len(source_corpus), len(target_corpus)))
+    def _can_vectorize(self):
+        if not self._vectorize:
+            return False
+        if not (self._set_based or self._count_based):
+            return False
+        if self.ratio_function not in block_functions:
+            return False
+        # weighted functions look up every term in self.weights
+        return self.weights is not None or self.ratio_function is jaccard
+
+    def _score_vectorized(self):
+        smatrix, tmatrix, terms = document_term_matrices(self.sseqs,
+                                                         self.tseqs)
+        sys.stderr.write("Scoring %d x %d docs with %d terms using sparse "
+                         "matrix products\n"
+                         % (smatrix.shape[0], tmatrix.shape[0], len(terms)))
+        weights = None
+        if self.weights is not None:
+            weights = np.array([self.weights[term] for term in terms],
+                               dtype=np.float64)
+        block_function = block_functions[self.ratio_function]
+        return block_function(weights, smatrix, tmatrix)
+
+    def _score_rows(self, pool):
+        """ Yields (first row, scores) for consecutive blocks of rows """
+        if self._can_vectorize():
+            for start, scores in self._score_vectorized():
+                yield start, scores
+            return
+
         if pool is None:
             for s_idx in xrange(len(self.sseqs)):
+                scores = np.zeros((1, len(self.tseqs)))
                 for t_idx in xrange(len(self.tseqs)):
-                    scoring_matrix[s_idx, t_idx] = \
+                    scores[0, t_idx] = \
                         self.ratio_function(self.weights,
                                             self.sseqs[s_idx],
                                             self.tseqs[t_idx])
+                yield s_idx, scores
                 if (s_idx + 1) % 20 == 0:
                     sys.stderr.write('.')
                     if (s_idx + 1) % 1000 == 0:
@@ -353,10 +516,7 @@ class DistanceScorer(object):
             for s_idx, scores in enumerate(
                     pool.imap(rf, self.sseqs, chunksize=50)):
                 # assert len(scores) == len(self.tseqs)
-                scoring_matrix[s_idx] = scores
-
-                # for t_idx in xrange(len(self.tseqs)):
-                #     scoring_matrix[s_idx, t_idx] = scores[t_idx]
+                yield s_idx, np.array(scores, ndmin=2)
 
                 if (s_idx + 1) % 20 == 0:
                     sys.stderr.write('.')
@@ -365,6 +525,59 @@ class DistanceScorer(object):
                     sys.stderr.flush()
             sys.stderr.write("[%d]\n" % len(self.sseqs))
             sys.stderr.flush()
+
+    def _score_candidates(self, rows, cols, pool):
+        """ Scores only the given pairs, rows need to be sorted """
+        data = np.zeros(len(rows))
+        if self._can_vectorize():
+            for start, scores in self._score_rows(pool):
+                block = (rows >= start) & (rows < start + scores.shape[0])
+                data[block] = scores[rows[block] - start, cols[block]]
+            return data
+
+        # one task per source document
+        bounds = np.flatnonzero(np.diff(rows)) + 1
+        bounds = np.concatenate(([0], bounds, [len(rows)]))
+        tasks = ((self.sseqs[rows[begin]], cols[begin:end])
+                 for begin, end in zip(bounds[:-1], bounds[1:])
+                 if end > begin)
+        rf = partial(ratio_subset_pool, self.tseqs, self.ratio_function,
+                     self.weights)
+        results = imap(rf, tasks) if pool is None else \
+            pool.imap(rf, tasks, chunksize=50)
+        for task_idx, scores in enumerate(results):
+            data[bounds[task_idx]:bounds[task_idx + 1]] = scores
+            if (task_idx + 1) % 20 == 0:
+                sys.stderr.write('.')
+                if (task_idx + 1) % 1000 == 0:
+                    sys.stderr.write("[%d]\n" % (task_idx + 1))
+                sys.stderr.flush()
+        return data
+
+    def score(self, source_corpus, target_corpus, pool=None, weighting=None,
+              topk=None, candidates=None):
+        """ Returns a dense score matrix or, if topk is given, TopKScores
+            holding only the best topk candidates per source and target.
+            candidates=(rows, cols) restricts scoring to these pairs, all
+            other pairs get the lowest observed score. """
+        self._extract(source_corpus, target_corpus, weighting)
+        sys.stderr.write("Done extracting...\n")
+        shape = (len(source_corpus), len(target_corpus))
+        if candidates is not None:
+            rows, cols = candidates
+            data = self._score_candidates(rows, cols, pool)
+            fill_value = data.min() if len(data) else 0.
+            return TopKScores(shape, rows, cols, data, fill_value)
+
+        if topk:
+            collector = TopKCollector(shape, topk)
+            for start, scores in self._score_rows(pool):
+                collector.update(start, scores)
+            return collector.scores()
+
+        scoring_matrix = np.zeros(shape)
+        for start, scores in self._score_rows(pool):
+            scoring_matrix[start:start + scores.shape[0]] = scores
         return scoring_matrix
 
     def joined_counts(self, source_corpus, target_corpus):
@@ -386,11 +599,14 @@ class GaleChurchWrapper(object):
         self.alignment_types = list(self.params.PRIORS.keys())
 
     def align_score(self, source_sents, target_sents, max_dist=100):
+        """ Returns -min(alignment cost, max_dist). Costs are not negative,
+            so we can stop once a whole row is >= max_dist. """
         D = [[]]
 
         # backlinks = {}
 
         for i in range(len(source_sents) + 1):
+            row_min = float('inf')
             for j in range(len(target_sents) + 1):
                 min_dist = float('inf')
                 # min_align = None
@@ -410,12 +626,13 @@ class GaleChurchWrapper(object):
                 if min_dist == float('inf'):
                     # return max_dist
                     min_dist = 0
-                elif min_dist >= max_dist:
-                    return max_dist
+                row_min = min(row_min, min_dist)
 
                 # backlinks[(i, j)] = min_align
                 D[-1].append(min_dist)
 
+            if row_min >= max_dist:
+                return -max_dist
             if len(D) > 2:
                 D.pop(0)
             D.append([])
@@ -424,7 +641,7 @@ class GaleChurchWrapper(object):
         # sys.exit()
         if D[-2][-1] == 0:
             return -max_dist
-        return -D[-2][-1]
+        return -min(D[-2][-1], max_dist)
 
 
 def gc_alignment_score(seq1, seq2):
@@ -434,10 +651,56 @@ def gc_alignment_score(seq1, seq2):
 
 class GaleChurchScorer(DistanceScorer):
 
-    def __init__(self):
+    """ Scores each source against all targets at once with the
+        vectorized DP from galechurch.py """
+
+    def __init__(self, max_dist=100):
         super(GaleChurchScorer,
               self).__init__(extraction_mapper=GCBlockExtractor(),
                              ratio_function=gc_alignment_score)
+        self.max_dist = max_dist
+
+    def _score_tasks(self, tasks, pool):
+        """ Yields scores for (source sequence, target indices) tasks """
+        if pool is None:
+            targets = TargetGroups.from_sequences(self.tseqs)
+            for source, target_indices in tasks:
+                yield targets.align_scores(source, target_indices,
+                                           self.max_dist)
+            return
+
+        # workers memory-map the padded targets instead of getting a copy
+        targets_dir = tempfile.mkdtemp()
+        try:
+            TargetGroups.from_sequences(self.tseqs).save(targets_dir)
+            rf = partial(align_scores_pool, targets_dir, self.max_dist)
+            for scores in pool.imap(rf, tasks, chunksize=10):
+                yield scores
+        finally:
+            shutil.rmtree(targets_dir)
+
+    def _score_rows(self, pool):
+        tasks = ((source, None) for source in self.sseqs)
+        for s_idx, scores in enumerate(self._score_tasks(tasks, pool)):
+            yield s_idx, scores[np.newaxis, :]
+            if (s_idx + 1) % 20 == 0:
+                sys.stderr.write('.')
+                if (s_idx + 1) % 1000 == 0:
+                    sys.stderr.write("[%d]\n" % (s_idx + 1))
+                sys.stderr.flush()
+
+    def _score_candidates(self, rows, cols, pool):
+        data = np.zeros(len(rows))
+        bounds = np.flatnonzero(np.diff(rows)) + 1
+        bounds = np.concatenate(([0], bounds, [len(rows)]))
+        bounds = [(begin, end) for begin, end in zip(bounds[:-1], bounds[1:])
+                  if end > begin]
+        tasks = ((self.sseqs[rows[begin]], cols[begin:end])
+                 for begin, end in bounds)
+        for (begin, end), scores in zip(bounds,
+                                        self._score_tasks(tasks, pool)):
+            data[begin:end] = scores
+        return data
 
 
 class CosineDistanceScorer(object):
@@ -820,10 +1083,15 @@ class StructureScorer(DistanceScorer):
 class SimhashDistance(DistanceScorer):
     CHAR, TOKEN = range(2)
 
-    def __init__(self, source_tokenizer, target_tokenizer, n=2, level=TOKEN):
+    def __init__(self, source_tokenizer=None, target_tokenizer=None, n=2,
+                 level=TOKEN, max_distance=None):
+        """ Scores are negative Hamming distances between 64 bit simhash
+            fingerprints. With max_distance only pairs that close are
+            kept, found with a HammingIndex. """
         self.name = "Simhash Distance Scorer, n=%d" % n
         self.sentence_splitter = PunktSentenceTokenizer()
-        self.s_hashes, self.t_hashes = [], []
+        self.s_hashes, self.t_hashes = None, None
+        self.max_distance = max_distance
 
         self.source_tokenizer = source_tokenizer
         if not source_tokenizer:
@@ -868,7 +1136,7 @@ class SimhashDistance(DistanceScorer):
         if level == SimhashDistance.TOKEN:
             self.source_features = partial(tokens, n, self.source_tokenizer)
             self.target_features = partial(tokens, n, self.target_tokenizer)
-        elif level == SimhashDistance.CHARS:
+        elif level == SimhashDistance.CHAR:
             self.source_features = partial(chars, n, self.source_tokenizer)
             self.target_features = partial(chars, n, self.target_tokenizer)
         # self.source_features = partial(ngrams, n, self.source_tokenizer)
@@ -882,14 +1150,43 @@ class SimhashDistance(DistanceScorer):
                 words.add(w)
         return words
 
-    def _extract(self, source_corpus, target_corpus):
-        for url, page in source_corpus.iteritems():
-            self.s_hashes.append(Simhash(self.source_features(page)))
-        for url, page in target_corpus.iteritems():
-            self.t_hashes.append(Simhash(self.target_features(page)))
+    def _extract(self, source_corpus, target_corpus, weighting=None):
+        # extract_features passes sorted lists, older callers url->page dicts
+        if isinstance(source_corpus, dict):
+            source_corpus = source_corpus.values()
+        if isinstance(target_corpus, dict):
+            target_corpus = target_corpus.values()
+        self.s_hashes = fingerprint_array(
+            Simhash(self.source_features(page)).value
+            for page in source_corpus)
+        self.t_hashes = fingerprint_array(
+            Simhash(self.target_features(page)).value
+            for page in target_corpus)
 
     def _score_pair(self, s_idx, s_page, t_idx, t_page):
-        return -self.s_hashes[s_idx].distance(self.t_hashes[t_idx])
+        return -popcount64(self.s_hashes[s_idx] ^ self.t_hashes[t_idx])
+
+    def _score_rows(self, pool):
+        for start, distances in hamming_blocks(self.s_hashes, self.t_hashes):
+            yield start, -distances
+
+    def _score_candidates(self, rows, cols, pool):
+        return -hamming_pairs(self.s_hashes, self.t_hashes, rows, cols)
+
+    def score(self, source_corpus, target_corpus, pool=None, weighting=None,
+              topk=None, candidates=None):
+        if self.max_distance is None or candidates is not None:
+            return super(SimhashDistance, self).score(
+                source_corpus, target_corpus, pool=pool, weighting=weighting,
+                topk=topk, candidates=candidates)
+        self._extract(source_corpus, target_corpus, weighting)
+        index = HammingIndex(self.t_hashes, self.max_distance)
+        rows, cols, distances = index.query(self.s_hashes)
+        sys.stderr.write("Found %d pairs within Hamming distance %d\n"
+                         % (len(rows), self.max_distance))
+        return TopKScores((len(self.s_hashes), len(self.t_hashes)),
+                          rows, cols, -distances.astype(np.float64),
+                          -float(self.max_distance + 1))
 
     def get_features(self, text):
         width = 3
@@ -1,3 +1,4 @@
+import Queue
 import sys
 import subprocess
 import os
@@ -30,45 +31,166 @@ class WordPunctTokenizer(object):
         return " ".join(words)
 
 
+# Written after every batch, a worker is done with the batch when this comes
+# back. Plain letters and digits pass through tokenizers, at most the case
+# changes.
+SENTINEL = u"docalignerbatchend7f3a2c91"
+
+
+class TokenizerWorker(object):
+
+    """ One long-lived tokenizer process. The command has to answer every
+        input line with one output line without buffering (e.g. Moses'
+        tokenizer.perl -b). """
+
+    def __init__(self, cmd, devnull):
+        self.cmd = cmd
+        self.devnull = devnull
+        self.proc = None
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd.split(),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self.devnull)
+        self.output = Queue.Queue()
+        reader = threading.Thread(target=self._read,
+                                  args=(self.proc.stdout, self.output))
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def _read(stdout, output):
+        for line in iter(stdout.readline, ''):
+            output.put(line)
+        output.put(None)  # EOF, process is gone
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.proc.wait()
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def submit(self, lines):
+        """ Writes in the background, a long batch would otherwise fill up
+            the output pipe while we are still writing """
+        data = u"".join(u"%s\n" % line for line in lines + [SENTINEL])
+
+        def write(stdin, data):
+            try:
+                stdin.write(data)
+                stdin.flush()
+            except (IOError, ValueError):
+                pass  # crashed, noticed while collecting
+
+        writer = threading.Thread(target=write,
+                                  args=(self.proc.stdin, data.encode('utf-8')))
+        writer.daemon = True
+        writer.start()
+
+    def collect(self, n_lines, timeout):
+        """ Output for the last submitted batch or None if the process died
+            or took longer than timeout seconds for a line """
+        result = []
+        while True:
+            try:
+                line = self.output.get(timeout=timeout)
+            except Queue.Empty:
+                return None
+            if line is None:
+                return None
+            line = line.decode('utf-8').strip()
+            if line.lower() == SENTINEL:
+                break
+            result.append(line)
+        if len(result) != n_lines:
+            return None
+        return result
+
+
 class ExternalProcessor(object):
 
-    """ wraps an external script and does utf-8 conversions, is thread-safe """
+    """ wraps an external script and does utf-8 conversions, is thread-safe.
+        Keeps n_workers processes running and sends batches of batch_size
+        lines to them round-robin. A worker that dies or hangs for more
+        than timeout seconds is restarted and its batch retried once; if
+        that fails too the lines are returned untokenized. """
 
-    def __init__(self, cmd):
+    def __init__(self, cmd, n_workers=1, batch_size=1000, timeout=60.0):
         self.cmd = cmd
+        self.batch_size = batch_size
+        self.timeout = timeout
         self.devnull = open(os.devnull, 'wb')
         self._lock = threading.Lock()
-        self.proc = None
-        self.reset()
-
-    def reset(self):
+        self.workers = []
+        if self.cmd is not None:
+            self.workers = [TokenizerWorker(cmd, self.devnull)
+                            for _ in range(n_workers)]
+
+    def _collect(self, worker, batch):
+        result = worker.collect(len(batch), self.timeout)
+        if result is None:
+            sys.stderr.write("Restarting tokenizer: %s\n" % self.cmd)
+            worker.restart()
+            worker.submit(batch)
+            result = worker.collect(len(batch), self.timeout)
+        if result is None:
+            sys.stderr.write("Tokenizer failed on batch of %d lines\n"
+                             % len(batch))
+            worker.restart()
+            result = batch
+        return result
+
+    def process_lines(self, lines):
+        """ Tokenizes a list of lines, output is in the same order """
+        result = list(lines)
+        todo = [idx for idx, line in enumerate(lines) if line.strip()]
+        if self.cmd is None or not todo:
+            return result
+        for line_idx in todo:
+            assert u"\n" not in lines[line_idx]
+        batches = [todo[start:start + self.batch_size]
+                   for start in range(0, len(todo), self.batch_size)]
         with self._lock:
-            if self.proc is not None:
-                res = self.proc.communicate()
-                if res[0].strip():
-                    sys.stderr.write("Remaining output: %s" % res[0])
-            self.proc = subprocess.Popen(self.cmd.split(),
-                                         stdin=subprocess.PIPE,
-                                         stdout=subprocess.PIPE,
-                                         stderr=self.devnull)
+            for start in range(0, len(batches), len(self.workers)):
+                # one batch per worker, collected in order
+                running = zip(self.workers,
+                              batches[start:start + len(self.workers)])
+                for worker, batch in running:
+                    worker.submit([lines[line_idx] for line_idx in batch])
+                for worker, batch in running:
+                    output = self._collect(
+                        worker, [lines[line_idx] for line_idx in batch])
+                    for line_idx, line in zip(batch, output):
+                        result[line_idx] = line
+        return result
+
+    def process_documents(self, texts):
+        """ Tokenizes many multi-line documents in one go """
+        lines, bounds = [], [0]
+        for text in texts:
+            lines.extend(text.split(u'\n'))
+            bounds.append(len(lines))
+        lines = self.process_lines(lines)
+        return [u'\n'.join(lines[begin:end])
+                for begin, end in zip(bounds[:-1], bounds[1:])]
 
     def process_multiline(self, text):
-        res = []
-        for line in text.split(u'\n'):
-            if line.strip():
-                res.append(self.process(line))
-        return u'\n'.join(res)
+        return u'\n'.join(line for line in self.process_lines(
+            text.split(u'\n')) if line.strip())
 
     def process(self, line):
         if self.cmd is None or not line.strip():
             return line
-        assert u"\n" not in line
-        u_string = u"%s\n" % line
-        u_string = u_string.encode("utf-8")
-        result = u_string  # fallback: return input
-        with self._lock:
-            self.proc.stdin.write(u_string)
-            self.proc.stdin.flush()
-            result = self.proc.stdout.readline()
-        self.reset()
-        return result.decode("utf-8").strip()
+        return self.process_lines([line])[0]
+
+    def close(self):
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import numpy as np
+from collections import namedtuple
+
+# Sparse alternative to a dense n_source x n_target score matrix. Only the
+# k best targets for every source and the k best sources for every target are
+# kept, all other pairs are assumed to have fill_value.
+TopKScores = namedtuple('TopKScores',
+                        ['shape', 'row', 'col', 'data', 'fill_value'])
+
+
+def _best_k(scores, k, axis):
+    """ Indices of the k largest entries along axis (unordered) """
+    if scores.shape[axis] <= k:
+        idx = np.arange(scores.shape[axis])
+        if axis == 0:
+            return np.tile(idx[:, np.newaxis], (1, scores.shape[1]))
+        return np.tile(idx, (scores.shape[0], 1))
+    return np.argpartition(-scores, k - 1, axis=axis).take(np.arange(k),
+                                                           axis=axis)
+
+
+class TopKCollector(object):
+
+    """ Keeps top-k candidates while rows of a score matrix are added
+        block by block, so the full matrix never needs to exist. """
+
+    def __init__(self, shape, k):
+        self.shape = tuple(shape)
+        self.k = k
+        self.fill_value = np.inf
+        self.rows, self.cols, self.data = [], [], []
+        n_target = self.shape[1]
+        self.col_scores = np.empty((0, n_target))
+        self.col_rows = np.empty((0, n_target), dtype=np.int64)
+
+    def update(self, start, block):
+        block = np.atleast_2d(block)
+        n_rows, n_target = block.shape
+        if n_rows == 0:
+            return
+        if block.size:
+            self.fill_value = min(self.fill_value, block.min())
+
+        # best targets for each source in this block
+        best = _best_k(block, self.k, axis=1)
+        rows = np.repeat(np.arange(n_rows), best.shape[1])
+        cols = best.ravel()
+        self.rows.append(rows + start)
+        self.cols.append(cols)
+        self.data.append(block[rows, cols])
+
+        # merge best sources for each target with previous blocks
+        best = _best_k(block, self.k, axis=0)
+        cols = np.arange(n_target)
+        scores = np.vstack((self.col_scores, block[best, cols]))
+        sources = np.vstack((self.col_rows, best + start))
+        keep = _best_k(scores, self.k, axis=0)
+        self.col_scores = scores[keep, cols]
+        self.col_rows = sources[keep, cols]
+
+    def scores(self):
+        cols = np.tile(np.arange(self.shape[1]), (self.col_rows.shape[0], 1))
+        rows = np.concatenate(self.rows + [self.col_rows.ravel()])
+        cols = np.concatenate(self.cols + [cols.ravel()])
+        data = np.concatenate(self.data + [self.col_scores.ravel()])
+        keys, first = np.unique(rows * self.shape[1] + cols, return_index=True)
+        fill_value = self.fill_value if np.isfinite(self.fill_value) else 0.
+        return TopKScores(self.shape, keys // self.shape[1],
+                          keys % self.shape[1], data[first], fill_value)
+
+
+def topk(score_matrix, k, block_size=1000):
+    """ Reduces a dense score matrix to its top-k candidates """
+    collector = TopKCollector(score_matrix.shape, k)
+    for start in xrange(0, score_matrix.shape[0], block_size):
+        collector.update(start, score_matrix[start:start + block_size])
+    return collector.scores()
+
+
+def densify(scores):
+    if not isinstance(scores, TopKScores):
+        return scores
+    m = np.empty(scores.shape)
+    m.fill(scores.fill_value)
+    m[scores.row, scores.col] = scores.data
+    return m
+
+
+def lookup(scores, row, col):
+    """ Values of scores at (row, col), fill_value where not stored """
+    if not isinstance(scores, TopKScores):
+        return scores[row, col]
+    n_target = scores.shape[1]
+    keys = scores.row * n_target + scores.col  # sorted by construction
+    query = np.asarray(row) * n_target + np.asarray(col)
+    pos = np.searchsorted(keys, query).clip(0, max(len(keys) - 1, 0))
+    values = np.empty(query.shape)
+    values.fill(scores.fill_value)
+    if len(keys):
+        found = keys[pos] == query
+        values[found] = scores.data[pos[found]]
+    return values
+
+
+def candidates(features):
+    """ Union of candidate pairs over all sparse features.
+        Returns rows, columns and an (n_pairs, n_features) matrix. """
+    shape = features[0].shape
+    keys = np.unique(np.concatenate(
+        [f.row * shape[1] + f.col for f in features]))
+    rows, cols = keys // shape[1], keys % shape[1]
+    m = np.zeros((len(keys), len(features)), dtype=np.float64)
+    for f_idx, f in enumerate(features):
+        assert f.shape == shape
+        m[:, f_idx] = lookup(f, rows, cols)
+    return rows, cols, m
+
+
+def submatrix(scores, rows, cols):
+    """ Dense scores[rows][:, cols] without densifying everything """
+    if not isinstance(scores, TopKScores):
+        return scores[rows][:, cols]
+    row2pos = np.empty(scores.shape[0], dtype=np.int64)
+    row2pos.fill(-1)
+    row2pos[rows] = np.arange(len(rows))
+    col2pos = np.empty(scores.shape[1], dtype=np.int64)
+    col2pos.fill(-1)
+    col2pos[cols] = np.arange(len(cols))
+    m = np.empty((len(rows), len(cols)))
+    m.fill(scores.fill_value)
+    r, c = row2pos[scores.row], col2pos[scores.col]
+    inside = (r >= 0) & (c >= 0)
+    m[r[inside], c[inside]] = scores.data[inside]
+    return m
+
+
+def save_scores(fh, scores):
+    if isinstance(scores, TopKScores):
+        np.savez(fh, shape=np.array(scores.shape), row=scores.row,
+                 col=scores.col, data=scores.data,
+                 fill_value=np.array(scores.fill_value))
+    else:
+        np.save(fh, scores)
+
+
+def load_scores(fh):
+    """ Reads a dense .npy matrix or TopKScores, optionally gzipped """
+    if fh.name.endswith('.gz'):
+        fh = gzip.GzipFile(fileobj=fh, mode='r')
+    m = np.load(fh)
+    if hasattr(m, 'files'):
+        assert 'row' in m.files, "unexpected npz file: %s" % (m.files)
+        return TopKScores(tuple(m['shape']), m['row'], m['col'], m['data'],
+                          float(m['fill_value']))
+    return m
@@ -76,7 +76,8 @@ if __name__ == "__main__":
 
         tgt, fm = npzfile['targets'], npzfile['feature_matrix']
         print "target size: ", tgt.shape
-        print "positive examples: ", sum(sum(tgt))
+        # targets are n_source x n_target or, for top-k candidates, flat
+        print "positive examples: ", tgt.sum()
         tgt = tgt.reshape(tgt.size)
         if args.smote:
             ratio = float(np.count_nonzero(tgt == 0)) / \
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import gzip
+import heapq
+import json
+import multiprocessing
+import os
+from operator import itemgetter
+import shutil
+import sys
+import tempfile
+
+from metadatabase import read_cdx
+from value_codec import ValueCodec, dict_key
+
+""" Parallel version of
+
+    zcat cdx-*.gz | metadatabase.py --cdx CRAWL cdx | insertkv DB
+
+    Cdx files are parsed in a process pool. Entries are split into key
+    ranges and written as sorted runs, then the runs of each range are
+    merged. The output, part-00000.kv.gz, part-00001.kv.gz, ..., is sorted
+    as a whole, so
+
+    zcat OUTDIR/part-*.kv.gz | insertkv DB
+
+    only ever appends and RocksDB has no overlapping files to compact.
+
+    If a key occurs more than once, the entries keep their cdx order (cdx
+    files in the order given, then line order), so as with the serial
+    pipeline the last one wins in insertkv. """
+
+_codec = None
+
+
+def _init_worker(warc_paths):
+    global _codec
+    if warc_paths:
+        _codec = load_codec(warc_paths)
+
+
+def load_codec(warc_paths):
+    open_paths = gzip.open if warc_paths.endswith('.gz') else open
+    with open_paths(warc_paths) as paths_file:
+        return ValueCodec.from_paths(paths_file)
+
+
+def open_cdx(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename)
+
+
+def read_kv(filename, max_lines=None):
+    """ (key, value) pairs of a cdx file """
+    dumps = _codec.dumps if _codec is not None else json.dumps
+    with open_cdx(filename) as cdx:
+        if max_lines is not None:
+            cdx = (line for linenr, line in enumerate(cdx)
+                   if linenr < max_lines)
+        for key, valuedict in read_cdx(None, cdx):
+            if key is None or valuedict is None:
+                continue
+            yield key, dumps(valuedict)
+
+
+def sample_keys(filename_max_lines):
+    filename, max_lines = filename_max_lines
+    return [key for key, value in read_kv(filename, max_lines)]
+
+
+def write_run(tmpdir, partition, entries):
+    """ Writes (key, value) pairs sorted by key, entries with the same key
+        stay in cdx order. Returns the filename """
+    entries.sort(key=itemgetter(0))
+    fd, filename = tempfile.mkstemp(
+        dir=os.path.join(tmpdir, "%05d" % partition), suffix=".gz")
+    with gzip.GzipFile(fileobj=os.fdopen(fd, 'wb'), compresslevel=1) as run:
+        for key, value in entries:
+            run.write("%s\t%s\n" % (key, value))
+    return filename
+
+
+def process_shard(args):
+    """ Splits the entries of one cdx file by key range into sorted runs of
+        at most run_size entries. Returns [(partition, (shard, run number,
+        run file)), ...]; the run number keeps the cdx order of a shard. """
+    shard, filename, boundaries, tmpdir, run_size = args
+    buckets = [[] for _ in range(len(boundaries) + 1)]
+    n_buffered = 0
+    runs = []
+    for key, value in read_kv(filename):
+        buckets[bisect.bisect_right(boundaries, key)].append((key, value))
+        n_buffered += 1
+        if n_buffered >= run_size:
+            for partition, entries in enumerate(buckets):
+                if entries:
+                    runs.append((partition, (
+                        shard, len(runs),
+                        write_run(tmpdir, partition, entries))))
+            buckets = [[] for _ in range(len(boundaries) + 1)]
+            n_buffered = 0
+    for partition, entries in enumerate(buckets):
+        if entries:
+            runs.append((partition, (shard, len(runs),
+                                     write_run(tmpdir, partition, entries))))
+    sys.stderr.write("Done with %s\n" % filename)
+    return runs
+
+
+def read_run(shard, run_number, filename):
+    """ Lines of a run with (key, shard, run number, line number) in front
+        for merging, as heapq.merge has no key argument in Python 2 """
+    with gzip.open(filename) as run:
+        for linenr, line in enumerate(run):
+            yield line.split('\t', 1)[0], shard, run_number, linenr, line
+
+
+def merge_partition(args):
+    """ Merges the runs of one key range into outfile. Equal keys stay in
+        cdx order. """
+    outfile, runs = args
+    n_lines = 0
+    with gzip.open(outfile, 'wb', 1) as out:
+        for entry in heapq.merge(*[read_run(*run) for run in runs]):
+            out.write(entry[-1])
+            n_lines += 1
+    for _shard, _run_number, filename in runs:
+        os.remove(filename)
+    return n_lines
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outdir', help='directory for part-*.kv.gz')
+    parser.add_argument('cdx', nargs='+', help='cdx files, e.g. cdx-00000.gz')
+    parser.add_argument('-crawl', help='crawl id for --binary, e.g. 2015_40')
+    parser.add_argument('-processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of processes, default: all cores')
+    parser.add_argument('-partitions', type=int, default=64,
+                        help='number of key ranges')
+    parser.add_argument('-sample', type=int, default=2000,
+                        help='lines per cdx file to estimate key ranges')
+    parser.add_argument('-run_size', type=int, default=500000,
+                        help='entries per sorted run')
+    parser.add_argument('-tmpdir', help='directory for sorted runs',
+                        default=None)
+    parser.add_argument('--binary', action='store_true',
+                        help='write compact binary values, see value_codec')
+    parser.add_argument('--warc_paths',
+                        help='warc.paths(.gz) of the crawl, needed for '
+                        '--binary')
+    args = parser.parse_args(sys.argv[1:])
+
+    warc_paths = None
+    if args.binary:
+        assert args.warc_paths and args.crawl, \
+            "--binary needs --warc_paths and -crawl"
+        warc_paths = args.warc_paths
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir or args.outdir)
+    for partition in range(args.partitions):
+        os.mkdir(os.path.join(tmpdir, "%05d" % partition))
+
+    pool = multiprocessing.Pool(processes=args.processes,
+                                initializer=_init_worker,
+                                initargs=(warc_paths,))
+
+    # key ranges with about the same number of entries each
+    sample = []
+    for keys in pool.imap_unordered(
+            sample_keys, [(f, args.sample) for f in args.cdx]):
+        sample.extend(keys)
+    sample.sort()
+    boundaries = [sample[len(sample) * i // args.partitions]
+                  for i in range(1, args.partitions)] if sample else []
+    sys.stderr.write("Sampled %d keys\n" % len(sample))
+
+    runs = [[] for _ in range(len(boundaries) + 1)]
+    for shard_runs in pool.imap_unordered(
+            process_shard,
+            [(shard, f, boundaries, tmpdir, args.run_size)
+             for shard, f in enumerate(args.cdx)]):
+        for partition, run in shard_runs:
+            runs[partition].append(run)
+
+    outfiles = [os.path.join(args.outdir, "part-%05d.kv.gz" % partition)
+                for partition in range(len(runs))]
+    n_lines = sum(pool.imap(merge_partition, zip(outfiles, runs)))
+    pool.close()
+    pool.join()
+    shutil.rmtree(tmpdir)
+
+    if args.binary:
+        # '~' keys sort last
+        outfile = os.path.join(args.outdir,
+                               "part-%05d.kv.gz" % len(outfiles))
+        with gzip.open(outfile, 'wb') as out:
+            out.write("%s\t%s\n" % (dict_key(args.crawl),
+                                    load_codec(warc_paths).dict_value()))
+    sys.stderr.write("Wrote %d entries to %s\n" % (n_lines, args.outdir))
@@ -3,6 +3,8 @@
 import sys
 import rocksdb
 
+from value_codec import is_meta_key
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -21,5 +23,7 @@ if __name__ == "__main__":
     it = db.iterkeys()
     it.seek_to_first()
     for key in it:
+        if is_meta_key(key):
+            continue
         tld, url, crawl = key.split(" ", 2)
         args.outfile.write(url + "\n")
@@ -19,10 +19,7 @@ DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )
 
 if [ ! -f ${OUTFILE/.xz/.done} ]; then
   curl -s --retry 5 $1 | \
-  gzip -cd | \
-  ${DIR}/links_from_wat.py -nolinks | \
-  sort -t" " -S500M -k1,1 --compress-program=pigz --temporary-directory=${TMPDIR} --parallel=2 | \
-  uniq | \
+  ${DIR}/links_from_wat.py -nolinks -unzip_processes 2 -sort -tmpdir ${TMPDIR} | \
   /home/buck/net/build/pxz/pxz -T 2 -9 -e \
   > ${OUTFILE}
   touch ${OUTFILE/.xz/.done}
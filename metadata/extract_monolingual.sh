@@ -6,8 +6,8 @@ set -o pipefail
 FILENAME=$(echo $1 | awk ' BEGIN { FS = "/" } { print $(NF-2) "/" $(NF)}')
 
 if [ ! -f ${FILENAME}.done ]; then
-  curl -s $1 | gzip -cd | \
-  /fs/nas/heithrun0/commoncrawl/langsplit/bin/read_wet.py | \
+  curl -s $1 | \
+  /fs/nas/heithrun0/commoncrawl/langsplit/bin/read_wet.py -unzip_processes 2 | \
   /fs/nas/heithrun0/commoncrawl/langsplit/bin/langsplit --printchunks 2> /dev/null | \
   xz -9 -e > ${FILENAME}.langsplit.xz
   touch ${FILENAME}.done
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+import multiprocessing
+import sys
+import urllib2
+import zlib
+
+# Parallel decompression of multi-member gzip files.
+#
+# CommonCrawl WARC/WAT/WET files are concatenations of independent gzip
+# members, one per record. The compressed stream is cut into chunks at
+# member boundaries and the chunks are inflated by a pool of processes,
+# results are handed out in input order. Boundaries are found by looking
+# for the gzip magic bytes and checking that a complete member, including
+# its CRC, starts there. Plain gzip files with a single member are
+# decompressed in this process.
+
+GZIP_MAGIC = "\x1f\x8b\x08"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+WINDOW = 64 * 1024  # bytes fed to zlib at a time
+
+
+def _inflate_pieces(blocks):
+    """ Yields decompressed data of all members in compressed blocks """
+    decompressor = None
+    for block in blocks:
+        # small pieces, so unused_data stays small
+        for pos in xrange(0, len(block), WINDOW):
+            piece = block[pos:pos + WINDOW]
+            while piece:
+                if decompressor is None:
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                yield decompressor.decompress(piece)
+                # after the end of a member the rest shows up here
+                piece = decompressor.unused_data
+                if piece:
+                    yield decompressor.flush()
+                    decompressor = None
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def inflate(data):
+    """ Decompresses a string of complete gzip members """
+    return "".join(_inflate_pieces([data]))
+
+
+def is_member_start(data, pos):
+    """ True if a gzip member starts at pos and ends within data, None if
+        it does not end within data """
+    if data[pos:pos + 3] != GZIP_MAGIC:
+        return False
+    flags = data[pos + 3:pos + 4]
+    if not flags:
+        return None
+    if ord(flags) & 0xe0:  # reserved flags
+        return False
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        for start in xrange(pos, len(data), WINDOW):
+            decompressor.decompress(data[start:start + WINDOW])
+            if decompressor.unused_data:
+                return True
+    except zlib.error:
+        return False
+    return None
+
+
+class MemberReader(object):
+
+    """ Decompressed contents of a gzip stream as file-like object, for
+        read(size) or iteration over lines, not both. Data that does not
+        start like a gzip file is passed through unchanged. """
+
+    def __init__(self, infile, processes=4, chunk_size=4 * 1024 * 1024,
+                 max_chunk=64 * 1024 * 1024):
+        self.infile = infile
+        self.processes = processes
+        self.chunk_size = chunk_size
+        # no member boundary within this many bytes: decompress serially
+        self.max_chunk = max_chunk
+        self._head = infile.read(len(GZIP_MAGIC))
+        self.compressed = self._head == GZIP_MAGIC
+        self._rest = ""
+        self._blocks = self._decompressed_blocks()
+        self._buf, self._pos = "", 0
+
+    def _raw(self):
+        yield self._head
+        while True:
+            block = self.infile.read(self.chunk_size)
+            if not block:
+                break
+            yield block
+
+    def _chunks(self):
+        """ Compressed data cut at member boundaries. Leaves the data
+            in self._rest if no boundary could be found. """
+        buf, start = "", 1
+        for block in self._raw():
+            buf += block
+            while len(buf) >= self.chunk_size:
+                pos = buf.find(GZIP_MAGIC, max(start, self.chunk_size // 2))
+                if pos < 0:
+                    start = len(buf) - len(GZIP_MAGIC) + 1
+                    break
+                found = is_member_start(buf, pos)
+                if found is None:  # member continues beyond buf
+                    start = pos
+                    break
+                if not found:
+                    start = pos + 1
+                    continue
+                yield buf[:pos]
+                buf, start = buf[pos:], 1
+            if len(buf) > self.max_chunk:
+                self._rest = buf
+                return
+        if buf:
+            yield buf
+
+    def _decompressed_blocks(self):
+        if not self.compressed:
+            for block in self._raw():
+                yield block
+            return
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+            pending = collections.deque()
+            try:
+                for chunk in self._chunks():
+                    pending.append(pool.apply_async(inflate, (chunk,)))
+                    if len(pending) > 2 * self.processes:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+            finally:
+                pool.terminate()
+            if not self._rest:
+                return
+            sys.stderr.write("No gzip member boundary found in %d bytes, "
+                             "decompressing serially\n" % len(self._rest))
+            raw = self._raw()
+            next(raw)  # the head is part of self._rest
+        else:
+            raw = self._raw()
+        for block in _inflate_pieces(itertools.chain([self._rest], raw)):
+            if block:
+                yield block
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) - self._pos < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buf = self._buf[self._pos:] + block
+            self._pos = 0
+        if size < 0:
+            size = len(self._buf) - self._pos
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def __iter__(self):
+        rest = ""
+        for block in self._blocks:
+            lines = (rest + block).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if rest:
+            yield rest
+
+
+def open_input(filename, processes=4):
+    """ MemberReader for a local file, a http(s) url or '-' for stdin """
+    if filename == '-':
+        infile = sys.stdin
+    elif filename.startswith("http://") or filename.startswith("https://"):
+        infile = urllib2.urlopen(filename)
+    else:
+        infile = open(filename, 'rb')
+    return MemberReader(infile, processes)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Decompresses a multi-member gzip file in parallel, '
+        'like gzip -cd')
+    parser.add_argument('infile', nargs='?', default='-',
+                        help='file or url, default: stdin')
+    parser.add_argument('-processes', type=int, default=4)
+    args = parser.parse_args(sys.argv[1:])
+
+    reader = open_input(args.infile, args.processes)
+    while True:
+        data = reader.read(16 * 1024 * 1024)
+        if not data:
+            break
+        sys.stdout.write(data)
@@ -3,18 +3,37 @@
 import sys
 import leveldb
 
+from value_codec import ValueCodec, dict_key, is_meta_key
+
 if __name__ == "__main__":
     errors = 0
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument('db', help='leveldb root directory')
+    parser.add_argument('-update', action='store_true',
+                        help='merge values into existing ones, like '
+                        'updatekv but also for binary values')
     args = parser.parse_args(sys.argv[1:])
 
     db = leveldb.LevelDB(args.db)
+    codecs = {}
 
     for line in sys.stdin:
         k, v = line.rstrip().split("\t", 1)
+        if args.update and not is_meta_key(k):
+            crawl = k.rsplit(" ", 1)[-1]
+            if crawl not in codecs:
+                try:
+                    codecs[crawl] = ValueCodec.from_dict_value(
+                        db.Get(dict_key(crawl)))
+                except KeyError:
+                    codecs[crawl] = ValueCodec()
+            try:
+                v = codecs[crawl].merge(v, db.Get(k))
+            except KeyError:  # like updatekv, only update existing keys
+                sys.stderr.write("Not found: %s\n" % k)
+                continue
         db.Put(k, v)
 
     sys.stderr.write("%s" % db.GetStats())
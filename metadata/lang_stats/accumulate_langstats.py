@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import sys
-from collections import defaultdict
 from math import log
 
+from accumulator import LanguageStats
+
 """ Collect language distribution per domain
     from language splitting output """
 
@@ -42,9 +43,12 @@ if __name__ == "__main__":
                         help="ignore chunks smaller than this.")
     parser.add_argument('-lang', nargs='*',
                         help="Ignore all other languages but these.")
+    parser.add_argument('-binary', action='store_true',
+                        help="write mergeable statistics, "
+                        "see accumulator.py")
     args = parser.parse_args(sys.argv[1:])
 
-    stats = defaultdict(lambda: defaultdict(int))
+    stats = LanguageStats()
 
     header = None
     full_domain = None
@@ -61,16 +65,20 @@ if __name__ == "__main__":
 
         if header["bytes"] >= args.minbytes:
             hostname = netloc(header["uri"])
-            stats[hostname][lang] += header["bytes"]
-
-for domain in stats:
-    h = entropy(stats[domain])
-    if h == 0.0:
-        continue
-    sys.stdout.write("%f %s" % (h, domain))
-    counts = [(count, language)
-              for language, count in stats[domain].iteritems()]
-    counts.sort(reverse=True)
-    for count, lang in counts:
-        sys.stdout.write(" %s %d" % (lang, count))
-    sys.stdout.write("\n")
+            stats.add(hostname, lang, header["bytes"])
+
+    if args.binary:
+        stats.write(sys.stdout)
+        sys.exit()
+
+    for domain, lang_dist in stats.iteritems():
+        h = entropy(lang_dist)
+        if h == 0.0:
+            continue
+        sys.stdout.write("%f %s" % (h, domain))
+        counts = [(count, language)
+                  for language, count in lang_dist.iteritems()]
+        counts.sort(reverse=True)
+        for count, lang in counts:
+            sys.stdout.write(" %s %d" % (lang, count))
+        sys.stdout.write("\n")
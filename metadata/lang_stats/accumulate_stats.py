@@ -2,10 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import sys
-from collections import defaultdict
-import gzip
 from math import log
 
+from accumulator import LanguageStats
+
 magic_number = 'df6fa1abb58549287111ba8d776733e9'
 
 
@@ -49,9 +49,12 @@ if __name__ == "__main__":
                         help="ignore chunks smaller than this.")
     parser.add_argument('-lang', nargs='*',
                         help="Ignore all other languages but these.")
+    parser.add_argument('-binary', action='store_true',
+                        help="write mergeable statistics, "
+                        "see accumulator.py")
     args = parser.parse_args(sys.argv[1:])
 
-    stats = defaultdict(lambda: defaultdict(int))
+    stats = LanguageStats()
 
     header = None
     full_domain = None
@@ -77,19 +80,23 @@ if __name__ == "__main__":
 
         bytes_in_lang = header["bytes"] * percent / 100
         if bytes_in_lang >= args.minbytes:
-            stats[full_domain][lang] += bytes_in_lang
+            stats.add(full_domain, lang, bytes_in_lang)
             # print full_domain, lang, bytes_in_lang
 
 # del lang # fix pyflakes warning
 
-for domain in stats:
-    h = entropy(stats[domain])
-    if h == 0.0:
-        continue
-    sys.stdout.write("%f %s" % (h, domain))
-    counts = [(count, language)
-              for language, count in stats[domain].iteritems()]
-    counts.sort(reverse=True)
-    for count, lang in counts:
-        sys.stdout.write(" %s %d" % (lang, count))
-    sys.stdout.write("\n")
+    if args.binary:
+        stats.write(sys.stdout)
+        sys.exit()
+
+    for domain, lang_dist in stats.iteritems():
+        h = entropy(lang_dist)
+        if h == 0.0:
+            continue
+        sys.stdout.write("%f %s" % (h, domain))
+        counts = [(count, language)
+                  for language, count in lang_dist.iteritems()]
+        counts.sort(reverse=True)
+        for count, lang in counts:
+            sys.stdout.write(" %s %d" % (lang, count))
+        sys.stdout.write("\n")
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+""" Mergeable language statistics per domain
+
+    Languages are interned, each domain holds an array of language ids
+    and an array of byte counts, which is a lot smaller than a dict of
+    dicts. Statistics of different shards can be merged in any order, so
+    per-WET outputs can be reduced in a tree:
+
+    accumulate_langstats.py -binary < x.langsplit > x.stats
+    accumulator.py -processes 16 all.stats shards/*.stats
+    join_stats.py all.stats
+
+    File format, little endian: magic, version, number of languages,
+    the languages as length prefixed strings, number of domains, then
+    per domain, sorted by domain: domain length, number of languages,
+    the domain and the (language id, bytes) pairs.
+"""
+
+MAGIC = "LSTA"
+VERSION = 2
+HEADER = struct.Struct("<4sBI")  # magic, version, number of languages
+LANGUAGE_LENGTH = struct.Struct("<B")
+COUNT = struct.Struct("<I")
+DOMAIN_HEADER = struct.Struct("<HH")  # domain length, number of pairs
+
+# array has no 'Q' in Python 2, 'L' is 64 bit on the platforms we run on
+COUNT_TYPE = 'L'
+
+_pair_structs = {}
+
+
+def _pairs(n):
+    """ Struct for n (language id, bytes) pairs """
+    if n not in _pair_structs:
+        _pair_structs[n] = struct.Struct("<" + "HQ" * n)
+    return _pair_structs[n]
+
+
+def open_stats(filename, mode='rb'):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def peek_magic(f):
+    """ Reads the first bytes of f without seeking, so pipes work too.
+        Returns (True if f is a binary stats file, the bytes read). """
+    head = f.read(len(MAGIC))
+    return head == MAGIC, head
+
+
+class LanguageStats(object):
+
+    def __init__(self):
+        self.languages = []
+        self.lang_ids = {}
+        self.domains = {}
+
+    def __len__(self):
+        return len(self.domains)
+
+    def lang_id(self, lang):
+        lang_id = self.lang_ids.get(lang)
+        if lang_id is None:
+            lang_id = self.lang_ids[lang] = len(self.languages)
+            self.languages.append(lang)
+        return lang_id
+
+    def add(self, domain, lang, n_bytes):
+        self._add(domain, self.lang_id(lang), n_bytes)
+
+    def _add(self, domain, lang_id, n_bytes):
+        entry = self.domains.get(domain)
+        if entry is None:
+            self.domains[domain] = (array('H', (lang_id,)),
+                                    array(COUNT_TYPE, (n_bytes,)))
+            return
+        ids, counts = entry
+        for pos, other_id in enumerate(ids):
+            if other_id == lang_id:
+                counts[pos] += n_bytes
+                return
+        ids.append(lang_id)
+        counts.append(n_bytes)
+
+    def merge(self, other):
+        """ Adds the counts of other """
+        id_map = [self.lang_id(lang) for lang in other.languages]
+        same_ids = id_map == range(len(id_map))
+        domains = self.domains
+        for domain, (ids, counts) in other.domains.iteritems():
+            if domain not in domains:
+                if not same_ids:
+                    ids = (id_map[lang_id] for lang_id in ids)
+                domains[domain] = (array('H', ids), array(COUNT_TYPE, counts))
+                continue
+            for lang_id, n_bytes in zip(ids, counts):
+                self._add(domain, id_map[lang_id], n_bytes)
+        return self
+
+    def counts(self, domain):
+        """ {language: bytes} of a domain """
+        ids, counts = self.domains.get(domain, ((), ()))
+        return dict((self.languages[lang_id], n_bytes)
+                    for lang_id, n_bytes in zip(ids, counts))
+
+    def iteritems(self):
+        """ (domain, {language: bytes}) sorted by domain """
+        for domain in sorted(self.domains):
+            yield domain, self.counts(domain)
+
+    def write(self, outfile):
+        outfile.write(HEADER.pack(MAGIC, VERSION, len(self.languages)))
+        for lang in self.languages:
+            outfile.write(LANGUAGE_LENGTH.pack(len(lang)) + lang)
+        outfile.write(COUNT.pack(len(self.domains)))
+        for domain in sorted(self.domains):
+            ids, counts = self.domains[domain]
+            pairs = [None] * (2 * len(ids))
+            pairs[::2] = ids
+            pairs[1::2] = counts
+            outfile.write(DOMAIN_HEADER.pack(len(domain), len(ids)))
+            outfile.write(domain)
+            outfile.write(_pairs(len(ids)).pack(*pairs))
+
+    @classmethod
+    def read(cls, infile, head=""):
+        """ head: bytes already read from infile, see peek_magic """
+        buf = head + infile.read()
+        magic, version, n_languages = HEADER.unpack_from(buf)
+        assert magic == MAGIC, "Not a language stats file"
+        assert version == VERSION, "Unknown version %d" % version
+        stats = cls()
+        pos = HEADER.size
+        for _ in xrange(n_languages):
+            length = ord(buf[pos])
+            stats.lang_id(buf[pos + 1:pos + 1 + length])
+            pos += 1 + length
+        n_domains, = COUNT.unpack_from(buf, pos)
+        pos += COUNT.size
+        for _ in xrange(n_domains):
+            length, n_pairs = DOMAIN_HEADER.unpack_from(buf, pos)
+            pos += DOMAIN_HEADER.size
+            domain = buf[pos:pos + length]
+            pos += length
+            pairs = _pairs(n_pairs)
+            values = pairs.unpack_from(buf, pos)
+            stats.domains[domain] = (array('H', values[::2]),
+                                     array(COUNT_TYPE, values[1::2]))
+            pos += pairs.size
+        return stats
+
+    @classmethod
+    def load(cls, filenames):
+        """ Merged statistics of several files """
+        stats = cls()
+        for filename in filenames:
+            with open_stats(filename) as infile:
+                shard = cls.read(infile)
+            if not stats.domains:
+                stats = shard
+            else:
+                stats.merge(shard)
+        return stats
+
+
+def merge_files(args):
+    """ Merges filenames into a temporary file in tmpdir """
+    filenames, tmpdir = args
+    stats = LanguageStats.load(filenames)
+    fd, filename = tempfile.mkstemp(dir=tmpdir, suffix=".stats")
+    with os.fdopen(fd, 'wb') as outfile:
+        stats.write(outfile)
+    return filename
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Merges binary language statistics in a tree')
+    parser.add_argument('outfile', help='merged statistics')
+    parser.add_argument('infiles', nargs='+',
+                        help='statistics written with -binary')
+    parser.add_argument('-processes', type=int, default=1)
+    parser.add_argument('-fanin', type=int, default=16,
+                        help='number of files merged at once')
+    parser.add_argument('-tmpdir', help='directory for temporary files')
+    args = parser.parse_args(sys.argv[1:])
+    if args.fanin < 2:
+        parser.error("-fanin needs to be at least 2")
+
+    filenames, temporary = args.infiles, []
+    pool = multiprocessing.Pool(args.processes)
+    while len(filenames) > args.fanin:
+        groups = [(filenames[start:start + args.fanin], args.tmpdir)
+                  for start in xrange(0, len(filenames), args.fanin)]
+        sys.stderr.write("Merging %d files into %d\n"
+                         % (len(filenames), len(groups)))
+        filenames = pool.map(merge_files, groups)
+        for filename in temporary:
+            os.remove(filename)
+        temporary = filenames
+    pool.close()
+
+    stats = LanguageStats.load(filenames)
+    with open_stats(args.outfile, 'wb') as outfile:
+        stats.write(outfile)
+    for filename in temporary:
+        os.remove(filename)
+    sys.stderr.write("Wrote %d domains in %d languages\n"
+                     % (len(stats), len(stats.languages)))
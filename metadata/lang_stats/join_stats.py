@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import sys
-from collections import defaultdict
-from itertools import izip
+from cStringIO import StringIO
+from itertools import chain, izip
 from math import log
 
+from accumulator import LanguageStats, peek_magic
+
 """ join language stat files together, possibly
     filtering by langauge
 
@@ -20,6 +22,7 @@ from math import log
     Example:
     -0.000089 www.hammockforums.net en 22430509 da 155
 
+    or binary statistics written with -binary, see accumulator.py.
     Output is in the same format
 """
 
@@ -43,6 +46,25 @@ def entropy(lang_dist):
     return h
 
 
+def read_entries(f):
+    """ (domain, [language, bytes, ...]) from a text or binary file """
+    is_binary, head = peek_magic(f)
+    if is_binary:
+        for domain, lang_dist in LanguageStats.read(f, head).iteritems():
+            data = []
+            for l, b in lang_dist.iteritems():
+                data.extend((l, b))
+            yield domain, data
+        return
+    # put the peeked bytes back in front of the first line
+    for line in chain(StringIO(head + f.readline()), f):
+        data = line.split()
+        if len(data) % 2 == 0:  # Line contrains entropy in first column
+            _entropty = data.pop(0)
+        domain = data.pop(0)
+        yield domain, data
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -55,20 +77,18 @@ if __name__ == "__main__":
                         help='filter monolingual entries')
     parser.add_argument('-total', action='store_true',
                         help='ignore domains')
+    parser.add_argument('-binary', action='store_true',
+                        help='write mergeable statistics')
     args = parser.parse_args()
 
     valid_languages = None
     if args.lang:
         valid_languages = [l.lower() for l in args.lang]
 
-    stats = defaultdict(lambda: defaultdict(int))
+    stats = LanguageStats()
 
     for f in args.infiles:
-        for line in f:
-            data = line.split()
-            if len(data) % 2 == 0:  # Line contrains entropy in first column
-                _entropty = data.pop(0)
-            domain = data.pop(0)
+        for domain, data in read_entries(f):
             domain = domain.split('?')[0]
             if args.total:
                 domain = "TOTAL"
@@ -78,21 +98,25 @@ if __name__ == "__main__":
                     l = "xx"
                 if valid_languages and l not in valid_languages:
                     continue
-                stats[domain][l] += int(b)
+                stats.add(domain, l, int(b))
+
+    if args.binary:
+        stats.write(sys.stdout)
+        sys.exit()
 
-    for domain in stats:
-        if args.nomono and len(stats[domain]) == 1:
+    for domain, lang_dist in stats.iteritems():
+        if args.nomono and len(lang_dist) == 1:
             continue
-        e = entropy(stats[domain])
+        e = entropy(lang_dist)
         if args.total:
             crawl = args.infiles[0].name.split('.')[0]
             sys.stdout.write("%s\t%s\n" % (crawl, crawl))
-            for language in sorted(stats[domain].keys()):
+            for language in sorted(lang_dist.keys()):
                 sys.stdout.write(
-                    "%s\t%d\n" % (language, stats[domain][language]))
+                    "%s\t%d\n" % (language, lang_dist[language]))
         else:
             sys.stdout.write("%f %s" % (e, domain))
-            for language in stats[domain]:
+            for language in lang_dist:
                 sys.stdout.write(
-                    " %s %d" % (language, stats[domain][language]))
+                    " %s %d" % (language, lang_dist[language]))
             sys.stdout.write("\n")
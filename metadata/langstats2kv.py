@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 from collections import defaultdict
 from metadatabase import make_key
+from value_codec import ValueCodec
 import json
 
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from baseline.external_sort import sort_lines
+
 magic_number = 'df6fa1abb58549287111ba8d776733e9'
 
 
@@ -24,12 +29,27 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('crawl', help='crawl format YYYY_WW, e.g. 2015_22')
+    parser.add_argument('-binary', action='store_true',
+                        help='write compact binary values, see value_codec')
+    parser.add_argument('-sort', action='store_true',
+                        help='sort input first instead of expecting it '
+                        'grouped by uri')
+    parser.add_argument('-sort_memory', type=int, default=500,
+                        help='memory for sorting in MB')
+    parser.add_argument('-tmpdir', help='directory for temporary files')
     args = parser.parse_args(sys.argv[1:])
 
+    dumps = ValueCodec().dumps if args.binary else json.dumps
+
     stats = defaultdict(int)
     url = None
 
-    for linenr, line in enumerate(sys.stdin):
+    lines = sys.stdin
+    if args.sort:
+        lines = sort_lines((line for line in lines
+                            if line.startswith(magic_number)),
+                           args.sort_memory * 1024 * 1024, args.tmpdir)
+    for linenr, line in enumerate(lines):
         if not line.startswith(magic_number):
             continue
         line = parse_line(line)
@@ -43,7 +63,7 @@ if __name__ == "__main__":
                 continue
             sys.stdout.write("%s\t%s\n" % (
                 key,
-                json.dumps({"languages": stats.items()})))
+                dumps({"languages": stats.items()})))
             stats = defaultdict(int)
         url = line['uri']
         stats[line['language']] += int(line['bytes'])
@@ -53,6 +73,6 @@ if __name__ == "__main__":
             key = make_key(url, args.crawl)
             sys.stdout.write("%s\t%s\n" % (
                 key,
-                json.dumps({"languages": stats.items()})))
+                dumps({"languages": stats.items()})))
         except:
             pass
@@ -2,10 +2,26 @@
 # -*- coding: utf-8 -*-
 import sys
 import json
-import tldextract
+import os
+import re
+import time
 from urlparse import urlparse, urlsplit, urlunsplit
 from urllib import quote, quote_plus
 
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from baseline import domains
+from baseline.external_sort import ExternalSorter
+from gzip_members import open_input
+
+# optional faster parsers for complete lines
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = json
+
 
 def is_pdf_link(link):
     if "path" not in link:
@@ -40,33 +56,136 @@ def normalize_whitepace(s):
         res = " ".join(s.split())
     return res
 
+def read_record(line, with_links=True, loads=json.loads):
+    """ (container, content type, uri, links) from a WAT line, parsed
+        with loads. Raises ValueError or KeyError for unusable lines. """
+    d = loads(line)
+    payload = d["Envelope"]["Payload-Metadata"]["HTTP-Response-Metadata"]
+    return (d["Container"],
+            payload["Headers"]["Content-Type"],
+            d["Envelope"]["WARC-Header-Metadata"]["WARC-Target-URI"],
+            payload["HTML-Metadata"]["Links"])
+
+
+_decoder = json.JSONDecoder()
+_key_patterns = {}
+
+
+def _value_pos(line, key, pos=0):
+    """ Position of the value of the first "key" after pos """
+    pattern = _key_patterns.get(key)
+    if pattern is None:
+        pattern = _key_patterns[key] = re.compile(
+            r'"%s"\s*:\s*' % re.escape(key))
+    match = pattern.search(line, pos)
+    if match is None:
+        raise KeyError(key)
+    return match.end()
+
+
+def _value_at(line, pos):
+    return _decoder.raw_decode(line, pos)[0]
+
+
+def read_fields(line, with_links=True):
+    """ Same as read_record, but only decodes the values that are used:
+        keys are found in the text, in the order in which they appear in
+        WAT files, and only their values are parsed. Without with_links,
+        links are only checked for and None is returned. """
+    if not line.rstrip().endswith("}"):
+        raise ValueError("Incomplete line")
+    container = _value_at(line, _value_pos(line, "Container"))
+    pos = _value_pos(line, "WARC-Header-Metadata")
+    uri = _value_at(line, _value_pos(line, "WARC-Target-URI", pos))
+    payload = _value_pos(line, "HTTP-Response-Metadata")
+    content_type = _value_at(line, _value_pos(
+        line, "Content-Type", _value_pos(line, "Headers", payload)))
+    pos = _value_pos(line, "Links", _value_pos(line, "HTML-Metadata",
+                                               payload))
+    links = _value_at(line, pos) if with_links else None
+    return container, content_type, uri, links
+
+
+def fast_read_record(line, with_links=True):
+    return read_record(line, with_links, fast_json.loads)
+
+
+def choose_reader(with_links):
+    """ Parsing the whole line is only worth it if the links are used """
+    return fast_read_record if with_links else read_fields
+
+
+def benchmark(lines, with_links):
+    """ Lines per second of the different ways to read lines, compared
+        to read_record with json.loads """
+    expected = None
+    for name, function in (("json.loads", read_record),
+                           ("%s.loads" % fast_json.__name__,
+                            fast_read_record),
+                           ("read_fields", read_fields)):
+        start = time.time()
+        extracted = []
+        for line in lines:
+            try:
+                extracted.append(function(line, with_links))
+            except (KeyError, ValueError):
+                extracted.append(None)
+        sys.stderr.write("%s: %.0f lines/s\n"
+                         % (name, len(lines) / (time.time() - start)))
+        if not with_links:
+            extracted = [r and r[:3] for r in extracted]
+        if expected is None:
+            expected = extracted
+            continue
+        n_diff = sum(1 for a, b in zip(expected, extracted) if a != b)
+        sys.stderr.write("  %d of %d lines differ\n" % (n_diff, len(lines)))
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument('infile', nargs='?', default='-',
+                        help='WAT file or url, .gz or uncompressed, '
+                        'default: stdin')
+    parser.add_argument('-unzip_processes', type=int, default=1,
+                        help='decompress gzip members in parallel')
     parser.add_argument('-nolinks', action='store_true',
                         help='skip link extraction')
     parser.add_argument('-pdf', action='store_true',
                         help='extract only PDF links')
+    parser.add_argument('-full_json', action='store_true',
+                        help='parse complete lines with json.loads')
+    parser.add_argument('-benchmark', action='store_true',
+                        help='compare speed and results of the parsers '
+                        'on the input instead of extracting')
+    parser.add_argument('-sort', action='store_true',
+                        help='sort output and remove repeated lines, '
+                        'like sort | uniq')
+    parser.add_argument('-sort_memory', type=int, default=500,
+                        help='memory for sorting in MB')
+    parser.add_argument('-tmpdir', help='directory for temporary files')
     args = parser.parse_args(sys.argv[1:])
 
-    for line in sys.stdin:
+    with_links = args.pdf or not args.nolinks
+    if args.benchmark:
+        benchmark([line for line in open_input(args.infile,
+                                               args.unzip_processes)
+                   if line.startswith("{")], with_links)
+        sys.exit()
+
+    sorter, write = None, sys.stdout.write
+    if args.sort:
+        sorter = ExternalSorter(args.sort_memory * 1024 * 1024, args.tmpdir,
+                                unique=True)
+        write = sorter.add
+
+    read = read_record if args.full_json else choose_reader(with_links)
+    for line in open_input(args.infile, args.unzip_processes):
         if not line.startswith("{"):
             continue
         try:
-            d = json.loads(line)
-        except ValueError:
-            continue
-
-        uri, links, container, content_type = None, None, None, None
-        try:
-            container = d["Container"]
-            content_type = d["Envelope"]["Payload-Metadata"][
-                "HTTP-Response-Metadata"]["Headers"][
-                "Content-Type"]
-            uri = d["Envelope"]["WARC-Header-Metadata"]["WARC-Target-URI"]
-            links = d["Envelope"]["Payload-Metadata"][
-                "HTTP-Response-Metadata"]["HTML-Metadata"]["Links"]
-        except KeyError:
+            container, content_type, uri, links = read(line, with_links)
+        except (KeyError, ValueError):
             continue
 
         if args.pdf:
@@ -81,7 +200,7 @@ if __name__ == "__main__":
                         text = normalize_whitepace(text)
 
                         output = "%s\t%s\t%s\n" % (uri, url, text)
-                        sys.stdout.write(output)
+                        write(output)
                     except UnicodeDecodeError:
                         continue
 
@@ -91,7 +210,12 @@ if __name__ == "__main__":
         if not args.nolinks:
             res["links"] = links
         try:
-            tld = tldextract.extract(urlparse(uri).netloc)
+            tld = domains.extract(urlparse(uri).netloc)
         except UnicodeError:
             continue
-        print tld.domain.encode("utf8", "ignore"), json.dumps(res)
+        write("%s %s\n" % (tld.domain.encode("utf8", "ignore"),
+                           json.dumps(res)))
+
+    if sorter is not None:
+        for line in sorter:
+            sys.stdout.write(line)
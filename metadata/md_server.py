@@ -1,17 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
 import os
 import sys
 import json
 import urlparse
-import tldextract
 import time
 import cherrypy
 import rocksdb
 from collections import defaultdict
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from baseline import domains
 from baseline.ccdownloader import CCDownloader
+from baseline.record_cache import RecordCache
+from value_codec import ValueCodec, dict_key, CRAWLS_KEY
 
 
 def split_uri(uri, encoding='idna'):
@@ -25,7 +28,7 @@ def split_uri(uri, encoding='idna'):
         parsed_uri = urlparse.urlparse("http://%s" + uri)
     netloc = parsed_uri.netloc
     assert netloc, "Cannot parse uri:%s\n" % uri
-    extracted = tldextract.extract(netloc)
+    extracted = domains.extract(netloc)
     # tld = .domain.encode(encoding)
     # suffix = tldextract.extract(netloc).suffix
     path = "%s" % (parsed_uri.path)
@@ -43,10 +46,15 @@ def json_error(status, message, traceback, version):
 class DBInterface(object):
 
     def __init__(self, db_directories, pretty=False, verbose=0,
-                 max_results=10000):
+                 max_results=10000, cache_dir=None, cache_size=10 * 1024 ** 3):
 
-        self.dbs = {}
-        self.ccdownloader = CCDownloader()
+        self.dbs = {}  # crawl -> db, one db can hold several crawls
+        self.sources = []  # (label, db) for every db
+        self.codecs = {}
+        self.cache = None
+        if cache_dir:
+            self.cache = RecordCache(cache_dir, max_size=cache_size)
+        self.ccdownloader = CCDownloader(cache=self.cache)
 
         for db_directory in db_directories:
             opts = rocksdb.Options()
@@ -54,14 +62,26 @@ class DBInterface(object):
             opts.max_open_files = 100
             opts.num_levels = 6
             db = rocksdb.DB(db_directory, opts, read_only=True)
-            it = db.iterkeys()
-            it.seek_to_first()
-            key = it.next()
-            tld, url, crawl = key.split(" ", 2)
-            assert crawl not in self.dbs, "Multiple dbs for %s\n" % crawl
+            crawls = db.get(CRAWLS_KEY)
+            if crawls is not None:  # built with merge_dbs.py
+                crawls = json.loads(crawls)
+            else:
+                it = db.iterkeys()
+                it.seek_to_first()
+                key = it.next()
+                tld, url, crawl = key.split(" ", 2)
+                crawls = [crawl]
+            for crawl in crawls:
+                assert crawl not in self.dbs, "Multiple dbs for %s\n" % crawl
+                self.dbs[crawl] = db
+                # filename list for binary values, see value_codec
+                filenames = db.get(dict_key(crawl))
+                self.codecs[crawl] = ValueCodec.from_dict_value(filenames) \
+                    if filenames is not None else ValueCodec()
             sys.stderr.write("DB at %s holds crawl %s\n" %
-                             (db_directory, crawl))
-            self.dbs[crawl] = db
+                             (db_directory, ", ".join(crawls)))
+            self.sources.append((",".join(sorted(crawls)), db))
+        self.sources.sort()
 
         self.pretty = pretty
         self.verbose = verbose
@@ -79,6 +99,21 @@ class DBInterface(object):
         result = {"crawls": sorted(self.dbs.keys())}
         return self._dump_json(result, pretty)
 
+    def _relevant_sources(self, query_crawl):
+        """ (label, db) to search; with a multi-crawl db that's one seek for
+            all crawls """
+        if query_crawl:
+            return [(label, db) for label, db in self.sources
+                    if db is self.dbs[query_crawl]]
+        return self.sources
+
+    @cherrypy.expose
+    def cache_stats(self, **kwargs):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        pretty = kwargs.get("pretty", 0) > 0
+        result = self.cache.stats() if self.cache is not None else {}
+        return self._dump_json(result, pretty)
+
     @cherrypy.expose
     def query_prefix(self, **kwargs):
         cherrypy.response.headers['Content-Type'] = 'application/json'
@@ -108,13 +143,10 @@ class DBInterface(object):
 
         n_results = 0
 
-        relevant_crawls = [query_crawl] if query_crawl else self.dbs.keys()
-
         # result["skipped_keys"] = []
         result["locations"] = defaultdict(list)
 
-        for db_crawl in relevant_crawls:
-            db = self.dbs[db_crawl]
+        for _label, db in self._relevant_sources(query_crawl):
             it = db.iteritems()
             it.seek(db_key)
             for key, value in it:
@@ -124,7 +156,8 @@ class DBInterface(object):
                     break
 
                 tld, uri, crawl = key.split(" ", 2)
-                assert crawl == db_crawl
+                if query_crawl and crawl != query_crawl:
+                    continue
 
                 if exact and uri != query_url:
                     continue
@@ -132,17 +165,8 @@ class DBInterface(object):
                 n_results += 1
                 if n_results > max_results:
                     break
-                data = json.loads(value)
-
-                # work around stupid error
-                if 'offset:' in data:
-                    data['offset'] = data.pop('offset:')
-
-                data['offset'] = int(data['offset'])
-                data['length'] = int(data['length'])
-
-                data["crawl"] = db_crawl
-                result["locations"][uri].append(data)
+                result["locations"][uri].append(
+                    self._decode_value(value, crawl))
 
         if verbose:
             result["time"] = "%.2fs" % (time.time() - start_time)
@@ -154,69 +178,256 @@ class DBInterface(object):
 
         return self._dump_json(result, pretty)
 
-    def get_html(self, data):
-        html = self.ccdownloader.download(data["filename"],
-                                          data["offset"],
-                                          data["length"],
-                                          html_only=True)
-        return html
+    def _decode_value(self, value, crawl):
+        data = self.codecs[crawl].decode(value)
+
+        # work around stupid error
+        if 'offset:' in data:
+            data['offset'] = data.pop('offset:')
+
+        data['offset'] = int(data['offset'])
+        data['length'] = int(data['length'])
+
+        data["crawl"] = crawl
+        return data
+
+    def _sweep(self, db, db_keys, max_results, exact_uris=None,
+               query_crawl=None):
+        """ Yields (index, uri, crawl, value) for all entries starting with
+            db_keys[index]. The keys must be sorted so that one iterator
+            only moves forward; it is only repositioned if it's not
+            already at the start of the next key's range. """
+        it = db.iteritems()
+        current = None  # next entry, already read from the iterator
+        prev_key = None
+        for idx, db_key in enumerate(db_keys):
+            if current is None or current[0] < db_key or \
+                    (prev_key is not None and db_key.startswith(prev_key)):
+                it.seek(db_key)
+                current = next(it, None)
+            prev_key = db_key
+            n_results = 0
+            while current is not None and current[0].startswith(db_key):
+                key, value = current
+                tld, uri, crawl = key.decode("utf-8").split(" ", 2)
+                if (exact_uris is None or uri == exact_uris[idx]) and \
+                        (not query_crawl or crawl == query_crawl):
+                    n_results += 1
+                    if n_results > max_results:
+                        # stopped inside the range, seek for the next key
+                        current = None
+                        break
+                    yield idx, uri, crawl, value
+                current = next(it, None)
 
     @cherrypy.expose
-    def query_tld(self, **kwargs):
-        cherrypy.response.headers['Content-Type'] = 'application/json'
-        start_time = time.time()
-        query_tld = kwargs["tld"]
+    def query_batch(self, **kwargs):
+        """ Like query_prefix for many urls at once: POST them as JSON list
+            or one per line. Returns one JSON object per line and url,
+            ordered by db key, with the url's position in "index". """
+        cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
         query_crawl = kwargs.get("crawl", "")
         if query_crawl:
             assert query_crawl in self.dbs.keys()
-        pretty = kwargs.get("pretty", 0) > 0
-        verbose = kwargs.get("verbose", 0) > 0
+        exact = int(kwargs.get("exact", 0)) > 0
+        get_html = int(kwargs.get("html", 0)) > 0
         max_results = int(kwargs.get("max_results", self.max_results))
 
-        tld, _suffix, _path = split_uri(query_tld)
-        db_key = "%s " % (tld)
-
-        result = {"query_tld": query_tld, "db_key": db_key}
+        if "urls" in kwargs:
+            body = kwargs["urls"]
+        else:
+            body = cherrypy.request.body.read().decode("utf-8")
+        if body.lstrip().startswith("["):
+            query_urls = json.loads(body)
+        else:
+            query_urls = [url.strip() for url in body.split("\n")
+                          if url.strip()]
+
+        queries = []
+        for idx, query_url in enumerate(query_urls):
+            if not (query_url.startswith("http://") or
+                    query_url.startswith("https://")):
+                query_url = "http://%s" % query_url
+            query_domain, query_suffix, query_path = split_uri(query_url)
+            db_key = ("%s %s" % (query_domain, query_url)).encode("utf-8")
+            queries.append((db_key, idx, query_url, query_domain))
+        queries.sort()
+        db_keys = [q[0] for q in queries]
+        exact_uris = [q[2] for q in queries] if exact else None
+
+        sources = self._relevant_sources(query_crawl)
+
+        def stream():
+            # all dbs advance together, so each url is done after
+            # one step and can be sent right away
+            sweeps = [(label, self._sweep(db, db_keys, max_results,
+                                          exact_uris, query_crawl))
+                      for label, db in sources]
+            pending = dict((label, next(sweep, None))
+                           for label, sweep in sweeps)
+            for pos, (db_key, idx, query_url, query_domain) in \
+                    enumerate(queries):
+                locations = defaultdict(list)
+                n_results = 0
+                for label, sweep in sweeps:
+                    while pending[label] is not None and \
+                            pending[label][0] == pos:
+                        _, uri, crawl, value = pending[label]
+                        # max_results over all crawls, as in query_prefix
+                        n_results += 1
+                        if n_results <= max_results:
+                            locations[uri].append(
+                                self._decode_value(value, crawl))
+                        pending[label] = next(sweep, None)
+                if get_html:
+                    self._add_html(locations)
+                result = {"index": idx,
+                          "query_url": query_urls[idx],
+                          "query_domain": query_domain,
+                          "db_key": db_key.decode("utf-8"),
+                          "locations": locations}
+                yield json.dumps(result) + "\n"
+
+        return stream()
+    query_batch._cp_config = {'response.stream': True}
+
+    def _add_html(self, locations):
+        """ Downloads all pages of one query concurrently """
+        all_data = [data for uri in locations for data in locations[uri]]
+        pages = self.ccdownloader.download_many(
+            ((data["filename"], data["offset"], data["length"])
+             for data in all_data), n_workers=8, html_only=True)
+        for idx, html in pages:
+            all_data[idx]["html"] = html
 
-        n_results = 0
-
-        relevant_crawls = [query_crawl] if query_crawl else self.dbs.keys()
-
-        result["locations"] = defaultdict(list)
+    def get_html(self, data):
+        html = self.ccdownloader.download(data["filename"],
+                                          data["offset"],
+                                          data["length"],
+                                          html_only=True)
+        return html
 
-        for db_crawl in relevant_crawls:
-            db = self.dbs[db_crawl]
+    def _iter_tld(self, query_tld, query_crawl, cursor=None):
+        """ Yields (label, crawl, key, uri, value) for a domain, db by db.
+            With a cursor from _make_cursor, starts right after that key. """
+        tld, _suffix, _path = split_uri(query_tld)
+        db_key = "%s " % (tld)
+        resume_label, resume_key = None, None
+        if cursor:
+            resume_label, resume_key = json.loads(
+                base64.urlsafe_b64decode(str(cursor)))
+            resume_key = resume_key.encode("utf-8")
+            assert resume_key.startswith(db_key), "Cursor for other domain"
+
+        for label, db in self._relevant_sources(query_crawl):
+            if resume_label is not None and label < resume_label:
+                continue
             it = db.iteritems()
-            it.seek(db_key)
+            if label == resume_label:
+                it.seek(resume_key)
+            else:
+                it.seek(db_key)
             for key, value in it:
-                key = key.decode("utf-8")
                 if not key.startswith(db_key):
                     # We've gone too far
                     break
+                if label == resume_label and key == resume_key:
+                    continue
+                key = key.decode("utf-8")
 
                 tld, uri, crawl = key.split(" ", 2)
-                assert crawl == db_crawl
+                if query_crawl and crawl != query_crawl:
+                    continue
 
                 # This allows to query a suffix (e.g. .com) as well
                 if query_tld not in urlparse.urlparse(uri).netloc:
                     continue
 
-                n_results += 1
-                if n_results > max_results:
-                    break
-                data = json.loads(value)
+                yield label, crawl, key, uri, value
+
+    def _make_cursor(self, label, key):
+        return base64.urlsafe_b64encode(json.dumps([label, key]))
+
+    def _decode_tld_value(self, value, crawl):
+        data = self.codecs[crawl].decode(value)
 
-                # work around stupid error
-                if 'offset:' in data:
-                    data['offset'] = data.pop('offset:')
+        # work around stupid error
+        if 'offset:' in data:
+            data['offset'] = data.pop('offset:')
 
-                data["crawl"] = db_crawl
-                result["locations"][uri].append(data)
+        data["crawl"] = crawl
+        return data
+
+    @cherrypy.expose
+    def query_tld(self, **kwargs):
+        """ All urls of a domain. Results are capped at max_results; the
+            returned cursor continues after the last one. With stream=1
+            each result is sent as one JSON line while the DB is read,
+            followed by a line with the number of results and the cursor.
+        """
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        start_time = time.time()
+        query_tld = kwargs["tld"]
+        query_crawl = kwargs.get("crawl", "")
+        if query_crawl:
+            assert query_crawl in self.dbs.keys()
+        pretty = kwargs.get("pretty", 0) > 0
+        verbose = kwargs.get("verbose", 0) > 0
+        stream = int(kwargs.get("stream", 0)) > 0
+        max_results = int(kwargs.get("max_results", self.max_results))
+        assert max_results > 0, "max_results needs to be positive"
+
+        results = self._iter_tld(query_tld, query_crawl,
+                                 kwargs.get("cursor"))
+
+        if stream:
+            cherrypy.response.headers['Content-Type'] = \
+                'application/x-ndjson'
+            return self._stream_tld(results, max_results, start_time,
+                                    verbose)
+
+        tld, _suffix, _path = split_uri(query_tld)
+        result = {"query_tld": query_tld, "db_key": "%s " % (tld)}
+        result["locations"] = defaultdict(list)
+
+        n_results = 0
+        for label, crawl, key, uri, value in results:
+            n_results += 1
+            if n_results > max_results:
+                # there is more, continue after the last one returned
+                result["cursor"] = self._make_cursor(last_label, last_key)
+                break
+            result["locations"][uri].append(
+                self._decode_tld_value(value, crawl))
+            last_label, last_key = label, key
 
         if verbose:
             result["time"] = "%.2fs" % (time.time() - start_time)
         return self._dump_json(result, pretty)
-
+    query_tld._cp_config = {'response.stream': True}
+
+    def _stream_tld(self, results, max_results, start_time, verbose,
+                    chunk_size=1000):
+        chunk = []
+        n_results, cursor = 0, None
+        for label, crawl, key, uri, value in results:
+            if n_results == max_results:
+                cursor = self._make_cursor(last_label, last_key)
+                break
+            n_results += 1
+            data = self._decode_tld_value(value, crawl)
+            data["uri"] = uri
+            chunk.append(json.dumps(data))
+            if len(chunk) == chunk_size:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+            last_label, last_key = label, key
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+        summary = {"n_results": n_results, "cursor": cursor}
+        if verbose:
+            summary["time"] = "%.2fs" % (time.time() - start_time)
+        yield json.dumps(summary) + "\n"
 
 if __name__ == "__main__":
     import argparse
@@ -245,6 +456,12 @@ if __name__ == "__main__":
                         help='verbosity level, default: 0',
                         type=int,
                         default=0)
+    parser.add_argument('-cache_dir',
+                        help='keep downloaded records in this directory')
+    parser.add_argument('-cache_size',
+                        help='max. cache size in GB, default: 10',
+                        type=float,
+                        default=10.)
     parser.add_argument('db', nargs='+', help='leveldb root directories')
     # parser.add_argument('url', help='url to search for')
 
@@ -266,4 +483,7 @@ if __name__ == "__main__":
     cherrypy.quickstart(DBInterface(args.db,
                                     pretty=args.pretty,
                                     verbose=args.verbose,
-                                    max_results=args.maxresults))
+                                    max_results=args.maxresults,
+                                    cache_dir=args.cache_dir,
+                                    cache_size=int(args.cache_size *
+                                                   1024 ** 3)))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+import json
+import sys
+import rocksdb
+
+from value_codec import CRAWLS_KEY, is_meta_key
+
+""" Merges per-crawl metadata DBs into one. Keys are 'domain url crawl', so
+    all crawls of a url end up next to each other and md_server.py finds a
+    url's history with a single seek instead of one per crawl. """
+
+
+def open_db(db_directory, read_only=True):
+    opts = rocksdb.Options()
+    opts.create_if_missing = not read_only
+    opts.max_open_files = 100
+    opts.num_levels = 6
+    return rocksdb.DB(db_directory, opts, read_only=read_only)
+
+
+def get_crawls(db):
+    """ Crawls held by a DB, see md_server.DBInterface """
+    crawls = db.get(CRAWLS_KEY)
+    if crawls is not None:
+        return json.loads(crawls)
+    it = db.iterkeys()
+    it.seek_to_first()
+    tld, url, crawl = it.next().split(" ", 2)
+    return [crawl]
+
+
+def read_entries(db):
+    it = db.iteritems()
+    it.seek_to_first()
+    for key, value in it:
+        if key != CRAWLS_KEY:
+            yield key, value
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outdb', help='rocksdb directory to create')
+    parser.add_argument('db', nargs='+', help='rocksdb directories to merge')
+    parser.add_argument('-batchsize', help='size of write batches',
+                        default=100000, type=int)
+    args = parser.parse_args(sys.argv[1:])
+
+    dbs = [open_db(db_directory) for db_directory in args.db]
+    crawls = []
+    for db_directory, db in zip(args.db, dbs):
+        db_crawls = get_crawls(db)
+        sys.stderr.write("DB at %s holds crawl %s\n" %
+                         (db_directory, ", ".join(db_crawls)))
+        for crawl in db_crawls:
+            assert crawl not in crawls, "Multiple dbs for %s\n" % crawl
+        crawls.extend(db_crawls)
+
+    outdb = open_db(args.outdb, read_only=False)
+    batch = rocksdb.WriteBatch()
+    batch_size = 0
+    count = 0
+    # all inputs are sorted, so this writes in key order
+    for key, value in heapq.merge(*[read_entries(db) for db in dbs]):
+        batch.put(key, value)
+        batch_size += 1
+        if not is_meta_key(key):
+            count += 1
+        if batch_size >= args.batchsize:
+            outdb.write(batch)
+            sys.stderr.write('.')
+            batch = rocksdb.WriteBatch()
+            batch_size = 0
+    batch.put(CRAWLS_KEY, json.dumps(sorted(crawls)))
+    outdb.write(batch, sync=True)
+    sys.stderr.write("\nWrote %d entries of %d crawls\n"
+                     % (count, len(crawls)))
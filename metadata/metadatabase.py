@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import sys
+import gzip
 import json
-import tldextract
+import os
 from urlparse import urlparse
 import re
 
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from baseline import domains
+from value_codec import ValueCodec, dict_key
+
 magic_number = "df6fa1abb58549287111ba8d776733e9"
 commoncrawl_s3_url = "https://commoncrawl.s3.amazonaws.com/"
 
@@ -26,7 +31,7 @@ def get_tld(uri):
         return ""
     # netloc = urlparse(uri)
     try:
-        tld = tldextract.extract(netloc)
+        tld = domains.extract(netloc)
     except UnicodeError:
         return None
     except IndexError:
@@ -117,8 +122,8 @@ def process_cdx(line, args):
     return key, valuedict
 
 
-def read_cdx(args):
-    for line in sys.stdin:
+def read_cdx(args, infile=sys.stdin):
+    for line in infile:
 #        yield process_cdx(line, args)
 #        continue
         try:
@@ -170,10 +175,23 @@ if __name__ == "__main__":
                         default=100000, type=int)
     parser.add_argument('--prefix', help='prefix for filename',
                         default='')
+    parser.add_argument('--binary', action='store_true',
+                        help='write compact binary values, see value_codec')
+    parser.add_argument('--warc_paths',
+                        help='warc.paths(.gz) of the crawl, needed for '
+                        '--binary')
     parser.add_argument('crawl', help='crawl id, e.g. 2013_11')
     parser.add_argument('folder', help='subfolder, e.g. 1368696381249')
     args = parser.parse_args(sys.argv[1:])
 
+    dumps = json.dumps
+    if args.binary:
+        assert args.warc_paths, "--binary needs --warc_paths"
+        open_paths = gzip.open if args.warc_paths.endswith('.gz') else open
+        with open_paths(args.warc_paths) as paths_file:
+            codec = ValueCodec.from_paths(paths_file)
+        dumps = codec.dumps
+
     db = None
     if args.db:
         import leveldb
@@ -182,6 +200,13 @@ if __name__ == "__main__":
         batch_size = 0
         batch = leveldb.WriteBatch()
 
+    if args.binary:
+        if db is not None:
+            db.Put(dict_key(args.crawl), codec.dict_value())
+        else:
+            sys.stdout.write("%s\t%s\n" %
+                             (dict_key(args.crawl), codec.dict_value()))
+
     count = 0
     kv_generator = read_cdx(args) if args.cdx else read_json(args)
     if args.old:
@@ -199,17 +224,17 @@ if __name__ == "__main__":
                     batch = leveldb.WriteBatch()
                     batch_size = 0
                 else:
-                    batch.Put("%s" % key, json.dumps(valuedict))
+                    batch.Put("%s" % key, dumps(valuedict))
                     batch_size += 1
             else:  # no batch writes
                 if count % 10000 == 0:
                     sys.stderr.write('>')
-                db.Put("%s" % key, json.dumps(valuedict))
+                db.Put("%s" % key, dumps(valuedict))
         else:
             # if count % 10000 == 0:
             #     sys.stderr.write(':')
             sys.stdout.write("%s\t%s\n" %
-                             (key, json.dumps(valuedict)))
+                             (key, dumps(valuedict)))
 
     if db is not None and batch_size > 0:
         db.Write(batch, sync=True)
@@ -7,6 +7,18 @@ import tldextract
 import time
 from collections import defaultdict
 
+from value_codec import ValueCodec, dict_key
+
+
+def get_codec(db, crawl, codecs={}):
+    """ Reads the filename list for binary values once per crawl """
+    if crawl not in codecs:
+        try:
+            codecs[crawl] = ValueCodec.from_dict_value(db.Get(dict_key(crawl)))
+        except KeyError:
+            codecs[crawl] = ValueCodec()
+    return codecs[crawl]
+
 
 def get_tld(uri):
     netloc = urlparse.urlparse(uri).netloc
@@ -35,7 +47,7 @@ if __name__ == "__main__":
         tld, uri, crawl = key.split(" ", 2)
         if query_tld != tld:
             break
-        data = json.loads(value)
+        data = get_codec(db, crawl).decode(value)
         uri2crawl[uri].append((crawl, data))
         crawl2uri[crawl].add(uri)
 
@@ -5,6 +5,8 @@ import sys
 import chardet
 from chardet.universaldetector import UniversalDetector
 
+from warc_reader import open_records, map_records
+
 
 def guess_encoding_incremental(data):
     sys.stderr.write("running incremental chardet\n")
@@ -48,38 +50,30 @@ def convert_to_utf8(data, force_chardet=False):
 magic_number = "df6fa1abb58549287111ba8d776733e9"
 
 
-def process_buffer(uri, buf):
-    sys.stdout.write("%s uri:%s\n" % (magic_number, uri))
-    buf = "".join(buf)
-    buf = convert_to_utf8(buf)
-    sys.stdout.write(buf.encode("utf-8"))
-
-in_header, in_content = False, False
-uri, buf = None, []
-
-skip = True
-
-for line in sys.stdin:
-    assert not (in_header and in_content)
-    assert not (in_header and buf)
-    assert not (in_content and not uri)
-
-    if line.startswith("WARC-Type: conversion"):
-        in_header = True
-        continue
-
-    if in_header:
-        if line.startswith("WARC-Target-URI:"):
-            uri = line.split(" ", 1)[1].strip()
-        if not line.strip():
-            in_content = True
-            in_header = False
-        continue
-
-    if in_content:
-        if not line.strip():
-            process_buffer(uri, buf)
-            uri, buf = None, []
-            in_content = False
-        else:
-            buf.append(line)
+def convert_record(record):
+    """ Output for a WET conversion record """
+    headers, payload = record
+    text = convert_to_utf8(payload).encode("utf-8")
+    if not text.endswith("\n"):
+        text += "\n"
+    return "%s uri:%s\n%s" % (magic_number, headers["WARC-Target-URI"], text)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', nargs='?', default='-',
+                        help='WET file or url, .gz or uncompressed, '
+                        'default: stdin')
+    parser.add_argument('-processes', type=int, default=1,
+                        help='decode records in parallel')
+    parser.add_argument('-unzip_processes', type=int, default=1,
+                        help='decompress gzip members in parallel')
+    args = parser.parse_args(sys.argv[1:])
+
+    records = open_records(args.infile,
+                           unzip_processes=args.unzip_processes)
+    records = (record for record in records
+               if record[0].get("WARC-Type") == "conversion")
+    for output in map_records(convert_record, records, args.processes):
+        sys.stdout.write(output)
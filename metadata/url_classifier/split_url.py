@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import sys
 from urlparse import urlparse, parse_qsl
-import tldextract
 import re
 import random
 
+sys.path.insert(1, os.path.join(sys.path[0], '..', '..'))
+from baseline import domains
+
 # example: df6fa1abb58549287111ba8d776733e9
 # uri:http://49ersnews.com/forum/index.php?showtopic=36414&st=15
 # encoding:iso-8859-1 tld:com domain:49ersnews bytes:1180
@@ -34,7 +37,7 @@ def url_components(uri, max_length, valid_components):
     # extract subdomain, domain, suffic from full domain
     # e.g.: tldextract.extract('radio1.bbc.co.uk')
     # gives ExtractResult(subdomain='radio1', domain='bbc', suffix='co.uk')
-    domain_parts = tldextract.extract(parts.netloc)
+    domain_parts = domains.extract(parts.netloc)
     if domain_parts.subdomain:
         components.add("sub:%s" % domain_parts.subdomain)
     if domain_parts.domain:
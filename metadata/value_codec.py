@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import json
+import struct
+
+# Compact encoding of metadata values.
+#
+# Instead of a JSON object with the full S3 url of the WARC file, a value
+# holds the position of the WARC file in the crawl's warc.paths list, offset,
+# length and an interned mime type, and/or the number of bytes per language.
+# Numbers are fixed width little endian: struct.unpack is a lot faster than
+# decoding varints in Python, and all of it is still ~10 times smaller than
+# JSON. Values are base64 encoded so they stay on one line in .kv files and
+# pass through insertkv unchanged; JSON values start with '{', which is not
+# a base64 character, so both kinds can be read side by side.
+#
+# The filename list of a crawl is stored in the DB itself, under
+# dict_key(crawl), which sorts after all regular keys.
+
+commoncrawl_s3_url = "https://commoncrawl.s3.amazonaws.com/"
+
+VERSION = 1
+LOCATION, LANGUAGES = 1, 2
+
+# mime type ids, 0 means the type follows as string
+MIME_TYPES = ["UNKNOWN", "text/html", "application/xhtml+xml",
+              "text/plain", "application/pdf", "text/xml", "application/xml",
+              "application/rss+xml", "application/atom+xml",
+              "application/json", "application/javascript", "text/css",
+              "text/calendar", "application/msword", "image/jpeg",
+              "image/png", "image/gif", "application/octet-stream", "unk"]
+MIME_IDS = dict((mime, idx + 1) for idx, mime in enumerate(MIME_TYPES))
+
+HEADER = struct.Struct("<BB")  # version, flags
+LOCATION_FIELDS = struct.Struct("<IQIB")  # file id, offset, length, mime id
+STRING_LENGTH = struct.Struct("<B")
+
+
+_count_structs = {}
+
+
+def _counts(n):
+    """ Struct for n language byte counts """
+    if n not in _count_structs:
+        _count_structs[n] = struct.Struct("<%dQ" % n)
+    return _count_structs[n]
+
+
+def _pack_string(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    assert len(s) < 256, "String too long: %s" % s
+    return STRING_LENGTH.pack(len(s)) + s
+
+
+def _unpack_string(buf, pos):
+    length = ord(buf[pos])
+    return buf[pos + 1:pos + 1 + length].decode('utf-8'), pos + 1 + length
+
+
+# Keys starting with '~ ' hold data about the DB, they sort after all
+# domains.
+CRAWLS_KEY = "~ crawls"  # JSON list of crawls if a DB holds several
+
+
+def dict_key(crawl):
+    """ Key of the filename list of a crawl """
+    return "~ filenames %s" % crawl
+
+
+def is_meta_key(key):
+    return key.startswith("~ ")
+
+
+class ValueCodec(object):
+
+    def __init__(self, filenames=()):
+        """ filenames as in warc.paths, i.e. relative to the S3 bucket """
+        self.filenames = list(filenames)
+        self.file_ids = dict((f, idx) for idx, f in enumerate(self.filenames))
+
+    @classmethod
+    def from_paths(cls, paths_file):
+        return cls(line.strip() for line in paths_file if line.strip())
+
+    @classmethod
+    def from_dict_value(cls, value):
+        return cls(json.loads(value))
+
+    def dict_value(self):
+        return json.dumps(self.filenames)
+
+    def encode(self, valuedict):
+        """ Binary value or None if the filename is not known """
+        flags = 0
+        if "filename" in valuedict:
+            filename = valuedict["filename"]
+            if filename.startswith(commoncrawl_s3_url):
+                filename = filename[len(commoncrawl_s3_url):]
+            file_id = self.file_ids.get(filename)
+            if file_id is None:
+                return None
+            flags |= LOCATION
+        if "languages" in valuedict:
+            flags |= LANGUAGES
+        out = [HEADER.pack(VERSION, flags)]
+        if flags & LOCATION:
+            mime = valuedict.get("mime", "UNKNOWN")
+            out.append(LOCATION_FIELDS.pack(
+                file_id, int(valuedict["offset"]), int(valuedict["length"]),
+                MIME_IDS.get(mime, 0)))
+            if mime not in MIME_IDS:
+                out.append(_pack_string(mime))
+        if flags & LANGUAGES:
+            # codes as one space separated string, then the counts
+            languages = valuedict["languages"]
+            out.append(_pack_string(" ".join(lang for lang, _ in languages)))
+            out.append(_counts(len(languages)).pack(
+                *[n_bytes for _, n_bytes in languages]))
+        return base64.b64encode("".join(out))
+
+    def dumps(self, valuedict):
+        """ Binary if possible, JSON otherwise """
+        value = self.encode(valuedict)
+        if value is None:
+            return json.dumps(valuedict)
+        return value
+
+    def decode(self, value):
+        """ dict as stored by json.dumps, for JSON and binary values """
+        if value.startswith("{"):
+            return json.loads(value)
+        buf = base64.b64decode(value)
+        version, flags = HEADER.unpack_from(buf)
+        assert version == VERSION, "Unknown value version %d" % version
+        pos = HEADER.size
+        data = {}
+        if flags & LOCATION:
+            file_id, data["offset"], data["length"], mime_id = \
+                LOCATION_FIELDS.unpack_from(buf, pos)
+            pos += LOCATION_FIELDS.size
+            if mime_id:
+                data["mime"] = MIME_TYPES[mime_id - 1]
+            else:
+                data["mime"], pos = _unpack_string(buf, pos)
+            data["filename"] = commoncrawl_s3_url + self.filenames[file_id]
+        if flags & LANGUAGES:
+            length = ord(buf[pos])
+            langs = buf[pos + 1:pos + 1 + length].split()
+            counts = _counts(len(langs)).unpack_from(buf, pos + 1 + length)
+            data["languages"] = [[lang, count]
+                                 for lang, count in zip(langs, counts)]
+        return data
+
+    def merge(self, old_value, new_value):
+        """ Fields of new_value replace those of old_value """
+        data = self.decode(old_value)
+        data.update(self.decode(new_value))
+        return self.dumps(data)
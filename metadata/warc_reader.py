@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import mmap
+import multiprocessing
+import re
+import sys
+
+from gzip_members import open_input
+
+# Record level reader for WARC/WET/WAT files. Payloads are sliced out of
+# large blocks (or a mmap of an uncompressed local file) using the
+# Content-Length header instead of looking at every line.
+
+BLOCK_SIZE = 16 * 1024 * 1024
+HEADER_END = re.compile(r'\r?\n\r?\n')
+SEPARATOR = re.compile(r'[\r\n]*')
+
+
+def parse_headers(block):
+    """ Dict of the 'Name: value' lines of a record header, the first
+        occurrence of a name wins """
+    headers = {}
+    for line in block.splitlines()[1:]:
+        name, _, value = line.partition(":")
+        if name not in headers:
+            headers[name] = value.strip()
+    return headers
+
+
+def iter_records(data, read=None, block_size=BLOCK_SIZE):
+    """ Yields (headers, payload) for the records in data, a string or
+        mmap. If read is given, more data is read with read(size) when
+        data is used up. """
+    pos = SEPARATOR.match(data).end()
+    eof = read is None
+    while True:
+        header_end = HEADER_END.search(data, pos)
+        length = None
+        if header_end is not None:
+            headers = parse_headers(data[pos:header_end.start()])
+            length = int(headers.get("Content-Length", 0))
+            if header_end.end() + length <= len(data):
+                payload = data[header_end.end():header_end.end() + length]
+                pos = SEPARATOR.match(data, header_end.end() + length).end()
+                yield headers, payload
+                continue
+        if eof:
+            if pos < len(data):
+                sys.stderr.write("Skipping truncated record at end of input "
+                                 "(%d bytes)\n" % (len(data) - pos))
+            return
+        needed = block_size
+        if length is not None:
+            needed = max(needed, header_end.end() + length - len(data))
+        block = read(needed)
+        eof = not block
+        data = data[pos:] + block
+        # the separator may have been split between blocks
+        pos = SEPARATOR.match(data).end()
+
+
+def open_records(filename, block_size=BLOCK_SIZE, unzip_processes=1):
+    """ Records of a file or url, '-' reads stdin. Local uncompressed
+        files are mapped into memory, everything else is read in blocks
+        and decompressed if necessary, see gzip_members. """
+    if filename == '-' or filename.endswith(".gz") or \
+            filename.startswith("http://") or \
+            filename.startswith("https://"):
+        infile = open_input(filename, unzip_processes)
+        return iter_records("", infile.read, block_size)
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        except ValueError:  # empty file
+            return iter([])
+    return iter_records(data)
+
+
+def map_records(function, records, processes=1, chunksize=16):
+    """ function(record) for each record, in input order. With more than
+        one process, records are handed to a pool in chunks. """
+    if processes <= 1:
+        for record in records:
+            yield function(record)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(function, records, chunksize):
+            yield result
+    finally:
+        pool.terminate()